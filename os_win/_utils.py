@@ -41,6 +41,12 @@ socket = eventlet.import_patched('socket')
 synchronized = lockutils.synchronized_with_prefix('oswin-')
 
 _WBEM_E_NOT_FOUND = 0x80041002
+_RPC_FAILURE_HRESULTS = (
+    0x800706BA,  # RPC_S_SERVER_UNAVAILABLE
+    0x800706BE,  # RPC_S_CALL_FAILED
+    0x80010108,  # RPC_E_DISCONNECTED
+    0x80010114,  # RPC_E_SERVER_DIED_DNE
+)
 
 
 def execute(*cmd, **kwargs):
@@ -231,6 +237,11 @@ def _is_not_found_exc(exc):
     return hresult == _WBEM_E_NOT_FOUND
 
 
+def _is_rpc_failure_exc(exc):
+    hresult = get_com_error_hresult(exc.com_error)
+    return hresult in _RPC_FAILURE_HRESULTS
+
+
 def not_found_decorator(translated_exc=exceptions.NotFound):
     """Wraps x_wmi: Not Found exceptions as os_win.exceptions.NotFound."""
 
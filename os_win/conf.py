@@ -25,8 +25,18 @@ os_win_opts = [
                 help='Caches temporary WMI objects in order to increase '
                      'performance. This only affects networkutils, where '
                      'almost all operations require a reference to a '
-                     'switch port. The cached objects are no longer valid '
-                     'if the VM they are associated with is destroyed.'),
+                     'switch port. Cached switch port objects are '
+                     'invalidated when the according ports are removed.'),
+    cfg.IntOpt('wmi_object_cache_max_size',
+               default=4096,
+               help='The maximum number of entries of each networkutils '
+                    'WMI object cache. The least recently used entries are '
+                    'evicted when this limit is exceeded.'),
+    cfg.IntOpt('wmi_object_cache_ttl',
+               default=3600,
+               help='The number of seconds after which the cached '
+                    'networkutils WMI objects expire. Set to 0 in order to '
+                    'disable expiration.'),
 ]
 
 CONF = cfg.CONF
@@ -220,6 +220,11 @@ class WMIJobFailed(HyperVException):
         super(WMIJobFailed, self).__init__(message, **kwargs)
 
 
+class WMIJobTimeout(HyperVException):
+    msg_fmt = _("WMI job %(job_path)s did not complete in %(timeout)s "
+                "seconds.")
+
+
 class JobTerminateFailed(HyperVException):
     msg_fmt = _("Could not terminate the requested job(s).")
 
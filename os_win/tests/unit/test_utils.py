@@ -254,6 +254,18 @@ class UtilsTestCase(base.BaseTestCase):
         self.assertEqual(expected, result)
         mock_get_com_error_hresult.assert_called_once_with(exc.com_error)
 
+    @ddt.data(_utils._RPC_FAILURE_HRESULTS[0], _utils._WBEM_E_NOT_FOUND)
+    @mock.patch.object(_utils, 'get_com_error_hresult')
+    def test_is_rpc_failure_exc(self, hresult, mock_get_com_error_hresult):
+        mock_get_com_error_hresult.return_value = hresult
+        exc = mock.MagicMock()
+
+        result = _utils._is_rpc_failure_exc(exc)
+
+        expected = hresult in _utils._RPC_FAILURE_HRESULTS
+        self.assertEqual(expected, result)
+        mock_get_com_error_hresult.assert_called_once_with(exc.com_error)
+
     @mock.patch.object(_utils, 'get_com_error_hresult')
     def test_not_found_decorator(self, mock_get_com_error_hresult):
         mock_get_com_error_hresult.side_effect = lambda x: x
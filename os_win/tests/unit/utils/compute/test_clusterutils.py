@@ -778,20 +778,32 @@ class ClusterUtilsTestCase(test_base.OsWinBaseTestCase):
                                               self._FAKE_PREV_HOST,
                                               self._FAKE_HOST)
 
-    @mock.patch.object(clusterutils.ClusterUtils, 'monitor_vm_failover')
+    @mock.patch.object(clusterutils.ClusterUtils, '_process_failover_event')
+    @mock.patch.object(clusterutils.ClusterUtils, '_get_wmi_event_hub')
     @mock.patch.object(clusterutils, 'time')
-    def test_get_vm_owner_change_listener(self, mock_time, mock_monitor):
-        mock_monitor.side_effect = [None, exceptions.OSWinException,
-                                    KeyboardInterrupt]
+    def test_get_vm_owner_change_listener(self, mock_time, mock_get_hub,
+                                          mock_process_event):
+        mock_subscribe = mock_get_hub.return_value.subscribe
+        mock_subscription = mock_subscribe.return_value
+        mock_subscription.get.side_effect = [
+            None, mock.sentinel.event, exceptions.OSWinException,
+            KeyboardInterrupt]
 
         listener = self._clusterutils.get_vm_owner_change_listener()
         self.assertRaises(KeyboardInterrupt,
                           listener,
                           mock.sentinel.callback)
 
-        mock_monitor.assert_has_calls(
-            [mock.call(mock.sentinel.callback,
-                       constants.DEFAULT_WMI_EVENT_TIMEOUT_MS)] * 3)
+        mock_get_hub.assert_called_once_with(
+            self._clusterutils._MS_CLUSTER_NAMESPACE %
+            self._clusterutils._host)
+        mock_subscribe.assert_called_once_with(
+            self._clusterutils._get_failover_watcher_query())
+        mock_subscription.get.assert_has_calls(
+            [mock.call(
+                timeout=constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000)] * 4)
+        mock_process_event.assert_called_once_with(mock.sentinel.event,
+                                                   mock.sentinel.callback)
         mock_time.sleep.assert_called_once_with(
             constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000)
 
@@ -0,0 +1,140 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win.tests.unit import test_base
+from os_win.utils.compute import _disk_resource_index
+
+
+class DiskResourceIndexTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V disk resource index."""
+
+    _FAKE_CLASS = 'Msvm_StorageAllocationSettingData'
+
+    def setUp(self):
+        super(DiskResourceIndexTestCase, self).setUp()
+        self._conn = mock.Mock()
+        self._event_hub = mock.Mock()
+        self._index = _disk_resource_index.DiskResourceIndex(
+            self._conn, {self._FAKE_CLASS: ['sub_type_0', 'sub_type_1']},
+            event_hub=self._event_hub)
+
+    def _get_fake_resource(self, instance_id, host_resource=None,
+                           serial=None):
+        return mock.Mock(InstanceID=instance_id,
+                         HostResource=[host_resource] if host_resource else [],
+                         ElementName=serial)
+
+    def test_refresh(self):
+        self._conn.query.return_value = [
+            self._get_fake_resource('id_0',
+                                    host_resource='C:\\Disk.VHDX'),
+            self._get_fake_resource('id_1',
+                                    serial=mock.sentinel.serial)]
+
+        self._index.refresh()
+
+        self._conn.query.assert_called_once_with(
+            "SELECT InstanceID, HostResource, ElementName "
+            "FROM Msvm_StorageAllocationSettingData WHERE "
+            "ResourceSubType = 'sub_type_0' OR "
+            "ResourceSubType = 'sub_type_1'")
+        self.assertEqual(
+            'id_0',
+            self._index.get(self._FAKE_CLASS, disk_path='c:\\disk.vhdx'))
+        self.assertEqual(
+            'id_1',
+            self._index.get(self._FAKE_CLASS, serial=mock.sentinel.serial))
+        self.assertIsNone(
+            self._index.get(mock.sentinel.other_class,
+                            disk_path='c:\\disk.vhdx'))
+
+    @mock.patch.object(_disk_resource_index.DiskResourceIndex, 'refresh')
+    @mock.patch.object(_disk_resource_index.DiskResourceIndex,
+                       '_process_event')
+    def test_start(self, mock_process_event, mock_refresh):
+        self._index.start()
+
+        self.assertEqual(3, self._event_hub.subscribe.call_count)
+        mock_refresh.assert_called_once_with()
+
+        callback = self._event_hub.subscribe.call_args_list[2][1]['callback']
+        callback(mock.sentinel.event)
+        mock_process_event.assert_called_once_with(
+            self._index._EVENT_TYPE_MODIFY, self._FAKE_CLASS,
+            mock.sentinel.event)
+
+        self._index.stop()
+        subscription = self._event_hub.subscribe.return_value
+        self.assertEqual(3, subscription.cancel.call_count)
+
+    @mock.patch.object(_disk_resource_index.DiskResourceIndex, 'refresh')
+    def test_start_no_events(self, mock_refresh):
+        self._index.start(track_events=False)
+
+        self.assertFalse(self._event_hub.subscribe.called)
+        mock_refresh.assert_called_once_with()
+
+    def test_get_event_query(self):
+        query = self._index._get_event_query(
+            self._index._EVENT_TYPE_CREATE, self._FAKE_CLASS)
+
+        expected_query = (
+            "SELECT * FROM __InstanceCreationEvent WITHIN 2 "
+            "WHERE TargetInstance ISA 'Msvm_StorageAllocationSettingData' "
+            "AND (TargetInstance.ResourceSubType = 'sub_type_0' OR "
+            "TargetInstance.ResourceSubType = 'sub_type_1')")
+        self.assertEqual(expected_query, query)
+
+    def test_process_events(self):
+        resource = self._get_fake_resource('id', host_resource='disk_path',
+                                           serial=mock.sentinel.serial)
+        self._index._process_event(self._index._EVENT_TYPE_CREATE,
+                                   self._FAKE_CLASS, resource)
+
+        self.assertEqual('id',
+                         self._index.get(self._FAKE_CLASS,
+                                         disk_path='disk_path'))
+
+        # The disk path was updated.
+        resource.HostResource = ['new_disk_path']
+        self._index._process_event(self._index._EVENT_TYPE_MODIFY,
+                                   self._FAKE_CLASS, resource)
+
+        self.assertIsNone(self._index.get(self._FAKE_CLASS,
+                                          disk_path='disk_path'))
+        self.assertEqual('id',
+                         self._index.get(self._FAKE_CLASS,
+                                         disk_path='new_disk_path'))
+
+        self._index._process_event(self._index._EVENT_TYPE_DELETE,
+                                   self._FAKE_CLASS, resource)
+
+        self.assertIsNone(self._index.get(self._FAKE_CLASS,
+                                          disk_path='new_disk_path'))
+        self.assertIsNone(self._index.get(self._FAKE_CLASS,
+                                          serial=mock.sentinel.serial))
+
+    def test_invalidate(self):
+        self._index.update(
+            self._FAKE_CLASS,
+            self._get_fake_resource('id', host_resource='disk_path'))
+
+        self._index.invalidate('id')
+
+        self.assertIsNone(self._index.get(self._FAKE_CLASS,
+                                          disk_path='disk_path'))
+        self.assertEqual({}, self._index._entries)
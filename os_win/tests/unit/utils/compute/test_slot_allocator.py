@@ -0,0 +1,75 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win import exceptions
+from os_win.tests.unit import test_base
+from os_win.utils.compute import _slot_allocator
+
+
+class ControllerSlotAllocatorTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the controller slot allocator."""
+
+    def setUp(self):
+        super(ControllerSlotAllocatorTestCase, self).setUp()
+        self._allocator = _slot_allocator.ControllerSlotAllocator(
+            4, used_slots=[0, 2])
+
+    def test_reserve(self):
+        self.assertEqual(1, self._allocator.get_free_slot())
+        self.assertEqual(1, self._allocator.reserve())
+        self.assertEqual(3, self._allocator.reserve())
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._allocator.reserve)
+
+    def test_commit_release(self):
+        slot = self._allocator.reserve()
+        self._allocator.commit(slot)
+        self.assertTrue(self._allocator.is_used(slot))
+
+        self._allocator.release(0)
+        self.assertFalse(self._allocator.is_used(0))
+        self.assertEqual(0, self._allocator.reserve())
+
+        self._allocator.release(0)
+        self.assertEqual(0, self._allocator.get_free_slot())
+
+    def test_update(self):
+        slot = self._allocator.reserve()
+
+        self._allocator.update([])
+
+        # Reservations are preserved.
+        self.assertTrue(self._allocator.is_used(slot))
+        self.assertFalse(self._allocator.is_used(0))
+        self.assertEqual(0, self._allocator.get_free_slot())
+
+    @mock.patch.object(_slot_allocator.time, 'time')
+    def test_update_expired_reservations(self, mock_time):
+        allocator = _slot_allocator.ControllerSlotAllocator(
+            4, reservation_timeout=10)
+        mock_time.return_value = 0
+        stale_slot = allocator.reserve()
+        mock_time.return_value = 5
+        slot = allocator.reserve()
+
+        mock_time.return_value = 10
+        allocator.update([])
+
+        self.assertFalse(allocator.is_used(stale_slot))
+        self.assertTrue(allocator.is_used(slot))
+        self.assertEqual(10, allocator.updated_at)
@@ -0,0 +1,159 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win.tests.unit import test_base
+from os_win.utils.compute import _vm_lookup_cache
+
+
+class VMLookupCacheTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V VM lookup cache."""
+
+    _FAKE_VM_ID = 'fake-vm-id'
+    _FAKE_INSTANCE_ID = 'Microsoft:fake-vm-id'
+
+    def setUp(self):
+        super(VMLookupCacheTestCase, self).setUp()
+        self._conn = mock.Mock()
+        self._event_hub = mock.Mock()
+        self._cache = _vm_lookup_cache.VMLookupCache(self._conn,
+                                                     self._event_hub)
+
+    def _get_fake_wmi_obj(self, path, **kwargs):
+        return mock.Mock(path_=mock.Mock(return_value=path), **kwargs)
+
+    def test_refresh(self):
+        vssds = [
+            self._get_fake_wmi_obj(mock.sentinel.vssd_path,
+                                   ElementName=mock.sentinel.vm_name,
+                                   InstanceID=self._FAKE_INSTANCE_ID),
+            self._get_fake_wmi_obj(mock.sentinel.dup_vssd_path,
+                                   ElementName=mock.sentinel.dup_name,
+                                   InstanceID=mock.sentinel.dup_id_0),
+            self._get_fake_wmi_obj(mock.sentinel.dup_vssd_path,
+                                   ElementName=mock.sentinel.dup_name,
+                                   InstanceID=mock.sentinel.dup_id_1)]
+        vms = [self._get_fake_wmi_obj(mock.sentinel.vm_path,
+                                      Name=self._FAKE_VM_ID)]
+        self._conn.query.side_effect = [vssds, vms]
+
+        self._cache.refresh()
+
+        expected_entry = _vm_lookup_cache.VMLookupEntry(
+            mock.sentinel.vm_path, mock.sentinel.vssd_path,
+            self._FAKE_INSTANCE_ID)
+        self.assertEqual(expected_entry,
+                         self._cache.get(mock.sentinel.vm_name))
+        self.assertIsNone(self._cache.get(mock.sentinel.dup_name))
+
+    @mock.patch.object(_vm_lookup_cache.VMLookupCache, 'refresh')
+    @mock.patch.object(_vm_lookup_cache.VMLookupCache, '_process_event')
+    def test_start(self, mock_process_event, mock_refresh):
+        self._cache.start()
+
+        self.assertEqual(3, self._event_hub.subscribe.call_count)
+        mock_refresh.assert_called_once_with()
+
+        callback = self._event_hub.subscribe.call_args_list[1][1]['callback']
+        callback(mock.sentinel.event)
+        mock_process_event.assert_called_once_with(
+            self._cache._EVENT_TYPE_DELETE, mock.sentinel.event)
+
+        self._cache.stop()
+        subscription = self._event_hub.subscribe.return_value
+        self.assertEqual(3, subscription.cancel.call_count)
+
+    def test_get_event_query_modify(self):
+        query = self._cache._get_event_query(
+            self._cache._EVENT_TYPE_MODIFY)
+
+        self.assertIn("TargetInstance ISA 'Msvm_ComputerSystem'", query)
+        self.assertIn("TargetInstance.ElementName != "
+                      "PreviousInstance.ElementName", query)
+
+    def test_process_create_event(self):
+        event = self._get_fake_wmi_obj(mock.sentinel.vm_path,
+                                       Name=self._FAKE_VM_ID,
+                                       ElementName=mock.sentinel.vm_name)
+
+        self._cache._process_event(self._cache._EVENT_TYPE_CREATE, event)
+
+        # The event object paths are not cached.
+        expected_entry = _vm_lookup_cache.VMLookupEntry(
+            None, None, self._FAKE_INSTANCE_ID)
+        self.assertEqual(expected_entry,
+                         self._cache.get(mock.sentinel.vm_name))
+        event.path_.assert_not_called()
+
+    def test_get_vm_id(self):
+        self.assertEqual(
+            self._FAKE_VM_ID,
+            self._cache.get_vm_id(self._FAKE_INSTANCE_ID))
+
+    def test_process_rename_event(self):
+        self._cache.update(mock.sentinel.old_name,
+                           vm_path=mock.sentinel.vm_path,
+                           instance_id=self._FAKE_INSTANCE_ID)
+        event = self._get_fake_wmi_obj(mock.sentinel.vm_path,
+                                       Name=self._FAKE_VM_ID,
+                                       ElementName=mock.sentinel.vm_name)
+
+        self._cache._process_event(self._cache._EVENT_TYPE_MODIFY, event)
+
+        self.assertIsNone(self._cache.get(mock.sentinel.old_name))
+        self.assertIsNotNone(self._cache.get(mock.sentinel.vm_name))
+
+    def test_process_duplicate_name_event(self):
+        self._cache.update(mock.sentinel.vm_name,
+                           instance_id=mock.sentinel.other_instance_id)
+        event = self._get_fake_wmi_obj(mock.sentinel.vm_path,
+                                       Name=self._FAKE_VM_ID,
+                                       ElementName=mock.sentinel.vm_name)
+
+        self._cache._process_event(self._cache._EVENT_TYPE_CREATE, event)
+
+        self.assertIsNone(self._cache.get(mock.sentinel.vm_name))
+
+    def test_process_delete_event(self):
+        self._cache.update(mock.sentinel.vm_name,
+                           instance_id=self._FAKE_INSTANCE_ID)
+        event = mock.Mock(Name=self._FAKE_VM_ID)
+
+        self._cache._process_event(self._cache._EVENT_TYPE_DELETE, event)
+
+        self.assertIsNone(self._cache.get(mock.sentinel.vm_name))
+        self.assertEqual({}, self._cache._names_by_id)
+
+    def test_update(self):
+        self._cache.update(mock.sentinel.vm_name,
+                           vm_path=mock.sentinel.vm_path)
+        self._cache.update(mock.sentinel.vm_name,
+                           vssd_path=mock.sentinel.vssd_path,
+                           instance_id=self._FAKE_INSTANCE_ID)
+
+        expected_entry = _vm_lookup_cache.VMLookupEntry(
+            mock.sentinel.vm_path, mock.sentinel.vssd_path,
+            self._FAKE_INSTANCE_ID)
+        self.assertEqual(expected_entry,
+                         self._cache.get(mock.sentinel.vm_name))
+
+    def test_invalidate(self):
+        self._cache.update(mock.sentinel.vm_name,
+                           instance_id=self._FAKE_INSTANCE_ID)
+        self._cache.invalidate(mock.sentinel.vm_name)
+
+        self.assertIsNone(self._cache.get(mock.sentinel.vm_name))
+        self.assertEqual({}, self._cache._names_by_id)
@@ -0,0 +1,129 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import ddt
+import mock
+
+from os_win.tests.unit import test_base
+from os_win.utils.compute import _vm_state_mirror
+
+
+@ddt.ddt
+class VMStateMirrorTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the VM state mirror."""
+
+    def setUp(self):
+        super(VMStateMirrorTestCase, self).setUp()
+        self._conn = mock.Mock()
+        self._event_hub = mock.Mock()
+        self._mirror = _vm_state_mirror.VMStateMirror(
+            self._conn, self._event_hub, resync_interval=10)
+
+    def _get_mock_vm(self, vm_id, vm_name, enabled_state):
+        return mock.Mock(Name=vm_id, ElementName=vm_name,
+                         EnabledState=enabled_state)
+
+    def _seed(self):
+        self._conn.query.return_value = [
+            self._get_mock_vm('id1', 'vm1', 2),
+            self._get_mock_vm('id2', 'vm2', 3),
+            self._get_mock_vm('id3', 'dup_vm', 2),
+            self._get_mock_vm('id4', 'dup_vm', 2)]
+        self._mirror.refresh()
+
+    @mock.patch.object(_vm_state_mirror.VMStateMirror, 'refresh')
+    @mock.patch.object(_vm_state_mirror.VMStateMirror, '_process_event')
+    def test_start(self, mock_process_event, mock_refresh):
+        self._mirror.start()
+
+        self.assertEqual(3, self._event_hub.subscribe.call_count)
+        mock_refresh.assert_called_once_with()
+
+        # The events are passed by the hub worker to the mirror.
+        callback = self._event_hub.subscribe.call_args_list[0][1]['callback']
+        callback(mock.sentinel.event)
+        mock_process_event.assert_called_once_with(
+            self._mirror._EVENT_TYPE_CREATE, mock.sentinel.event)
+
+        self._mirror.stop()
+        subscription = self._event_hub.subscribe.return_value
+        self.assertEqual(3, subscription.cancel.call_count)
+
+    def test_get_event_query(self):
+        query = self._mirror._get_event_query(
+            self._mirror._EVENT_TYPE_MODIFY)
+
+        self.assertIn("TargetInstance.Caption = 'Virtual Machine'", query)
+        self.assertIn("TargetInstance.EnabledState != "
+                      "PreviousInstance.EnabledState", query)
+
+    def test_refresh(self):
+        self._seed()
+
+        self._conn.query.assert_called_once_with(
+            "SELECT Name, ElementName, EnabledState FROM Msvm_ComputerSystem "
+            "WHERE Caption = 'Virtual Machine'")
+        self.assertEqual(2, self._mirror.get_state('vm1'))
+        self.assertEqual(3, self._mirror.get_state('vm2'))
+        # Duplicate VM names are not served from the mirror.
+        self.assertIsNone(self._mirror.get_state('dup_vm'))
+        self.assertTrue(self._mirror.exists('dup_vm'))
+        self.assertFalse(self._mirror.exists('missing_vm'))
+        self.assertEqual(['dup_vm', 'dup_vm', 'vm1'],
+                         sorted(self._mirror.get_vm_names(
+                             enabled_states=[2])))
+
+    def test_process_events(self):
+        self._seed()
+
+        self._mirror._process_event(
+            self._mirror._EVENT_TYPE_MODIFY,
+            self._get_mock_vm('id1', 'renamed_vm', 3))
+        self._mirror._process_event(
+            self._mirror._EVENT_TYPE_CREATE,
+            self._get_mock_vm('id5', 'vm5', 2))
+        self._mirror._process_event(
+            self._mirror._EVENT_TYPE_DELETE,
+            self._get_mock_vm('id3', 'dup_vm', 2))
+
+        self.assertFalse(self._mirror.exists('vm1'))
+        self.assertEqual(3, self._mirror.get_state('renamed_vm'))
+        self.assertEqual(2, self._mirror.get_state('vm5'))
+        self.assertEqual(2, self._mirror.get_state('dup_vm'))
+
+    @ddt.data({},
+              {'stale': False},
+              {'locked': True},
+              {'refresh_exc': True})
+    @ddt.unpack
+    @mock.patch('time.time')
+    @mock.patch.object(_vm_state_mirror.VMStateMirror, 'refresh')
+    def test_refresh_if_stale(self, mock_refresh, mock_time, stale=True,
+                              locked=False, refresh_exc=False):
+        self._mirror._last_sync = 100
+        mock_time.return_value = 110 if stale else 105
+        if locked:
+            self._mirror._refresh_lock.acquire()
+        if refresh_exc:
+            mock_refresh.side_effect = Exception
+
+        self._mirror.get_vm_names()
+
+        if stale and not locked:
+            mock_refresh.assert_called_once_with()
+        else:
+            mock_refresh.assert_not_called()
+        self.assertEqual(not locked,
+                         self._mirror._refresh_lock.acquire(False))
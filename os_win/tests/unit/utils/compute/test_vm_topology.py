@@ -0,0 +1,88 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win.tests.unit import test_base
+from os_win.utils.compute import _vm_topology
+
+
+class VMTopologyTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V VM topology snapshots."""
+
+    def setUp(self):
+        super(VMTopologyTestCase, self).setUp()
+
+        self._ctrl = self._get_fake_wmi_obj('ctrl_path', 'ctrl')
+        self._drive = self._get_fake_wmi_obj('drive_path', 'drive',
+                                             parent='CTRL_PATH')
+        self._disk = self._get_fake_wmi_obj('disk_path', 'disk',
+                                            parent='drive_path')
+        self._orphan = self._get_fake_wmi_obj('orphan_path', 'disk',
+                                              parent='missing_path')
+
+        self._topology = _vm_topology.VMTopology(
+            mock.sentinel.vm_name, mock.sentinel.instance_id,
+            [(mock.sentinel.rasd_class, [self._ctrl, self._drive]),
+             (mock.sentinel.sasd_class, [self._disk, self._orphan])])
+
+    def _get_fake_wmi_obj(self, path, res_sub_type, parent=None):
+        return mock.Mock(path_=mock.Mock(return_value=path),
+                         ResourceSubType=res_sub_type,
+                         Parent=parent)
+
+    def test_links(self):
+        ctrl = self._topology.get('CTRL_PATH')
+        drive = self._topology.get('drive_path')
+        disk = self._topology.get('disk_path')
+        orphan = self._topology.get('orphan_path')
+
+        self.assertEqual(self._ctrl, ctrl.wmi_obj)
+        self.assertIsNone(ctrl.parent)
+        self.assertEqual((drive, ), ctrl.children)
+        self.assertEqual(ctrl, drive.parent)
+        self.assertEqual((disk, ), drive.children)
+        self.assertEqual(drive, disk.parent)
+        self.assertEqual((), disk.children)
+        self.assertIsNone(orphan.parent)
+
+        self.assertEqual(mock.sentinel.sasd_class, disk.class_name)
+        self.assertEqual('disk', disk.res_sub_type)
+        self.assertIsNone(self._topology.get('missing_path'))
+
+    def test_get_resources(self):
+        self.assertEqual(4, len(self._topology.resources))
+        self.assertEqual(
+            [self._disk, self._orphan],
+            self._topology.get_wmi_objs(class_name=mock.sentinel.sasd_class))
+        self.assertEqual(
+            [self._ctrl, self._drive],
+            self._topology.get_wmi_objs(res_sub_types=['ctrl', 'drive']))
+        self.assertEqual(
+            (),
+            self._topology.get_resources(
+                class_name=mock.sentinel.rasd_class,
+                res_sub_types=['disk']))
+
+    def test_immutable(self):
+        resource = self._topology.resources[0]
+
+        self.assertRaises(AttributeError, setattr,
+                          self._topology, 'vm_name', mock.sentinel.name)
+        self.assertRaises(AttributeError, setattr,
+                          resource, 'parent', None)
+        self.assertRaises(AttributeError, setattr,
+                          resource, 'fake_attr', None)
+        self.assertEqual(mock.sentinel.vm_name, self._topology.vm_name)
@@ -22,6 +22,7 @@ from os_win import exceptions
 from os_win.tests.unit import test_base
 from os_win.utils import _wqlutils
 from os_win.utils.compute import vmutils
+from os_win.utils import jobutils
 
 
 @ddt.ddt
@@ -75,6 +76,11 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self._vmutils._pathutils = mock.MagicMock()
         self._jobutils = self._vmutils._jobutils
 
+        patcher = mock.patch.dict(vmutils.VMUtils._slot_allocators,
+                                  clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_get_vm_summary_info(self):
         self._lookup_vm()
 
@@ -89,6 +95,72 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         summary = self._vmutils.get_vm_summary_info(self._FAKE_VM_NAME)
         self.assertEqual(self._FAKE_SUMMARY_INFO, summary)
 
+    def test_get_vm_summary_info_exception(self):
+        self._lookup_vm()
+        mock_svc = self._vmutils._vs_man_svc
+        mock_svc.GetSummaryInformation.return_value = (mock.sentinel.ret_val,
+                                                       None)
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._vmutils.get_vm_summary_info,
+                          self._FAKE_VM_NAME)
+
+    def test_get_vms_summary_info(self):
+        mock_vssds = [
+            mock.Mock(ElementName=vm_name,
+                      path_=mock.Mock(return_value=vm_name + '_path'))
+            for vm_name in ['vm0', 'vm1', 'vm2']]
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = (
+            mock_vssds)
+
+        mock_summaries = [mock.Mock(EnabledState=3, UpTime=None),
+                          mock.Mock(EnabledState=2, UpTime='10')]
+        mock_svc = self._vmutils._vs_man_svc
+        mock_svc.GetSummaryInformation.return_value = (self._FAKE_RET_VAL,
+                                                       mock_summaries)
+        fields = [constants.VM_SUMMARY_ENABLED_STATE,
+                  constants.VM_SUMMARY_UPTIME]
+
+        summary = self._vmutils.get_vms_summary_info(
+            vm_names=['vm0', 'vm2', 'missing_vm'], fields=fields)
+
+        expected = {'vm0': {'EnabledState': constants.HYPERV_VM_STATE_DISABLED,
+                            'UpTime': None},
+                    'vm2': {'EnabledState': constants.HYPERV_VM_STATE_ENABLED,
+                            'UpTime': 10}}
+        self.assertEqual(expected, summary)
+        mock_get_vssds = self._vmutils._conn.Msvm_VirtualSystemSettingData
+        mock_get_vssds.assert_called_once_with(
+            ['ElementName'],
+            VirtualSystemType=self._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        mock_svc.GetSummaryInformation.assert_called_once_with(
+            fields, ['vm0_path', 'vm2_path'])
+
+    def test_get_vms_summary_info_duplicate_name(self):
+        mock_vssds = [
+            mock.Mock(ElementName='vm0',
+                      path_=mock.Mock(return_value=vm_path))
+            for vm_path in ['vm0_path', 'other_vm0_path']]
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = (
+            mock_vssds)
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._vmutils.get_vms_summary_info)
+        self.assertFalse(
+            self._vmutils._vs_man_svc.GetSummaryInformation.called)
+
+    def test_get_vms_summary_info_no_vms(self):
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = []
+
+        self.assertEqual({}, self._vmutils.get_vms_summary_info())
+        self.assertFalse(
+            self._vmutils._vs_man_svc.GetSummaryInformation.called)
+
+    def test_get_vms_summary_info_invalid_field(self):
+        self.assertRaises(exceptions.InvalidParameterValue,
+                          self._vmutils.get_vms_summary_info,
+                          fields=[mock.sentinel.invalid_field])
+
     def _lookup_vm(self):
         mock_vm = mock.MagicMock()
         self._vmutils._lookup_vm_check = mock.MagicMock(
@@ -128,6 +200,110 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         vssd = self._vmutils._lookup_vm_check(self._FAKE_VM_NAME)
         self.assertEqual(expected_vssd, vssd)
 
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_event_hub')
+    @mock.patch.object(vmutils._vm_lookup_cache, 'VMLookupCache')
+    def test_enable_vm_lookup_cache(self, mock_cache_cls, mock_get_hub):
+        self._vmutils.enable_vm_lookup_cache()
+        self._vmutils.enable_vm_lookup_cache()
+
+        mock_cache = mock_cache_cls.return_value
+        mock_cache_cls.assert_called_once_with(self._vmutils._conn,
+                                               mock_get_hub.return_value)
+        mock_get_hub.assert_called_once_with(
+            self._vmutils._wmi_namespace % self._vmutils._host)
+        mock_cache.start.assert_called_once_with()
+        self.assertEqual(mock_cache,
+                         self._vmutils._vm_lookup_caches['.'])
+
+        self._vmutils.disable_vm_lookup_cache()
+        mock_cache.stop.assert_called_once_with()
+        self.assertNotIn('.', self._vmutils._vm_lookup_caches)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_obj')
+    def test_lookup_vm_cached(self, mock_get_wmi_obj):
+        mock_cache = self._mock_vm_lookup_cache()
+        mock_get_wmi_obj.return_value.ElementName = self._FAKE_VM_NAME
+
+        vm = self._vmutils._lookup_vm(self._FAKE_VM_NAME, for_update=True)
+
+        self.assertEqual(mock_get_wmi_obj.return_value, vm)
+        mock_cache.get.assert_called_once_with(self._FAKE_VM_NAME)
+        mock_get_wmi_obj.assert_called_once_with(
+            mock_cache.get.return_value.vssd_path, True)
+        self.assertFalse(
+            self._vmutils._conn.Msvm_VirtualSystemSettingData.called)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_obj')
+    def test_lookup_vm_cached_stale(self, mock_get_wmi_obj):
+        mock_cache = self._mock_vm_lookup_cache()
+        mock_get_wmi_obj.side_effect = test_base.FakeWMIExc(
+            hresult=vmutils._utils._WBEM_E_NOT_FOUND)
+        mock_vm = mock.MagicMock()
+        self._vmutils._conn.Msvm_ComputerSystem.return_value = [mock_vm]
+
+        vm = self._vmutils._lookup_vm(self._FAKE_VM_NAME, as_vssd=False)
+
+        self.assertEqual(mock_vm, vm)
+        mock_cache.invalidate.assert_called_once_with(self._FAKE_VM_NAME)
+        mock_cache.update.assert_called_once_with(
+            self._FAKE_VM_NAME, vm_path=mock_vm.path_.return_value,
+            instance_id=mock_cache.get_instance_id.return_value)
+        mock_cache.get_instance_id.assert_called_once_with(mock_vm.Name)
+
+    @ddt.data(True, False)
+    def test_lookup_vm_cached_by_id(self, as_vssd):
+        mock_cache = self._mock_vm_lookup_cache()
+        mock_cache.get.return_value = vmutils._vm_lookup_cache.VMLookupEntry(
+            None, None, mock.sentinel.instance_id)
+        mock_vm = mock.MagicMock(
+            ElementName=self._FAKE_VM_NAME,
+            VirtualSystemType=self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        conn = self._vmutils._conn
+        conn.Msvm_VirtualSystemSettingData.return_value = [mock_vm]
+        conn.Msvm_ComputerSystem.return_value = [mock_vm]
+
+        vm = self._vmutils._lookup_vm(self._FAKE_VM_NAME, as_vssd=as_vssd)
+
+        self.assertEqual(mock_vm, vm)
+        if as_vssd:
+            conn.Msvm_VirtualSystemSettingData.assert_called_once_with(
+                InstanceID=mock.sentinel.instance_id)
+            mock_cache.update.assert_called_once_with(
+                self._FAKE_VM_NAME, vssd_path=mock_vm.path_.return_value,
+                instance_id=mock_vm.InstanceID)
+        else:
+            mock_cache.get_vm_id.assert_called_once_with(
+                mock.sentinel.instance_id)
+            conn.Msvm_ComputerSystem.assert_called_once_with(
+                Name=mock_cache.get_vm_id.return_value)
+            mock_cache.update.assert_called_once_with(
+                self._FAKE_VM_NAME, vm_path=mock_vm.path_.return_value,
+                instance_id=mock_cache.get_instance_id.return_value)
+        self.assertFalse(mock_cache.invalidate.called)
+
+    def test_lookup_vm_cache_miss(self):
+        mock_cache = self._mock_vm_lookup_cache()
+        mock_cache.get.return_value = None
+        mock_vssd = mock.MagicMock(
+            VirtualSystemType=self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = [
+            mock_vssd]
+
+        vssd = self._vmutils._lookup_vm(self._FAKE_VM_NAME)
+
+        self.assertEqual(mock_vssd, vssd)
+        mock_cache.update.assert_called_once_with(
+            self._FAKE_VM_NAME, vssd_path=mock_vssd.path_.return_value,
+            instance_id=mock_vssd.InstanceID)
+
+    def _mock_vm_lookup_cache(self):
+        mock_cache = mock.Mock()
+        patcher = mock.patch.dict(vmutils.VMUtils._vm_lookup_caches,
+                                  {'.': mock_cache})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock_cache
+
     @mock.patch.object(vmutils.VMUtils, '_lookup_vm')
     def test_vm_exists(self, mock_lookup_vm):
         result = self._vmutils.vm_exists(mock.sentinel.vm_name)
@@ -135,6 +311,83 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self.assertTrue(result)
         mock_lookup_vm.assert_called_once_with(mock.sentinel.vm_name, False)
 
+    @mock.patch.dict(vmutils.VMUtils._vm_state_mirrors, clear=True)
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_event_hub')
+    @mock.patch.object(vmutils._vm_state_mirror, 'VMStateMirror')
+    def test_enable_vm_state_mirror(self, mock_mirror_cls, mock_get_hub):
+        self._vmutils.enable_vm_state_mirror(
+            resync_interval=mock.sentinel.interval)
+        self._vmutils.enable_vm_state_mirror()
+
+        mock_mirror = mock_mirror_cls.return_value
+        mock_mirror_cls.assert_called_once_with(
+            self._vmutils._conn, mock_get_hub.return_value,
+            resync_interval=mock.sentinel.interval)
+        mock_get_hub.assert_called_once_with(
+            self._vmutils._wmi_namespace % self._vmutils._host)
+        mock_mirror.start.assert_called_once_with()
+        self.assertEqual(mock_mirror,
+                         self._vmutils._vm_state_mirrors['.'])
+
+        self._vmutils.disable_vm_state_mirror()
+        mock_mirror.stop.assert_called_once_with()
+        self.assertNotIn('.', self._vmutils._vm_state_mirrors)
+
+    def _mock_vm_state_mirror(self):
+        mock_mirror = mock.Mock()
+        patcher = mock.patch.dict(vmutils.VMUtils._vm_state_mirrors,
+                                  {'.': mock_mirror})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock_mirror
+
+    @mock.patch.object(vmutils.VMUtils, '_lookup_vm')
+    def test_vm_exists_mirrored(self, mock_lookup_vm):
+        mock_mirror = self._mock_vm_state_mirror()
+        mock_mirror.exists.return_value = True
+
+        result = self._vmutils.vm_exists(mock.sentinel.vm_name)
+
+        self.assertTrue(result)
+        mock_mirror.exists.assert_called_once_with(mock.sentinel.vm_name)
+        mock_lookup_vm.assert_not_called()
+
+    @mock.patch.object(vmutils.VMUtils, '_lookup_vm')
+    def test_vm_exists_not_mirrored(self, mock_lookup_vm):
+        mock_mirror = self._mock_vm_state_mirror()
+        mock_mirror.exists.return_value = False
+
+        result = self._vmutils.vm_exists(mock.sentinel.vm_name)
+
+        self.assertTrue(result)
+        mock_mirror.exists.assert_called_once_with(mock.sentinel.vm_name)
+        mock_lookup_vm.assert_called_once_with(mock.sentinel.vm_name, False)
+
+    @mock.patch.object(vmutils.VMUtils, 'get_vm_summary_info')
+    def test_get_vm_state_mirrored(self, mock_get_summary_info):
+        mock_mirror = self._mock_vm_state_mirror()
+        mock_mirror.get_state.return_value = (
+            self._vmutils._vm_power_states_map[
+                constants.HYPERV_VM_STATE_DISABLED])
+
+        state = self._vmutils.get_vm_state(mock.sentinel.vm_name)
+
+        self.assertEqual(constants.HYPERV_VM_STATE_DISABLED, state)
+        mock_mirror.get_state.assert_called_once_with(mock.sentinel.vm_name)
+        mock_get_summary_info.assert_not_called()
+
+    @mock.patch.object(vmutils.VMUtils, 'get_vm_summary_info')
+    def test_get_vm_state_not_mirrored(self, mock_get_summary_info):
+        mock_mirror = self._mock_vm_state_mirror()
+        mock_mirror.get_state.return_value = None
+        mock_get_summary_info.return_value = {
+            'EnabledState': mock.sentinel.state}
+
+        state = self._vmutils.get_vm_state(mock.sentinel.vm_name)
+
+        self.assertEqual(mock.sentinel.state, state)
+        mock_get_summary_info.assert_called_once_with(mock.sentinel.vm_name)
+
     def test_set_vm_memory_static(self):
         self._test_set_vm_memory_dynamic(dynamic_memory_ratio=1.0)
 
@@ -273,6 +526,85 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self.assertEqual([mock_rasds[0]], disks)
         self.assertEqual([mock_rasds[1]], volumes)
 
+    @mock.patch.object(vmutils._vm_topology, 'VMTopology')
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    def test_get_vm_topology(self, mock_get_element_associated_class,
+                             mock_topology_cls):
+        mock_vmsettings = self._lookup_vm()
+        mock_get_element_associated_class.side_effect = [
+            mock.sentinel.rasds, mock.sentinel.sasds]
+
+        topology = self._vmutils.get_vm_topology(self._FAKE_VM_NAME)
+
+        self.assertEqual(mock_topology_cls.return_value, topology)
+        mock_get_element_associated_class.assert_has_calls(
+            [mock.call(self._vmutils._compat_conn,
+                       class_name,
+                       element_instance_id=mock_vmsettings.InstanceID)
+             for class_name in (
+                self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS)])
+        mock_topology_cls.assert_called_once_with(
+            self._FAKE_VM_NAME, mock_vmsettings.InstanceID,
+            [(self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+              mock.sentinel.rasds),
+             (self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS,
+              mock.sentinel.sasds)])
+
+    def _get_fake_topology(self):
+        def _get_res(path, res_sub_type, **kwargs):
+            return mock.Mock(path_=mock.Mock(return_value=path),
+                             ResourceSubType=res_sub_type,
+                             **kwargs)
+
+        rasds = [
+            _get_res('scsi_ctrl', self._vmutils._SCSI_CTRL_RES_SUB_TYPE,
+                     Parent=None),
+            _get_res('ide_ctrl', self._vmutils._IDE_CTRL_RES_SUB_TYPE,
+                     Parent=None, Address='1'),
+            _get_res('drive', self._vmutils._DVD_DRIVE_RES_SUB_TYPE,
+                     Parent='ide_ctrl'),
+            _get_res('phys_disk', self._vmutils._PHYS_DISK_RES_SUB_TYPE,
+                     Parent='scsi_ctrl'),
+            _get_res('serial_port', self._vmutils._SERIAL_PORT_RES_SUB_TYPE,
+                     Parent=None, Connection=[mock.sentinel.pipe_path])]
+        sasds = [
+            _get_res('iso', self._vmutils._DVD_DISK_RES_SUB_TYPE,
+                     Parent='drive', HostResource=[mock.sentinel.iso_path])]
+        return vmutils._vm_topology.VMTopology(
+            self._FAKE_VM_NAME, mock.sentinel.instance_id,
+            [(self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS, rasds),
+             (self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS, sasds)])
+
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    def test_getters_using_topology(self, mock_get_element_associated_class):
+        topology = self._get_fake_topology()
+        self._vmutils._lookup_vm_check = mock.Mock()
+
+        self.assertEqual(
+            'scsi_ctrl',
+            self._vmutils.get_vm_scsi_controller(self._FAKE_VM_NAME,
+                                                 topology=topology))
+        self.assertEqual(
+            'ide_ctrl',
+            self._vmutils.get_vm_ide_controller(self._FAKE_VM_NAME, 1,
+                                                topology=topology))
+        disks, volumes = self._vmutils.get_vm_disks(self._FAKE_VM_NAME,
+                                                    topology=topology)
+        self.assertEqual(['iso'], [disk.path_() for disk in disks])
+        self.assertEqual(['phys_disk'], [vol.path_() for vol in volumes])
+        self.assertEqual(
+            [mock.sentinel.iso_path],
+            self._vmutils.get_vm_dvd_disk_paths(self._FAKE_VM_NAME,
+                                                topology=topology))
+        self.assertEqual(
+            [mock.sentinel.pipe_path],
+            self._vmutils.get_vm_serial_port_connections(
+                self._FAKE_VM_NAME, topology=topology))
+
+        self.assertFalse(self._vmutils._lookup_vm_check.called)
+        self.assertFalse(mock_get_element_associated_class.called)
+
     def _create_mock_disks(self):
         mock_rasd1 = mock.MagicMock()
         mock_rasd1.ResourceSubType = self._vmutils._HARD_DISK_RES_SUB_TYPE
@@ -416,25 +748,71 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         response = self._vmutils.get_free_controller_slot(
             self._FAKE_CTRL_PATH)
+        # The returned slots are reserved.
+        next_response = self._vmutils.get_free_controller_slot(
+            self._FAKE_CTRL_PATH)
 
         mock_get_attached_disks.assert_called_once_with(
             self._FAKE_CTRL_PATH)
 
-        self.assertEqual(response, 0)
+        self.assertEqual(0, response)
+        self.assertEqual(1, next_response)
+
+    @mock.patch('time.time')
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_get_free_controller_slot_stale(self, mock_get_attached_disks,
+                                            mock_time):
+        mock_time.return_value = 0
+        mock_get_attached_disks.side_effect = [
+            [], [mock.Mock(AddressOnParent='1')]]
+
+        self.assertEqual(
+            0, self._vmutils.get_free_controller_slot(self._FAKE_CTRL_PATH))
+
+        # The used slots are reloaded periodically, in case other consumers
+        # have attached drives meanwhile.
+        mock_time.return_value = self._vmutils._SLOT_ALLOCATOR_SYNC_INTERVAL
+        self.assertEqual(
+            2, self._vmutils.get_free_controller_slot(self._FAKE_CTRL_PATH))
+        self.assertEqual(2, mock_get_attached_disks.call_count)
+
+    def test_release_controller_slot(self):
+        mock_allocator = mock.Mock()
+        self._vmutils._slot_allocators[
+            ('.', self._FAKE_CTRL_PATH.upper())] = mock_allocator
+
+        self._vmutils._release_controller_slot(self._FAKE_CTRL_PATH, '1')
+        self._vmutils._release_controller_slot('other_ctrl_path', '1')
+
+        mock_allocator.release.assert_called_once_with(1)
 
     def test_get_free_controller_slot_exception(self):
-        fake_drive = mock.MagicMock()
-        type(fake_drive).AddressOnParent = mock.PropertyMock(
-            side_effect=list(range(constants.SCSI_CONTROLLER_SLOTS_NUMBER)))
+        fake_drives = [
+            mock.Mock(AddressOnParent=slot)
+            for slot in range(constants.SCSI_CONTROLLER_SLOTS_NUMBER)]
 
         with mock.patch.object(
                 self._vmutils,
                 'get_attached_disks') as fake_get_attached_disks:
-            fake_get_attached_disks.return_value = (
-                [fake_drive] * constants.SCSI_CONTROLLER_SLOTS_NUMBER)
+            fake_get_attached_disks.return_value = fake_drives
             self.assertRaises(exceptions.HyperVException,
                               self._vmutils.get_free_controller_slot,
-                              mock.sentinel.scsi_controller_path)
+                              self._FAKE_CTRL_PATH)
+
+        # The used slots are reloaded once the controller seems full.
+        self.assertEqual(2, fake_get_attached_disks.call_count)
+
+    def test_drop_vm_slot_allocators(self):
+        vm_ctrl_key = ('.', 'MSVM_RASD.INSTANCEID="MICROSOFT:VM_ID\\CTRL"')
+        other_keys = [('.', 'MSVM_RASD.INSTANCEID="MICROSOFT:OTHER_VM_ID"'),
+                      ('other_host', vm_ctrl_key[1])]
+        for key in [vm_ctrl_key] + other_keys:
+            self._vmutils._slot_allocators[key] = mock.sentinel.allocator
+
+        self._vmutils._drop_vm_slot_allocators('vm_id')
+
+        self.assertEqual(sorted(other_keys),
+                         sorted(self._vmutils._slot_allocators))
 
     @mock.patch.object(_wqlutils, 'get_element_associated_class')
     def test_get_vm_ide_controller(self, mock_get_element_associated_class):
@@ -502,10 +880,10 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     @mock.patch.object(vmutils.VMUtils, 'get_free_controller_slot')
     @mock.patch.object(vmutils.VMUtils, '_get_vm_scsi_controller')
     def test_attach_scsi_drive(self, mock_get_vm_scsi_controller,
-                               mock_get_free_controller_slot):
+                               mock_get_free_slot):
         mock_vm = self._lookup_vm()
         mock_get_vm_scsi_controller.return_value = self._FAKE_CTRL_PATH
-        mock_get_free_controller_slot.return_value = self._FAKE_DRIVE_ADDR
+        mock_get_free_slot.return_value = self._FAKE_DRIVE_ADDR
 
         with mock.patch.object(self._vmutils,
                                'attach_drive') as mock_attach_drive:
@@ -513,7 +891,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
                                             constants.DISK)
 
             mock_get_vm_scsi_controller.assert_called_once_with(mock_vm)
-            mock_get_free_controller_slot.assert_called_once_with(
+            mock_get_free_slot.assert_called_once_with(
                 self._FAKE_CTRL_PATH)
             mock_attach_drive.assert_called_once_with(
                 mock_vm, self._FAKE_PATH, self._FAKE_CTRL_PATH,
@@ -540,6 +918,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
     def test_attach_drive(self, drive_type, mock_get_new_rsd):
         mock_vm = self._lookup_vm()
+        mock_allocator = self._add_mock_slot_allocator()
 
         mock_drive_res = mock.Mock()
         mock_disk_res = mock.Mock()
@@ -551,8 +930,8 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self._vmutils.attach_drive(mock.sentinel.vm_name,
                                    mock.sentinel.disk_path,
-                                   mock.sentinel.ctrl_path,
-                                   mock.sentinel.drive_addr,
+                                   self._FAKE_CTRL_PATH,
+                                   self._FAKE_DRIVE_ADDR,
                                    drive_type)
 
         self._vmutils._lookup_vm_check.assert_called_once_with(
@@ -570,9 +949,9 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
              mock.call(exp_res_sub_types[1],
                        self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS)])
 
-        self.assertEqual(mock.sentinel.ctrl_path, mock_drive_res.Parent)
-        self.assertEqual(mock.sentinel.drive_addr, mock_drive_res.Address)
-        self.assertEqual(mock.sentinel.drive_addr,
+        self.assertEqual(self._FAKE_CTRL_PATH, mock_drive_res.Parent)
+        self.assertEqual(self._FAKE_DRIVE_ADDR, mock_drive_res.Address)
+        self.assertEqual(self._FAKE_DRIVE_ADDR,
                          mock_drive_res.AddressOnParent)
 
         self.assertEqual(mock.sentinel.drive_res_path,
@@ -583,11 +962,58 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self._jobutils.add_virt_resource.assert_has_calls(
             [mock.call(mock_drive_res, mock_vm),
              mock.call(mock_disk_res, mock_vm)])
+        mock_allocator.commit.assert_called_once_with(self._FAKE_DRIVE_ADDR)
+
+    def _add_mock_slot_allocator(self):
+        mock_allocator = mock.Mock()
+        self._vmutils._slot_allocators[
+            ('.', self._FAKE_CTRL_PATH.upper())] = mock_allocator
+        return mock_allocator
+
+    @mock.patch.object(vmutils.VMUtils, '_get_slot_allocator')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    def test_attach_drive_add_drive_exc(self, mock_get_new_rsd,
+                                        mock_get_slot_allocator):
+        self._lookup_vm()
+        mock_allocator = self._add_mock_slot_allocator()
+        self._jobutils.add_virt_resource.side_effect = (
+            exceptions.OSWinException)
+
+        self.assertRaises(exceptions.OSWinException,
+                          self._vmutils.attach_drive,
+                          mock.sentinel.vm_name,
+                          mock.sentinel.disk_path,
+                          self._FAKE_CTRL_PATH,
+                          self._FAKE_DRIVE_ADDR)
+
+        # The slot may have been used by other consumers.
+        mock_allocator.release.assert_called_once_with(self._FAKE_DRIVE_ADDR)
+        mock_get_slot_allocator.assert_called_once_with(
+            self._FAKE_CTRL_PATH, sync=True)
+        self.assertFalse(mock_allocator.commit.called)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_slot_allocator')
+    def test_attach_drive_vm_not_found(self, mock_get_slot_allocator):
+        mock_allocator = self._add_mock_slot_allocator()
+        self._vmutils._lookup_vm_check = mock.Mock(
+            side_effect=exceptions.HyperVVMNotFoundException(
+                vm_name=mock.sentinel.vm_name))
+
+        self.assertRaises(exceptions.HyperVVMNotFoundException,
+                          self._vmutils.attach_drive,
+                          mock.sentinel.vm_name,
+                          mock.sentinel.disk_path,
+                          self._FAKE_CTRL_PATH,
+                          self._FAKE_DRIVE_ADDR)
+
+        mock_allocator.release.assert_called_once_with(self._FAKE_DRIVE_ADDR)
+        self.assertFalse(self._jobutils.add_virt_resource.called)
 
     @mock.patch.object(vmutils.VMUtils, '_get_wmi_obj')
     @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
     def test_attach_drive_exc(self, mock_get_new_rsd, mock_get_wmi_obj):
         self._lookup_vm()
+        mock_allocator = self._add_mock_slot_allocator()
 
         mock_drive_res = mock.Mock()
         mock_disk_res = mock.Mock()
@@ -602,13 +1028,15 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
                           self._vmutils.attach_drive,
                           mock.sentinel.vm_name,
                           mock.sentinel.disk_path,
-                          mock.sentinel.ctrl_path,
-                          mock.sentinel.drive_addr,
+                          self._FAKE_CTRL_PATH,
+                          self._FAKE_DRIVE_ADDR,
                           constants.DISK)
 
         mock_get_wmi_obj.assert_called_once_with(mock.sentinel.drive_res_path)
         self._jobutils.remove_virt_resource.assert_called_once_with(
             mock.sentinel.attached_drive_res)
+        mock_allocator.release.assert_called_once_with(self._FAKE_DRIVE_ADDR)
+        self.assertFalse(mock_allocator.commit.called)
 
     @mock.patch.object(vmutils.VMUtils,
                        '_get_mounted_disk_resource_from_path')
@@ -689,6 +1117,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     def _test_attach_volume_to_controller(self, mock_get_wmi_obj,
                                           mock_get_new_rsd, disk_serial=None):
         mock_vm = self._lookup_vm()
+        mock_allocator = self._add_mock_slot_allocator()
         mock_diskdrive = mock.MagicMock()
         jobutils = self._vmutils._jobutils
         jobutils.add_virt_resource.return_value = [mock_diskdrive]
@@ -700,6 +1129,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self._vmutils._jobutils.add_virt_resource.assert_called_once_with(
             mock_get_new_rsd.return_value, mock_vm)
+        mock_allocator.commit.assert_called_once_with(self._FAKE_CTRL_ADDR)
 
         if disk_serial:
             jobutils.modify_virt_resource.assert_called_once_with(
@@ -713,14 +1143,197 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self._test_attach_volume_to_controller(
             disk_serial=mock.sentinel.serial)
 
+    @mock.patch.object(vmutils.VMUtils, '_get_slot_allocator')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    def test_attach_volume_to_controller_exc(self, mock_get_new_rsd,
+                                             mock_get_slot_allocator):
+        self._lookup_vm()
+        mock_allocator = self._add_mock_slot_allocator()
+        self._jobutils.add_virt_resource.side_effect = (
+            exceptions.OSWinException)
+
+        self.assertRaises(exceptions.OSWinException,
+                          self._vmutils.attach_volume_to_controller,
+                          self._FAKE_VM_NAME, self._FAKE_CTRL_PATH,
+                          self._FAKE_CTRL_ADDR, self._FAKE_MOUNTED_DISK_PATH)
+
+        mock_allocator.release.assert_called_once_with(self._FAKE_CTRL_ADDR)
+        mock_get_slot_allocator.assert_called_once_with(
+            self._FAKE_CTRL_PATH, sync=True)
+
+    def _get_mock_rasd(self, res_sub_type, path=None, parent=None,
+                       address=None, ctrl_address=None):
+        return mock.Mock(ResourceSubType=res_sub_type,
+                         Parent=parent,
+                         Address=ctrl_address,
+                         AddressOnParent=address,
+                         path_=mock.Mock(return_value=path))
+
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_obj')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    def test_attach_volumes(self, mock_get_element_associated_class,
+                            mock_get_new_rsd, mock_get_wmi_obj,
+                            mock_get_attached_disks):
+        mock_vmsettings = self._lookup_vm()
+        mock_get_attached_disks.return_value = [
+            mock.Mock(AddressOnParent='0'), mock.Mock(AddressOnParent='1')]
+        mock_get_element_associated_class.return_value = [
+            self._get_mock_rasd(self._vmutils._SCSI_CTRL_RES_SUB_TYPE,
+                                path='scsi_ctrl'),
+            self._get_mock_rasd(self._vmutils._IDE_CTRL_RES_SUB_TYPE,
+                                path='ide_ctrl'),
+            self._get_mock_rasd(self._vmutils._PHYS_DISK_RES_SUB_TYPE,
+                                parent='SCSI_CTRL', address='0'),
+            self._get_mock_rasd(self._vmutils._DISK_DRIVE_RES_SUB_TYPE,
+                                parent='ide_ctrl', address='0'),
+            self._get_mock_rasd(self._vmutils._DVD_DRIVE_RES_SUB_TYPE,
+                                parent='ide_ctrl', address='1')]
+        mock_get_new_rsd.side_effect = (
+            lambda res_sub_type, class_name=None: mock.Mock(
+                ResourceSubType=res_sub_type))
+
+        self._jobutils.virt_resource_batch.side_effect = (
+            lambda parent: jobutils.VirtResourceBatch(self._jobutils,
+                                                      parent))
+        mock_add_resources = self._jobutils.add_multiple_virt_resources
+        mock_add_resources.side_effect = [
+            [mock.sentinel.volume_path, mock.sentinel.drive_path],
+            exceptions.HyperVException]
+
+        volumes = [
+            (mock.sentinel.mounted_disk_path, constants.VOLUME, None),
+            (mock.sentinel.vhd_path, constants.DISK, None),
+            (mock.sentinel.iso_path, constants.DVD, 'ide_ctrl'),
+            (mock.sentinel.iso_path, constants.DVD, 'missing_ctrl'),
+            (mock.sentinel.vhd_path, mock.sentinel.drive_type, None)]
+        results = self._vmutils.attach_volumes(self._FAKE_VM_NAME, volumes)
+
+        self.assertEqual(mock.sentinel.volume_path, results[0])
+        self.assertIsInstance(results[1], exceptions.HyperVException)
+        self.assertIsInstance(results[2], exceptions.HyperVException)
+        self.assertIsInstance(results[3], exceptions.HyperVException)
+        self.assertIsInstance(results[4],
+                              exceptions.InvalidParameterValue)
+
+        mock_get_element_associated_class.assert_called_once_with(
+            self._vmutils._conn,
+            self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+            element_instance_id=mock_vmsettings.InstanceID)
+
+        self.assertEqual(2, mock_add_resources.call_count)
+        (volume, drive), parent = mock_add_resources.call_args_list[0][0]
+        self.assertEqual(mock_vmsettings, parent)
+        self.assertEqual(1, volume.AddressOnParent)
+        self.assertEqual('scsi_ctrl', volume.Parent)
+        self.assertEqual([mock.sentinel.mounted_disk_path],
+                         volume.HostResource)
+        self.assertEqual(2, drive.AddressOnParent)
+        self.assertEqual('scsi_ctrl', drive.Parent)
+
+        (vhd, ), parent = mock_add_resources.call_args_list[1][0]
+        self.assertEqual(mock.sentinel.drive_path, vhd.Parent)
+        self.assertEqual([mock.sentinel.vhd_path], vhd.HostResource)
+
+        # The drive of the failed disk attachment is removed, its slot
+        # being released.
+        mock_get_wmi_obj.assert_called_once_with(mock.sentinel.drive_path)
+        self._jobutils.remove_virt_resource.assert_called_once_with(
+            mock_get_wmi_obj.return_value)
+
+        scsi_allocator = self._vmutils._slot_allocators[('.', 'SCSI_CTRL')]
+        self.assertEqual([True, True, False, False],
+                         [scsi_allocator.is_used(slot) for slot in range(4)])
+        # The allocators are refreshed using the retrieved resources, the
+        # full IDE controller not being reloaded.
+        self.assertFalse(mock_get_attached_disks.called)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    def test_attach_volumes_reserved_slots(
+            self, mock_get_element_associated_class, mock_get_new_rsd):
+        self._lookup_vm()
+        mock_get_element_associated_class.return_value = [
+            self._get_mock_rasd(self._vmutils._SCSI_CTRL_RES_SUB_TYPE,
+                                path='scsi_ctrl'),
+            # A drive attached by another consumer, unknown to the
+            # existing allocator.
+            self._get_mock_rasd(self._vmutils._PHYS_DISK_RES_SUB_TYPE,
+                                parent='scsi_ctrl', address='1')]
+        mock_get_new_rsd.side_effect = (
+            lambda res_sub_type, class_name=None: mock.Mock())
+        mock_batch = self._jobutils.virt_resource_batch.return_value
+        # A slot reserved by a pending attach operation.
+        allocator = self._vmutils._get_slot_allocator('scsi_ctrl',
+                                                      used_slots=[])
+        allocator.reserve()
+
+        self._vmutils.attach_volumes(
+            self._FAKE_VM_NAME,
+            [(mock.sentinel.mounted_disk_path, constants.VOLUME, None)])
+
+        volume = mock_batch.add.call_args[0][0]
+        self.assertEqual(2, volume.AddressOnParent)
+        self.assertEqual([True, True, True],
+                         [allocator.is_used(slot) for slot in range(3)])
+
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    def test_attach_volumes_by_controller_type(
+            self, mock_get_element_associated_class, mock_get_new_rsd,
+            mock_get_attached_disks):
+        self._lookup_vm()
+        mock_get_element_associated_class.return_value = [
+            self._get_mock_rasd(self._vmutils._IDE_CTRL_RES_SUB_TYPE,
+                                path='ide_ctrl_1', ctrl_address='1'),
+            self._get_mock_rasd(self._vmutils._IDE_CTRL_RES_SUB_TYPE,
+                                path='ide_ctrl_0', ctrl_address='0'),
+            self._get_mock_rasd(self._vmutils._DISK_DRIVE_RES_SUB_TYPE,
+                                parent='ide_ctrl_0', address='0')]
+        mock_get_new_rsd.side_effect = (
+            lambda res_sub_type, class_name=None: mock.Mock())
+        mock_batch = self._jobutils.virt_resource_batch.return_value
+        mock_get_attached_disks.side_effect = [
+            [mock.Mock(AddressOnParent='0')], []]
+
+        volumes = [(mock.sentinel.vhd_path, constants.DISK,
+                    constants.CTRL_TYPE_IDE)] * 4
+        results = self._vmutils.attach_volumes(self._FAKE_VM_NAME, volumes)
+
+        # Only the free IDE slots can be used.
+        drives = [call_args[0][0]
+                  for call_args in mock_batch.add.call_args_list[::2]]
+        self.assertEqual([('ide_ctrl_0', 1), ('ide_ctrl_1', 0),
+                          ('ide_ctrl_1', 1)],
+                         [(drive.Parent, drive.AddressOnParent)
+                          for drive in drives])
+        self.assertIsInstance(results[3], exceptions.HyperVException)
+
     @mock.patch.object(vmutils.VMUtils, '_get_new_setting_data')
-    def test_create_nic(self, mock_get_new_virt_res):
+    def test_get_new_nic_data(self, mock_get_new_virt_res):
+        nic = self._vmutils._get_new_nic_data(self._FAKE_RES_NAME,
+                                              '00:11:22:33:44:55')
+
+        self.assertEqual(mock_get_new_virt_res.return_value, nic)
+        mock_get_new_virt_res.assert_called_once_with(
+            self._vmutils._SYNTHETIC_ETHERNET_PORT_SETTING_DATA_CLASS)
+        self.assertEqual(self._FAKE_RES_NAME, nic.ElementName)
+        self.assertEqual('001122334455', nic.Address)
+        self.assertEqual('True', nic.StaticMacAddress)
+        self.assertEqual(1, len(nic.VirtualSystemIdentifiers))
+
+    @mock.patch.object(vmutils.VMUtils, '_get_new_nic_data')
+    def test_create_nic(self, mock_get_new_nic_data):
         mock_vm = self._lookup_vm()
-        mock_nic = mock_get_new_virt_res.return_value
+        mock_nic = mock_get_new_nic_data.return_value
 
         self._vmutils.create_nic(
             self._FAKE_VM_NAME, self._FAKE_RES_NAME, self._FAKE_ADDRESS)
 
+        mock_get_new_nic_data.assert_called_once_with(
+            self._FAKE_RES_NAME, self._FAKE_ADDRESS)
         self._vmutils._jobutils.add_virt_resource.assert_called_once_with(
             mock_nic, mock_vm)
 
@@ -765,8 +1378,9 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_vm.RequestStateChange.assert_called_with(
             constants.HYPERV_VM_STATE_ENABLED)
 
-    def test_destroy_vm(self):
-        self._lookup_vm()
+    @mock.patch.object(vmutils.VMUtils, '_drop_vm_slot_allocators')
+    def test_destroy_vm(self, mock_drop_slot_allocators):
+        mock_vm = self._lookup_vm()
 
         mock_svc = self._vmutils._vs_man_svc
         getattr(mock_svc, self._DESTROY_SYSTEM).return_value = (
@@ -776,6 +1390,26 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         getattr(mock_svc, self._DESTROY_SYSTEM).assert_called_with(
             self._FAKE_VM_PATH)
+        mock_drop_slot_allocators.assert_called_once_with(mock_vm.Name)
+
+    @mock.patch.object(vmutils.VMUtils, '_drop_vm_slot_allocators')
+    def test_destroy_vm_async(self, mock_drop_slot_allocators):
+        mock_vm = self._lookup_vm()
+
+        mock_svc = self._vmutils._vs_man_svc
+        mock_svc.DestroySystem.return_value = (
+            self._FAKE_JOB_PATH, self._FAKE_RET_VAL)
+
+        future = self._vmutils.destroy_vm_async(
+            self._FAKE_VM_NAME, progress_callback=mock.sentinel.callback)
+
+        self.assertEqual(self._jobutils.check_ret_val_async.return_value,
+                         future)
+        mock_svc.DestroySystem.assert_called_once_with(self._FAKE_VM_PATH)
+        self._jobutils.check_ret_val_async.assert_called_once_with(
+            self._FAKE_RET_VAL, self._FAKE_JOB_PATH,
+            progress_callback=mock.sentinel.callback)
+        mock_drop_slot_allocators.assert_called_once_with(mock_vm.Name)
 
     @mock.patch.object(vmutils.VMUtils, 'get_vm_disks')
     def test_get_vm_physical_disk_mapping(self, mock_get_vm_disks):
@@ -793,7 +1427,8 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         result = self._vmutils.get_vm_physical_disk_mapping(self._FAKE_VM_NAME)
         self.assertEqual(expected_mapping, result)
-        mock_get_vm_disks.assert_called_once_with(self._FAKE_VM_NAME)
+        mock_get_vm_disks.assert_called_once_with(self._FAKE_VM_NAME,
+                                                  topology=None)
 
     @mock.patch.object(vmutils.VMUtils, '_get_wmi_obj')
     def test_set_disk_host_res(self, mock_get_wmi_obj):
@@ -891,6 +1526,46 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
             wmi_result_class=(
                 self._vmutils._VIRTUAL_SYSTEM_SETTING_DATA_CLASS))
 
+    @mock.patch.object(vmutils.VMUtils, '_get_snapshot_path_from_job')
+    def test_take_vm_snapshot_async(self, mock_get_snapshot_path):
+        self._lookup_vm()
+        mock_svc = self._get_snapshot_service()
+        mock_svc.CreateSnapshot.return_value = (self._FAKE_JOB_PATH,
+                                                mock.MagicMock(),
+                                                self._FAKE_RET_VAL)
+
+        future = self._vmutils.take_vm_snapshot_async(
+            self._FAKE_VM_NAME, mock.sentinel.snap_name)
+
+        self.assertEqual(self._jobutils.check_ret_val_async.return_value,
+                         future)
+        mock_svc.CreateSnapshot.assert_called_once_with(
+            AffectedSystem=self._FAKE_VM_PATH,
+            SnapshotType=self._vmutils._SNAPSHOT_FULL)
+
+        call_kwargs = self._jobutils.check_ret_val_async.call_args[1]
+        self.assertIsNone(call_kwargs['progress_callback'])
+        result_func = call_kwargs['result_func']
+        self.assertEqual(mock_get_snapshot_path.return_value,
+                         result_func(mock.sentinel.job))
+        mock_get_snapshot_path.assert_called_once_with(
+            mock.sentinel.job, snapshot_name=mock.sentinel.snap_name)
+
+    def test_remove_vm_snapshot_async(self):
+        mock_svc = self._get_snapshot_service()
+        mock_svc.DestroySnapshot.return_value = (
+            self._FAKE_JOB_PATH, self._FAKE_RET_VAL)
+
+        future = self._vmutils.remove_vm_snapshot_async(
+            self._FAKE_SNAPSHOT_PATH)
+
+        self.assertEqual(self._jobutils.check_ret_val_async.return_value,
+                         future)
+        mock_svc.DestroySnapshot.assert_called_once_with(
+            self._FAKE_SNAPSHOT_PATH)
+        self._jobutils.check_ret_val_async.assert_called_once_with(
+            self._FAKE_RET_VAL, self._FAKE_JOB_PATH, progress_callback=None)
+
     def test_remove_vm_snapshot(self):
         mock_svc = self._get_snapshot_service()
         getattr(mock_svc, self._DESTROY_SNAPSHOT).return_value = (
@@ -923,7 +1598,8 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_get_mounted_disk_from_path.assert_called_once_with(
             mock.sentinel.disk_path, is_physical)
 
-    def test_detach_vm_disk(self):
+    @mock.patch.object(vmutils.VMUtils, '_release_controller_slot')
+    def test_detach_vm_disk(self, mock_release_slot):
         mock_disk = self._prepare_mock_disk()
 
         self._vmutils.detach_vm_disk(self._FAKE_VM_NAME,
@@ -931,6 +1607,8 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
                                      serial=mock.sentinel.serial)
         self._vmutils._jobutils.remove_virt_resource.assert_called_once_with(
             mock_disk)
+        mock_release_slot.assert_called_once_with(mock_disk.Parent,
+                                                  mock_disk.AddressOnParent)
 
     @ddt.data(None, mock.sentinel.serial)
     def test_get_mounted_disk_resource_from_path(self, serial):
@@ -948,6 +1626,97 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self.assertEqual(mock_disk, physical_disk)
 
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_event_hub')
+    @mock.patch.object(vmutils._disk_resource_index, 'DiskResourceIndex')
+    def test_enable_disk_resource_index(self, mock_index_cls, mock_get_hub):
+        self._vmutils.enable_disk_resource_index(track_events=False)
+        self._vmutils.enable_disk_resource_index()
+
+        mock_index = mock_index_cls.return_value
+        mock_index_cls.assert_called_once_with(
+            self._vmutils._compat_conn,
+            {self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS: [
+                self._vmutils._PHYS_DISK_RES_SUB_TYPE],
+             self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS: [
+                self._vmutils._HARD_DISK_RES_SUB_TYPE,
+                self._vmutils._DVD_DISK_RES_SUB_TYPE]},
+            event_hub=mock_get_hub.return_value)
+        mock_index.start.assert_called_once_with(track_events=False)
+
+        self._vmutils.refresh_disk_resource_index()
+        mock_index.refresh.assert_called_once_with()
+
+        self._vmutils.disable_disk_resource_index()
+        mock_index.stop.assert_called_once_with()
+        self.assertNotIn('.', self._vmutils._disk_resource_indexes)
+
+    def _mock_disk_resource_index(self):
+        mock_index = mock.Mock()
+        patcher = mock.patch.dict(vmutils.VMUtils._disk_resource_indexes,
+                                  {'.': mock_index})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return mock_index
+
+    def _mock_indexed_disk_resources(self, disk_resources):
+        conn = self._vmutils._compat_conn
+        get_resources = getattr(
+            conn, self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS)
+        get_resources.return_value = disk_resources
+        getattr(conn, self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS
+                ).return_value = disk_resources
+        return get_resources
+
+    @ddt.data(None, mock.sentinel.serial)
+    def test_get_mounted_disk_resource_indexed(self, serial):
+        mock_index = self._mock_disk_resource_index()
+        mock_disk = mock.Mock(
+            HostResource=[self._FAKE_MOUNTED_DISK_PATH.upper()],
+            ElementName=serial)
+        get_resources = self._mock_indexed_disk_resources([mock_disk])
+
+        disk = self._vmutils._get_mounted_disk_resource_from_path(
+            self._FAKE_MOUNTED_DISK_PATH, False, serial=serial)
+
+        self.assertEqual(mock_disk, disk)
+        mock_index.get.assert_called_once_with(
+            self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS,
+            disk_path=self._FAKE_MOUNTED_DISK_PATH, serial=serial)
+        get_resources.assert_called_once_with(
+            InstanceID=mock_index.get.return_value)
+        self.assertFalse(self._vmutils._compat_conn.query.called)
+
+    def test_get_mounted_disk_resource_index_stale(self):
+        mock_index = self._mock_disk_resource_index()
+        mock_stale_disk = mock.Mock(HostResource=['other_disk_path'])
+        self._mock_indexed_disk_resources([mock_stale_disk])
+
+        mock_disk = mock.Mock(HostResource=[self._FAKE_MOUNTED_DISK_PATH])
+        self._vmutils._compat_conn.query.return_value = [mock_disk]
+
+        disk = self._vmutils._get_mounted_disk_resource_from_path(
+            self._FAKE_MOUNTED_DISK_PATH, True)
+
+        self.assertEqual(mock_disk, disk)
+        mock_index.update.assert_has_calls(
+            [mock.call(self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                       mock_stale_disk),
+             mock.call(self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                       mock_disk)])
+
+    def test_get_mounted_disk_resource_index_removed(self):
+        mock_index = self._mock_disk_resource_index()
+        self._mock_indexed_disk_resources([])
+        self._vmutils._compat_conn.query.return_value = []
+
+        disk = self._vmutils._get_mounted_disk_resource_from_path(
+            self._FAKE_MOUNTED_DISK_PATH, True)
+
+        self.assertIsNone(disk)
+        mock_index.invalidate.assert_called_once_with(
+            mock_index.get.return_value)
+        self.assertFalse(mock_index.update.called)
+
     def test_get_controller_volume_paths(self):
         self._prepare_mock_disk()
         mock_disks = {self._FAKE_RES_PATH: self._FAKE_HOST_RESOURCE}
@@ -966,20 +1735,60 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     def _get_snapshot_service(self):
         return self._vmutils._conn.Msvm_VirtualSystemSnapshotService()[0]
 
-    def test_get_active_instances(self):
-        fake_vm = mock.MagicMock()
-
-        type(fake_vm).ElementName = mock.PropertyMock(
-            side_effect=['active_vm', 'inactive_vm'])
-        type(fake_vm).EnabledState = mock.PropertyMock(
-            side_effect=[constants.HYPERV_VM_STATE_ENABLED,
-                         constants.HYPERV_VM_STATE_DISABLED])
-        self._vmutils.list_instances = mock.MagicMock(
-            return_value=[mock.sentinel.fake_vm_name] * 2)
-        self._vmutils._lookup_vm = mock.MagicMock(side_effect=[fake_vm] * 2)
+    @mock.patch.object(vmutils.VMUtils, 'list_instances_with_state')
+    def test_get_active_instances(self, mock_list_instances_with_state):
+        mock_list_instances_with_state.return_value = [
+            (mock.sentinel.vm_name, constants.HYPERV_VM_STATE_ENABLED)]
+
         active_instances = self._vmutils.get_active_instances()
 
-        self.assertEqual(['active_vm'], active_instances)
+        self.assertEqual([mock.sentinel.vm_name], active_instances)
+        mock_list_instances_with_state.assert_called_once_with(
+            states=[constants.HYPERV_VM_STATE_ENABLED])
+
+    @mock.patch.object(vmutils.VMUtils, 'list_instances_with_state')
+    def test_get_active_instances_mirrored(self,
+                                           mock_list_instances_with_state):
+        mock_mirror = self._mock_vm_state_mirror()
+
+        active_instances = self._vmutils.get_active_instances()
+
+        self.assertEqual(mock_mirror.get_vm_names.return_value,
+                         active_instances)
+        mock_mirror.get_vm_names.assert_called_once_with(
+            enabled_states=[self._vmutils._vm_power_states_map[
+                constants.HYPERV_VM_STATE_ENABLED]])
+        mock_list_instances_with_state.assert_not_called()
+
+    def test_list_instances_with_state(self):
+        mock_vm = mock.Mock(ElementName=mock.sentinel.vm_name,
+                            EnabledState=3)
+        self._vmutils._conn.query.return_value = [mock_vm]
+
+        instances = self._vmutils.list_instances_with_state(
+            states=[constants.HYPERV_VM_STATE_DISABLED,
+                    constants.HYPERV_VM_STATE_PAUSED])
+
+        self.assertEqual(
+            [(mock.sentinel.vm_name, constants.HYPERV_VM_STATE_DISABLED)],
+            instances)
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT ElementName, EnabledState FROM Msvm_ComputerSystem "
+            "WHERE Caption = 'Virtual Machine' AND "
+            "(EnabledState = 3 OR EnabledState = 9)")
+
+    def test_list_instances_with_state_unfiltered(self):
+        self._vmutils._conn.query.return_value = []
+
+        self.assertEqual([], self._vmutils.list_instances_with_state())
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT ElementName, EnabledState FROM Msvm_ComputerSystem "
+            "WHERE Caption = 'Virtual Machine'")
+
+    def test_list_instances_with_state_invalid(self):
+        self.assertRaises(exceptions.InvalidParameterValue,
+                          self._vmutils.list_instances_with_state,
+                          states=[mock.sentinel.invalid_state])
 
     @mock.patch.object(_wqlutils, 'get_element_associated_class')
     def _test_get_vm_serial_port_connection(self,
@@ -1155,6 +1964,155 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     def test_create_vm_obj_vnuma_disabled(self):
         self._test_create_vm_obj(vnuma_enabled=False)
 
+    @ddt.data([], [mock.sentinel.disk])
+    @mock.patch.object(vmutils.VMUtils, '_add_controllers_and_volumes')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_setting_data')
+    @mock.patch.object(vmutils.VMUtils, '_configure_vcpus_settings')
+    @mock.patch.object(vmutils.VMUtils, '_configure_memory_settings')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_vssd')
+    def test_create_vm_from_spec(self, disks, mock_get_new_vssd,
+                                 mock_configure_memory,
+                                 mock_configure_vcpus,
+                                 mock_get_new_setting_data,
+                                 mock_get_new_rsd, mock_add_volumes):
+        mock_mem, mock_proc, mock_nic = [mock.Mock(), mock.Mock(),
+                                         mock.Mock()]
+        mock_get_new_setting_data.side_effect = [mock_mem, mock_proc,
+                                                 mock_nic]
+        mock_ctrl = mock_get_new_rsd.return_value
+        mock_svc = self._vmutils._vs_man_svc
+        mock_svc.DefineSystem.return_value = (
+            mock.sentinel.job_path, mock.sentinel.vm_path,
+            mock.sentinel.ret_val)
+
+        spec = dict(name=mock.sentinel.vm_name,
+                    vm_gen=mock.sentinel.vm_gen,
+                    instance_path=mock.sentinel.instance_path,
+                    memory_mb=mock.sentinel.memory_mb,
+                    vcpus_num=mock.sentinel.vcpus_num,
+                    dynamic_memory_ratio=2,
+                    nics=[(mock.sentinel.nic_name, '00:11:22:33:44:55')],
+                    disks=disks)
+        result = self._vmutils.create_vm_from_spec(spec)
+
+        mock_get_new_vssd.assert_called_once_with(
+            mock.sentinel.vm_name, False, mock.sentinel.vm_gen, None,
+            mock.sentinel.instance_path)
+        mock_configure_memory.assert_called_once_with(
+            mock_mem, mock.sentinel.memory_mb, None, 2)
+        mock_configure_vcpus.assert_called_once_with(
+            mock_proc, mock.sentinel.vcpus_num, None, False)
+        mock_get_new_rsd.assert_called_once_with(
+            self._vmutils._SCSI_CTRL_RES_SUB_TYPE)
+
+        self.assertEqual(mock.sentinel.nic_name, mock_nic.ElementName)
+        self.assertEqual('001122334455', mock_nic.Address)
+
+        # The controllers are added along with the requested drives.
+        expected_resources = ([mock_mem, mock_proc, mock_nic] if disks
+                              else [mock_mem, mock_proc, mock_ctrl, mock_nic])
+        mock_vs_data = mock_get_new_vssd.return_value
+        mock_svc.DefineSystem.assert_called_once_with(
+            ResourceSettings=[res.GetText_.return_value
+                              for res in expected_resources],
+            ReferenceConfiguration=None,
+            SystemSettings=mock_vs_data.GetText_.return_value)
+        self._jobutils.check_ret_val.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path)
+
+        if disks:
+            self.assertEqual(mock_add_volumes.return_value, result)
+            mock_add_volumes.assert_called_once_with(
+                mock.sentinel.vm_name, [mock_ctrl], disks)
+        else:
+            self.assertEqual([], result)
+            self.assertFalse(mock_add_volumes.called)
+
+    @mock.patch.object(vmutils.VMUtils, 'attach_volumes')
+    @mock.patch.object(vmutils.VMUtils, '_remove_drive')
+    @mock.patch.object(vmutils.VMUtils, '_add_volume_to_batch')
+    @mock.patch.object(vmutils.VMUtils, '_lookup_vm_check')
+    def test_add_controllers_and_volumes(self, mock_lookup_vm,
+                                         mock_add_volume_to_batch,
+                                         mock_remove_drive,
+                                         mock_attach_volumes):
+        self._vmutils._jobutils = mock.Mock()
+        mock_batch = self._vmutils._jobutils.virt_resource_batch.return_value
+        mock_ctrl_request = mock_batch.add.return_value
+        mock_request = mock.Mock()
+        mock_request.result.return_value = mock.sentinel.res_path
+        mock_failed_request = mock.Mock()
+        mock_failed_request.result.side_effect = exceptions.HyperVException
+        mock_failed_drive_request = mock.Mock(path=mock.sentinel.drive_path)
+        mock_add_volume_to_batch.side_effect = [
+            (mock_request, mock.Mock()),
+            (mock_failed_request, mock_failed_drive_request)]
+        mock_attach_volumes.return_value = [mock.sentinel.ide_res_path]
+        ide_volume = (mock.sentinel.ide_path, constants.DISK,
+                      constants.CTRL_TYPE_IDE)
+        volumes = [(mock.sentinel.path, constants.DISK, None),
+                   ide_volume,
+                   (mock.sentinel.failed_path, constants.DVD,
+                    constants.CTRL_TYPE_SCSI)]
+
+        results = self._vmutils._add_controllers_and_volumes(
+            mock.sentinel.vm_name, [mock.sentinel.ctrl], volumes)
+
+        self.assertEqual(mock.sentinel.res_path, results[0])
+        self.assertEqual(mock.sentinel.ide_res_path, results[1])
+        self.assertIsInstance(results[2], exceptions.HyperVException)
+
+        self._vmutils._jobutils.virt_resource_batch.assert_called_once_with(
+            mock_lookup_vm.return_value)
+        mock_batch.add.assert_called_once_with(mock.sentinel.ctrl)
+        # The drives use the slots of the new controller.
+        mock_add_volume_to_batch.assert_has_calls(
+            [mock.call(mock_batch, mock.sentinel.path, constants.DISK, None,
+                       0, ctrl_request=mock_ctrl_request),
+             mock.call(mock_batch, mock.sentinel.failed_path, constants.DVD,
+                       None, 1, ctrl_request=mock_ctrl_request)])
+        mock_batch.commit.assert_called_once_with()
+        mock_ctrl_request.result.assert_called_once_with()
+        mock_remove_drive.assert_called_once_with(mock.sentinel.drive_path)
+        mock_attach_volumes.assert_called_once_with(mock.sentinel.vm_name,
+                                                    [ide_volume])
+
+    @ddt.data(constants.DISK, constants.VOLUME)
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    def test_add_volume_to_batch_ctrl_request(self, drive_type,
+                                              mock_get_new_rsd):
+        mock_batch = mock.Mock()
+        mock_drive = mock_get_new_rsd.return_value
+
+        request, drive_request = self._vmutils._add_volume_to_batch(
+            mock_batch, mock.sentinel.path, drive_type, None, 1,
+            ctrl_request=mock.sentinel.ctrl_request)
+
+        self.assertEqual(mock_batch.add.return_value, request)
+        # The drive is parented by the controller request.
+        mock_batch.add.assert_any_call(
+            mock_drive, parent_request=mock.sentinel.ctrl_request)
+        if drive_type == constants.DISK:
+            self.assertEqual(mock_batch.add.return_value, drive_request)
+            mock_batch.add.assert_called_with(
+                mock_drive, parent_request=mock_batch.add.return_value)
+        else:
+            self.assertIsNone(drive_request)
+
+    @mock.patch.object(vmutils.VMUtils, '_lookup_vm_check')
+    def test_add_controllers_and_volumes_no_slots(self, mock_lookup_vm):
+        self._vmutils._jobutils = mock.Mock()
+        mock_batch = self._vmutils._jobutils.virt_resource_batch.return_value
+
+        results = self._vmutils._add_controllers_and_volumes(
+            mock.sentinel.vm_name, [],
+            [(mock.sentinel.path, constants.DISK, None)])
+
+        self.assertIsInstance(results[0], exceptions.HyperVException)
+        self.assertFalse(mock_batch.add.called)
+        mock_batch.commit.assert_called_once_with()
+
     def test_list_instances(self):
         vs = mock.MagicMock()
         attrs = {'ElementName': 'fake_name'}
@@ -1249,35 +2207,41 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
             self.assertEqual(watcher.return_value, listener)
 
     @mock.patch('time.sleep')
-    @mock.patch.object(vmutils, 'tpool')
-    @mock.patch.object(vmutils, 'patcher')
-    def test_vm_power_state_change_event_handler(self, mock_patcher,
-                                                 mock_tpool, mock_sleep):
+    @mock.patch.object(vmutils.VMUtils, '_get_wmi_event_hub')
+    def test_vm_power_state_change_event_handler(self, mock_get_hub,
+                                                 mock_sleep):
         enabled_state = constants.HYPERV_VM_STATE_ENABLED
         hv_enabled_state = self._vmutils._vm_power_states_map[enabled_state]
         fake_event = mock.Mock(ElementName=mock.sentinel.vm_name,
                                EnabledState=hv_enabled_state)
         fake_callback = mock.Mock(side_effect=Exception)
 
-        fake_listener = (
-            self._vmutils._conn.Msvm_ComputerSystem.watch_for.return_value)
-        mock_tpool.execute.side_effect = (exceptions.x_wmi_timed_out,
-                                          fake_event, Exception,
-                                          KeyboardInterrupt)
+        mock_subscribe = mock_get_hub.return_value.subscribe
+        mock_subscription = mock_subscribe.return_value
+        mock_subscription.get.side_effect = (None, fake_event, Exception,
+                                             KeyboardInterrupt)
 
-        handler = self._vmutils.get_vm_power_state_change_listener(
-            get_handler=True)
+        with mock.patch.object(self._vmutils,
+                               '_get_event_wql_query') as mock_get_query:
+            handler = self._vmutils.get_vm_power_state_change_listener(
+                get_handler=True)
         # This is supposed to run as a daemon, so we'll just cause an
         # exception in order to be able to test the method.
         self.assertRaises(KeyboardInterrupt, handler, fake_callback)
 
+        mock_get_hub.assert_called_once_with(
+            self._vmutils._wmi_namespace % self._vmutils._host)
+        mock_subscribe.assert_called_once_with(
+            mock_get_query.return_value,
+            fields=[self._vmutils._VM_ENABLED_STATE_PROP])
         fake_callback.assert_called_once_with(mock.sentinel.vm_name,
                                               enabled_state)
-        mock_tpool.execute.assert_has_calls(
-            fake_listener,
-            [mock.call(constants.DEFAULT_WMI_EVENT_TIMEOUT_MS)] * 4)
+        mock_subscription.get.assert_has_calls(
+            [mock.call(
+                timeout=constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000)] * 4)
         mock_sleep.assert_called_once_with(
             constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000)
+        self._vmutils._conn.Msvm_ComputerSystem.watch_for.assert_not_called()
 
     def _test_get_vm_generation(self, vm_gen):
         mock_settings = self._lookup_vm()
@@ -98,6 +98,24 @@ class VMUtils10TestCase(test_base.OsWinBaseTestCase):
         self._vmutils._jobutils.modify_virt_resource.assert_called_once_with(
             mock_procsettings)
 
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    def test_get_vm_serial_port_connections_topology(
+            self, mock_get_element_associated_class):
+        # The serial ports are retrieved by the generic resource query.
+        serial_port = mock.Mock(
+            ResourceSubType=self._vmutils._SERIAL_PORT_RES_SUB_TYPE,
+            Connection=[mock.sentinel.pipe_path], Parent=None)
+        topology = vmutils10.vmutils._vm_topology.VMTopology(
+            mock.sentinel.vm_name, mock.sentinel.instance_id,
+            [(self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+              [serial_port])])
+
+        conns = self._vmutils.get_vm_serial_port_connections(
+            mock.sentinel.vm_name, topology=topology)
+
+        self.assertEqual([mock.sentinel.pipe_path], conns)
+        self.assertFalse(mock_get_element_associated_class.called)
+
     def test_vm_gen_supports_remotefx(self):
         ret = self._vmutils.vm_gen_supports_remotefx(mock.sentinel.VM_GEN)
 
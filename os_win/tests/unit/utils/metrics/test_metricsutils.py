@@ -270,6 +270,126 @@ class MetricsUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_get_metrics_values.assert_called_once_with(
             mock_disk, [mock.sentinel.metrics])
 
+    def _get_fake_metric(self, instance_id, metrics_def_id, value,
+                         metrics_class=None):
+        metric = mock.Mock(InstanceID=instance_id,
+                           MetricDefinitionId=metrics_def_id,
+                           MetricValue=str(value))
+        metric.path.return_value.Class = (metrics_class or
+                                          self.utils._BASE_METRICS_VALUE)
+        return metric
+
+    def test_collect_all_vm_metrics(self):
+        metrics_names = [
+            self.utils._CPU_METRICS, self.utils._MEMORY_METRICS,
+            self.utils._DISK_RD_METRICS, self.utils._DISK_WR_METRICS,
+            self.utils._DISK_LATENCY_METRICS, self.utils._DISK_IOPS_METRICS,
+            self.utils._NET_IN_METRICS, self.utils._NET_OUT_METRICS]
+        self.utils._metrics_defs_obj = {
+            metrics_name: mock.Mock(Id=metrics_name)
+            for metrics_name in metrics_names}
+
+        vm_prefix = 'Microsoft:VM_ID'
+        port_id = vm_prefix + '\\PORT_ID\\C'
+        disk_id = vm_prefix + '\\DISK_ID\\0\\0\\D'
+        acl_id = port_id + '\\ACL_ID'
+        mock_vm = mock.Mock(Name='vm_id', ElementName=mock.sentinel.vm_name,
+                            OnTimeInMilliseconds='10')
+        # VM names are not unique.
+        mock_other_vm = mock.Mock(Name='other_vm_id',
+                                  ElementName=mock.sentinel.vm_name,
+                                  OnTimeInMilliseconds=None)
+        mock_cpu_sd = mock.Mock(InstanceID=vm_prefix + '\\CPU_ID',
+                                VirtualQuantity='2')
+        mock_disk = mock.Mock(InstanceID=disk_id,
+                              HostResource=[mock.sentinel.disk_path])
+        mock_orphaned_disk = mock.Mock(
+            InstanceID='Microsoft:missing_vm\\DISK_ID', HostResource=[])
+        mock_port = mock.Mock(InstanceID=port_id,
+                              Parent='\\\\host\\VNIC_PATH')
+        mock_acl = mock.Mock(InstanceID=acl_id)
+        mock_vnic = mock.Mock(ElementName=mock.sentinel.vnic_name,
+                              Address=mock.sentinel.address)
+        mock_vnic.path_.return_value = '\\\\HOST\\vnic_path'
+        aggr_metrics = [
+            self._get_fake_metric(vm_prefix + '\\CPU_METRIC',
+                                  self.utils._CPU_METRICS, 10,
+                                  self.utils._AGGREGATION_METRICS_VALUE),
+            self._get_fake_metric(vm_prefix + '\\MEMORY_METRIC',
+                                  self.utils._MEMORY_METRICS, 1024,
+                                  self.utils._AGGREGATION_METRICS_VALUE)]
+        base_metrics = [
+            self._get_fake_metric(disk_id + '\\READ',
+                                  self.utils._DISK_RD_METRICS, 1),
+            self._get_fake_metric(disk_id + '\\WRITE',
+                                  self.utils._DISK_WR_METRICS, 2),
+            self._get_fake_metric(disk_id + '\\LATENCY',
+                                  self.utils._DISK_LATENCY_METRICS, 3),
+            self._get_fake_metric(acl_id + '\\IN',
+                                  self.utils._NET_IN_METRICS, 4),
+            self._get_fake_metric('Microsoft:unknown\\metric',
+                                  self.utils._DISK_IOPS_METRICS, 5)]
+
+        query_results = {
+            self.utils._COMPUTER_SYSTEM_CLASS: [mock_vm, mock_other_vm],
+            self.utils._PROCESSOR_SETTING_DATA_CLASS: [mock_cpu_sd],
+            self.utils._STORAGE_ALLOC_SETTING_DATA_CLASS: [
+                mock_disk, mock_orphaned_disk],
+            self.utils._PORT_ALLOC_SET_DATA: [mock_port],
+            self.utils._PORT_ALLOC_ACL_SET_DATA: [mock_acl],
+            self.utils._SYNTH_ETH_PORT_SET_DATA: [mock_vnic],
+            self.utils._AGGREGATION_METRICS_VALUE: aggr_metrics,
+            self.utils._BASE_METRICS_VALUE: base_metrics}
+
+        def fake_query(query):
+            for class_name, results in query_results.items():
+                if ' FROM %s' % class_name in query:
+                    return results
+
+        self.utils._conn.query.side_effect = fake_query
+
+        vm_metrics = self.utils.collect_all_vm_metrics()
+
+        expected = {
+            'vm_id': {
+                'vm_name': mock.sentinel.vm_name,
+                'cpu_used': 10,
+                'cpu_count': 2,
+                'uptime': 10,
+                'memory_usage': 1024,
+                'disks': [{'read_mb': 1,
+                           'write_mb': 2,
+                           'disk_latency': 3,
+                           'iops_count': 0,
+                           'instance_id': disk_id,
+                           'host_resource': mock.sentinel.disk_path}],
+                'vnics': [{'rx_mb': 4,
+                           'tx_mb': 0,
+                           'element_name': mock.sentinel.vnic_name,
+                           'address': mock.sentinel.address}]},
+            'other_vm_id': {
+                'vm_name': mock.sentinel.vm_name,
+                'cpu_used': 0,
+                'cpu_count': 0,
+                'uptime': 0,
+                'memory_usage': 0,
+                'disks': [],
+                'vnics': []}}
+        self.assertEqual(expected, vm_metrics)
+        self.assertEqual(len(query_results),
+                         self.utils._conn.query.call_count)
+
+    def test_get_instance_id_prefix(self):
+        prefixes = set(['A\\B', 'A\\B\\C'])
+
+        self.assertEqual(
+            'A\\B\\C',
+            self.utils._get_instance_id_prefix('A\\B\\C\\D', prefixes))
+        self.assertEqual(
+            'A\\B', self.utils._get_instance_id_prefix('A\\B\\CD', prefixes))
+        self.assertIsNone(
+            self.utils._get_instance_id_prefix('A\\BC', prefixes))
+
     def test_sum_metrics_values(self):
         mock_metric = mock.MagicMock(MetricValue='100')
         result = self.utils._sum_metrics_values([mock_metric] * 2)
@@ -0,0 +1,70 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win.tests.unit import test_base
+from os_win.utils.network import _acl_weight_allocator
+
+
+class ACLWeightAllocatorTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the ACL weight allocator."""
+
+    _FAKE_ACTION = 1
+    _FAKE_OTHER_ACTION = 2
+
+    def setUp(self):
+        super(ACLWeightAllocatorTestCase, self).setUp()
+        acls = [mock.Mock(Action=self._FAKE_ACTION, Weight=weight)
+                for weight in (2, 4, 9)]
+        acls.append(mock.Mock(Action=self._FAKE_OTHER_ACTION, Weight=1))
+        self._allocator = _acl_weight_allocator.ACLWeightAllocator(acls)
+
+    def test_get_min_used(self):
+        self.assertEqual(2, self._allocator.get_min_used(self._FAKE_ACTION))
+        self.assertEqual(
+            1, self._allocator.get_min_used(self._FAKE_OTHER_ACTION))
+        self.assertIsNone(self._allocator.get_min_used(mock.sentinel.action))
+
+    def test_allocate_lowest(self):
+        weights = self._allocator.allocate_lowest(self._FAKE_ACTION, 3, 1, 5)
+
+        self.assertEqual([1, 3, 5], weights)
+        for weight in weights:
+            self.assertTrue(self._allocator.is_used(self._FAKE_ACTION,
+                                                    weight))
+        self.assertFalse(self._allocator.is_used(self._FAKE_OTHER_ACTION, 3))
+
+    def test_allocate_lowest_exhausted(self):
+        weights = self._allocator.allocate_lowest(self._FAKE_ACTION, 3, 2, 4)
+
+        self.assertEqual([3], weights)
+        self.assertEqual(
+            [], self._allocator.allocate_lowest(self._FAKE_ACTION, 1, 2, 4))
+
+    def test_allocate_highest(self):
+        weights = self._allocator.allocate_highest(self._FAKE_ACTION, 3, 1, 9)
+
+        self.assertEqual([8, 7, 6], weights)
+        self.assertEqual(
+            [5, 3], self._allocator.allocate_highest(self._FAKE_ACTION,
+                                                     2, 3, 9))
+
+    def test_release(self):
+        self._allocator.release(self._FAKE_ACTION, [2, 9])
+
+        self.assertFalse(self._allocator.is_used(self._FAKE_ACTION, 2))
+        self.assertFalse(self._allocator.is_used(self._FAKE_ACTION, 9))
+        self.assertEqual(4, self._allocator.get_min_used(self._FAKE_ACTION))
@@ -68,7 +68,9 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         self.netutils._conn.Msvm_VirtualEthernetSwitch.assert_not_called()
         self.assertEqual({}, self.netutils._switches)
 
-    def test_init_caches(self):
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_start_cache_invalidation_listener')
+    def test_init_caches(self, mock_start_listener):
         self.netutils._switches = {}
         self.netutils._switch_ports = {}
         self.netutils._vlan_sds = {}
@@ -86,14 +88,7 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
 
         mock_sd = mock.MagicMock(InstanceID=self._FAKE_INSTANCE_ID)
         mock_bad_sd = mock.MagicMock(InstanceID=self._FAKE_BAD_INSTANCE_ID)
-        conn.Msvm_EthernetSwitchPortProfileSettingData.return_value = [
-            mock_bad_sd, mock_sd]
-        conn.Msvm_EthernetSwitchPortVlanSettingData.return_value = [
-            mock_bad_sd, mock_sd]
-        conn.Msvm_EthernetSwitchPortSecuritySettingData.return_value = [
-            mock_bad_sd, mock_sd]
-        conn.Msvm_EthernetSwitchPortBandwidthSettingData.return_value = [
-            mock_bad_sd, mock_sd]
+        conn.query.return_value = [mock_bad_sd, mock_sd]
 
         self.netutils.init_caches()
 
@@ -106,6 +101,38 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         self.assertEqual([mock_sd], list(self.netutils._vsid_sds.values()))
         self.assertEqual([mock_sd],
                          list(self.netutils._bandwidth_sds.values()))
+        mock_start_listener.assert_called_once_with()
+
+        conn.query.assert_has_calls([
+            mock.call("SELECT InstanceID, CdnLabelId, CdnLabelString, "
+                      "NetCfgInstanceId, ProfileData, ProfileId, "
+                      "ProfileName, VendorId, VendorName FROM %s" %
+                      self.netutils._PORT_PROFILE_SET_DATA),
+            mock.call("SELECT InstanceID, OperationMode, AccessVlanId, "
+                      "NativeVlanId, TrunkVlanIdArray FROM %s" %
+                      self.netutils._PORT_VLAN_SET_DATA),
+            mock.call("SELECT * FROM %s" %
+                      self.netutils._PORT_SECURITY_SET_DATA),
+            mock.call("SELECT * FROM %s" %
+                      self.netutils._PORT_BANDWIDTH_SET_DATA)])
+
+    @ddt.data(
+        ('Microsoft:vm_id/port_id/C/feature_id/sd_id',
+         'Microsoft:vm_id/port_id/C'),
+        ('microsoft:vm_id/port_id/C', 'microsoft:vm_id/port_id/C'),
+        ('Microsoft:vm_id/port_id', None),
+        ('Microsoft:vm_id/port_id/', None),
+        ('vm_id/port_id/C/feature_id', None))
+    @ddt.unpack
+    def test_get_switch_port_instance_id(self, feature_instance_id,
+                                         expected_port_id):
+        # We're using slashes for readability.
+        port_id = self.netutils._get_switch_port_instance_id(
+            feature_instance_id.replace('/', '\\'))
+
+        if expected_port_id:
+            expected_port_id = expected_port_id.replace('/', '\\')
+        self.assertEqual(expected_port_id, port_id)
 
     def test_update_cache_disabled(self):
         self.netutils._enable_cache = False
@@ -125,13 +152,140 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self.netutils.update_cache()
 
-        self.assertEqual({mock.sentinel.port_name: mock_port},
-                         self.netutils._switch_ports)
+        self.assertEqual([mock_port], self.netutils._switch_ports.values())
+        self.assertEqual(mock_port,
+                         self.netutils._switch_ports[mock.sentinel.port_name])
 
         # assert that other networkutils have the same cache.
         netutils = networkutils.NetworkUtils()
-        self.assertEqual({mock.sentinel.port_name: mock_port},
-                         netutils._switch_ports)
+        self.assertEqual([mock_port], netutils._switch_ports.values())
+
+    def test_update_cache_incremental(self):
+        self.netutils._switch_ports = {
+            mock.sentinel.removed_port_name: mock.sentinel.removed_port,
+            mock.sentinel.port_name: mock.sentinel.port}
+        self.netutils._CACHE_UPDATE_BATCH_SIZE = 1
+        conn = self.netutils._conn
+
+        port_names = [mock.sentinel.port_name, 'new_port', "new'port"]
+        ports = [mock.Mock(ElementName=port_name)
+                 for port_name in port_names]
+        # Unnamed ports are skipped.
+        unnamed_port = mock.Mock(ElementName=None)
+        conn.query.side_effect = [ports + [unnamed_port],
+                                  [ports[1]], [ports[2]]]
+
+        self.netutils.update_cache(incremental=True)
+
+        expected_cache = dict(zip(port_names, ports))
+        expected_cache[mock.sentinel.port_name] = mock.sentinel.port
+        self.assertEqual(expected_cache, self.netutils._switch_ports)
+
+        conn.query.assert_has_calls([
+            mock.call("SELECT InstanceID, ElementName FROM %s" %
+                      self.netutils._PORT_ALLOC_SET_DATA),
+            mock.call("SELECT * FROM %s WHERE ElementName = 'new_port'" %
+                      self.netutils._PORT_ALLOC_SET_DATA),
+            mock.call("SELECT * FROM %s WHERE ElementName = 'new\"port'" %
+                      self.netutils._PORT_ALLOC_SET_DATA)],
+            any_order=True)
+        conn.Msvm_EthernetPortAllocationSettingData.assert_not_called()
+
+    def _get_partial_sd(self, fields, **values):
+        # Mimics the setting data objects retrieved using projected queries,
+        # which only have the requested properties.
+        partial_sd = mock.Mock(spec=list(fields) + ['path_'])
+        for field in fields:
+            setattr(partial_sd, field, values.get(field))
+        return partial_sd
+
+    @ddt.data(constants.VLAN_MODE_ACCESS, constants.VLAN_MODE_TRUNK)
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_create_default_setting_data')
+    def test_prepare_vlan_sd_partial(self, operation_mode,
+                                     mock_create_default_sd):
+        vlan_sd = self._get_partial_sd(
+            self.netutils._PORT_VLAN_SD_FIELDS,
+            OperationMode=operation_mode, AccessVlanId=mock.sentinel.vlan_id,
+            NativeVlanId=mock.sentinel.vlan_id, TrunkVlanIdArray=[1, 2])
+
+        new_vlan_sd = self.netutils._prepare_vlan_sd(
+            vlan_sd, mock.sentinel.vlan_id, operation_mode, [2, 1])
+
+        self.assertIsNone(new_vlan_sd)
+
+    @mock.patch.object(networkutils.NetworkUtils, '_prepare_profile_sd')
+    def test_get_new_profile_sd_partial(self, mock_prepare_profile_sd):
+        profile_args = {arg_name: mock.sentinel.value
+                        for arg_name in networkutils._PORT_PROFILE_ATTR_MAP}
+        profile_values = {attr_name: mock.sentinel.value for attr_name in
+                          networkutils._PORT_PROFILE_ATTR_MAP.values()}
+        profile_sd = self._get_partial_sd(
+            self.netutils._PORT_PROFILE_SD_FIELDS, **profile_values)
+        mock_prepare_profile_sd.return_value = mock.Mock(**profile_values)
+
+        new_profile_sd = self.netutils._get_new_profile_sd(profile_sd,
+                                                           profile_args)
+
+        self.assertIsNone(new_profile_sd)
+
+    def test_get_cache_stats(self):
+        stats = self.netutils.get_cache_stats()
+
+        self.assertEqual(
+            set(['switches', 'switch_ports', 'vlan_sds', 'profile_sds',
+                 'vsid_sds', 'sg_acl_sds', 'sg_acl_weights',
+                 'bandwidth_sds']),
+            set(stats))
+        self.assertEqual(self.netutils._switches.get_stats(),
+                         stats['switches'])
+
+    def test_invalidate_port_cache(self):
+        self.netutils._switch_ports = {
+            mock.sentinel.port_name: mock.sentinel.port}
+        self.netutils._sg_acl_sds = {mock.sentinel.port_name: []}
+        self.netutils._sg_acl_weights = {
+            mock.sentinel.port_name: mock.sentinel.weight_allocator}
+        for cache_name in ('_profile_sds', '_vlan_sds', '_vsid_sds',
+                           '_bandwidth_sds'):
+            setattr(self.netutils, cache_name,
+                    {mock.sentinel.instance_id: mock.sentinel.sd})
+
+        self.netutils._invalidate_port_cache(mock.sentinel.port_name,
+                                             mock.sentinel.instance_id)
+
+        for cache_name in ('_switch_ports', '_sg_acl_sds', '_sg_acl_weights',
+                           '_profile_sds', '_vlan_sds', '_vsid_sds',
+                           '_bandwidth_sds'):
+            self.assertEqual({}, getattr(self.netutils, cache_name))
+
+    @mock.patch.object(networkutils.NetworkUtils, '_get_wmi_event_hub')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_event_wql_query')
+    def test_start_cache_invalidation_listener(self, mock_get_query,
+                                               mock_get_hub):
+        self.netutils._cache_invalidation_lock = mock.MagicMock()
+
+        with mock.patch.object(networkutils.NetworkUtils,
+                               '_cache_invalidation_subscription', None):
+            self.netutils._start_cache_invalidation_listener()
+            self.netutils._start_cache_invalidation_listener()
+
+        mock_get_query.assert_called_once_with(
+            cls=self.netutils._PORT_ALLOC_SET_DATA,
+            event_type=self.netutils.EVENT_TYPE_DELETE,
+            timeframe=2)
+        mock_get_hub.return_value.subscribe.assert_called_once_with(
+            mock_get_query.return_value,
+            callback=self.netutils._invalidate_removed_port)
+
+    @mock.patch.object(networkutils.NetworkUtils, '_invalidate_port_cache')
+    def test_invalidate_removed_port(self, mock_invalidate):
+        mock_event = mock.Mock()
+
+        self.netutils._invalidate_removed_port(mock_event)
+
+        mock_invalidate.assert_called_once_with(mock_event.ElementName,
+                                                mock_event.InstanceID)
 
     def test_clear_port_sg_acls_cache(self):
         self.netutils._sg_acl_sds[mock.sentinel.port_id] = [mock.sentinel.acl]
@@ -195,15 +349,14 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_nic_sd.assert_called_once_with(
             ElementName=mock.sentinel.vnic_name)
 
-    @mock.patch.object(networkutils, 'patcher')
-    @mock.patch.object(networkutils.tpool, 'execute')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_wmi_event_hub')
     @mock.patch.object(networkutils.NetworkUtils, '_get_event_wql_query')
     def test_get_vnic_event_listener(self, mock_get_event_query,
-                                     mock_execute, mock_patcher):
+                                     mock_get_hub):
         event = mock.MagicMock()
-        port_class = self.netutils._conn.Msvm_SyntheticEthernetPortSettingData
-        wmi_event_listener = port_class.watch_for.return_value
-        mock_execute.side_effect = [exceptions.x_wmi_timed_out, event]
+        mock_subscribe = mock_get_hub.return_value.subscribe
+        mock_subscription = mock_subscribe.return_value
+        mock_subscription.get.side_effect = [None, event]
 
         # callback will raise an exception in order to stop iteration in the
         # listener.
@@ -217,13 +370,37 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
             cls=self.netutils._VNIC_SET_DATA,
             event_type=self.netutils.EVENT_TYPE_CREATE,
             timeframe=2)
-        port_class.watch_for.assert_called_once_with(
+        mock_get_hub.assert_called_once_with(
+            self.netutils._wmi_namespace % self.netutils._host)
+        mock_subscribe.assert_called_once_with(
             mock_get_event_query.return_value)
-        mock_execute.assert_has_calls(
-            [mock.call(wmi_event_listener,
-                       self.netutils._VNIC_LISTENER_TIMEOUT_MS)] * 2)
+        mock_subscription.get.assert_has_calls(
+            [mock.call(
+                timeout=self.netutils._VNIC_LISTENER_TIMEOUT_MS / 1000)] * 2)
         callback.assert_called_once_with(event.ElementName)
 
+    @mock.patch('time.time')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_wmi_event_hub')
+    def test_get_vnic_event_listener_batched(self, mock_get_hub, mock_time):
+        events = [mock.Mock(ElementName=port_name)
+                  for port_name in ('port_a', 'port_b', 'port_a')]
+        mock_subscription = mock_get_hub.return_value.subscribe.return_value
+        mock_subscription.get.side_effect = [events[0], events[1], None,
+                                             events[2]]
+        mock_time.side_effect = [0, 1, 2, 3]
+
+        callback = mock.MagicMock(side_effect=TypeError)
+
+        returned_listener = self.netutils.get_vnic_event_listener(
+            self.netutils.EVENT_TYPE_CREATE, batch_window=3)
+        self.assertRaises(TypeError, returned_listener, callback)
+
+        mock_subscription.get.assert_has_calls(
+            [mock.call(timeout=self.netutils._VNIC_LISTENER_TIMEOUT_MS / 1000),
+             mock.call(timeout=3), mock.call(timeout=2),
+             mock.call(timeout=1)])
+        callback.assert_called_once_with(['port_a', 'port_b'])
+
     def test_get_event_wql_query(self):
         expected = ("SELECT * FROM %(event_type)s WITHIN %(timeframe)s "
                     "WHERE TargetInstance ISA '%(class)s' AND "
@@ -662,7 +839,7 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
             mock_port)
 
         self.assertEqual(mock_get_sd.return_value, result)
-        mock_get_sd.assert_called_once_with(mock_port, self.netutils._vsid_sds,
+        mock_get_sd.assert_called_once_with(mock_port, self.netutils._vlan_sds,
                                             self.netutils._PORT_VLAN_SET_DATA)
 
     @mock.patch.object(networkutils.NetworkUtils,
@@ -864,48 +1041,80 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         self.netutils.create_security_rules(self._FAKE_PORT_NAME, fake_rule)
         mock_bind.assert_called_once_with(m_port, fake_rule)
 
+    def _get_fake_sg_rule(self, **props):
+        props.setdefault('Action', self._FAKE_ACL_ACT)
+        props.setdefault('Direction', self._FAKE_ACL_DIR)
+        sg_rule = mock.Mock(**props)
+        sg_rule.to_dict.return_value = props
+        return sg_rule
+
     @mock.patch.object(_wqlutils, 'get_element_associated_class')
     @mock.patch.object(networkutils.NetworkUtils, '_create_security_acl')
     @mock.patch.object(networkutils.NetworkUtils, '_get_new_weights')
-    @mock.patch.object(networkutils.NetworkUtils, '_filter_security_acls')
-    def test_bind_security_rules(self, mock_filtered_acls, mock_get_weights,
-                                 mock_create_acl, mock_get_elem_assoc_cls):
+    def test_bind_security_rules(self, mock_get_weights, mock_create_acl,
+                                 mock_get_elem_assoc_cls):
         m_port = mock.MagicMock()
-        m_acl = mock.MagicMock()
-        mock_get_elem_assoc_cls.return_value = [m_acl]
-        mock_filtered_acls.return_value = []
-        mock_get_weights.return_value = [mock.sentinel.FAKE_WEIGHT]
-        mock_create_acl.return_value = m_acl
-        fake_rule = mock.MagicMock()
+        existent_rule = self._get_fake_sg_rule(Protocol=mock.sentinel.tcp)
+        fake_rule = self._get_fake_sg_rule(Protocol=mock.sentinel.udp)
+        m_acl = mock.Mock(Weight=mock.sentinel.weight,
+                          **existent_rule.to_dict())
+        acls = [m_acl]
+        mock_get_elem_assoc_cls.return_value = acls
+        mock_get_weights.return_value = [mock.sentinel.FAKE_WEIGHT,
+                                         mock.sentinel.OTHER_WEIGHT]
+        mock_create_acl.return_value = mock.sentinel.new_acl
 
-        self.netutils._bind_security_rules(m_port, [fake_rule])
+        self.netutils._bind_security_rules(
+            m_port, [existent_rule, fake_rule, fake_rule])
 
         mock_create_acl.assert_called_once_with(fake_rule,
                                                 mock.sentinel.FAKE_WEIGHT)
         mock_add_features = self.netutils._jobutils.add_multiple_virt_features
-        mock_add_features.assert_called_once_with([m_acl], m_port)
+        mock_add_features.assert_called_once_with([mock.sentinel.new_acl],
+                                                  m_port)
+        mock_get_weights.assert_called_once_with([fake_rule], acls, m_port)
         mock_get_elem_assoc_cls.assert_called_once_with(
             self.netutils._conn, self.netutils._PORT_EXT_ACL_SET_DATA,
             element_instance_id=m_port.InstanceID)
+        self.assertEqual([m_acl, fake_rule], acls)
 
     @mock.patch.object(_wqlutils, 'get_element_associated_class')
     @mock.patch.object(networkutils.NetworkUtils, '_get_new_weights')
-    @mock.patch.object(networkutils.NetworkUtils, '_filter_security_acls')
-    def test_bind_security_rules_existent(self, mock_filtered_acls,
-                                          mock_get_weights,
+    def test_bind_security_rules_existent(self, mock_get_weights,
                                           mock_get_elem_assoc_cls):
         m_port = mock.MagicMock()
-        m_acl = mock.MagicMock()
+        fake_rule = self._get_fake_sg_rule()
+        m_acl = mock.Mock(**fake_rule.to_dict())
         mock_get_elem_assoc_cls.return_value = [m_acl]
-        mock_filtered_acls.return_value = [m_acl]
-        fake_rule = mock.MagicMock()
 
         self.netutils._bind_security_rules(m_port, [fake_rule])
-        mock_filtered_acls.assert_called_once_with(fake_rule, [m_acl])
-        mock_get_weights.assert_called_once_with([fake_rule], [m_acl])
+
+        self.assertFalse(mock_get_weights.called)
         mock_get_elem_assoc_cls.assert_called_once_with(
             self.netutils._conn, self.netutils._PORT_EXT_ACL_SET_DATA,
             element_instance_id=m_port.InstanceID)
+        mock_add_features = self.netutils._jobutils.add_multiple_virt_features
+        self.assertFalse(mock_add_features.called)
+
+    @mock.patch.object(_wqlutils, 'get_element_associated_class')
+    @mock.patch.object(networkutils.NetworkUtils, '_create_security_acl')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_new_weights')
+    def test_bind_security_rules_failed(self, mock_get_weights,
+                                        mock_create_acl,
+                                        mock_get_elem_assoc_cls):
+        m_port = mock.MagicMock()
+        mock_get_elem_assoc_cls.return_value = []
+        mock_get_weights.return_value = [mock.sentinel.weight]
+        self.netutils._sg_acl_weights = {
+            m_port.ElementName: mock.sentinel.weight_allocator}
+        mock_add_features = self.netutils._jobutils.add_multiple_virt_features
+        mock_add_features.side_effect = exceptions.HyperVException
+
+        self.assertRaises(exceptions.HyperVException,
+                          self.netutils._bind_security_rules,
+                          m_port, [self._get_fake_sg_rule()])
+
+        self.assertEqual({}, self.netutils._sg_acl_weights)
 
     def test_get_port_security_acls_cached(self):
         mock_port = mock.MagicMock(ElementName=mock.sentinel.port_name)
@@ -937,17 +1146,127 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
             element_instance_id=mock_port.InstanceID)
 
     @mock.patch.object(_wqlutils, 'get_element_associated_class')
-    @mock.patch.object(networkutils.NetworkUtils, '_filter_security_acls')
-    def test_remove_security_rules(self, mock_filter, mock_get_elem_assoc_cls):
-        mock_acl = self._setup_security_rule_test(mock_get_elem_assoc_cls)[1]
-        fake_rule = mock.MagicMock()
-        mock_filter.return_value = [mock_acl]
+    def test_remove_security_rules(self, mock_get_elem_assoc_cls):
+        mock_port = self._mock_get_switch_port_alloc()
+        fake_rule = self._get_fake_sg_rule(Protocol=mock.sentinel.tcp)
+        mock_acl = mock.Mock(Weight=mock.sentinel.weight,
+                             **fake_rule.to_dict())
+        mock_other_acl = mock.Mock(
+            **self._get_fake_sg_rule(Protocol=mock.sentinel.udp).to_dict())
+        mock_get_elem_assoc_cls.return_value = [mock_acl, mock_other_acl]
+
+        mock_weight_allocator = mock.Mock()
+        self.netutils._sg_acl_weights = {
+            mock_port.ElementName: mock_weight_allocator}
 
         self.netutils.remove_security_rules(self._FAKE_PORT_NAME, [fake_rule])
 
         mock_remove_features = (
             self.netutils._jobutils.remove_multiple_virt_features)
         mock_remove_features.assert_called_once_with([mock_acl])
+        self.assertEqual([mock_other_acl],
+                         self.netutils._sg_acl_sds[mock_port.ElementName])
+        mock_weight_allocator.release.assert_called_once_with(
+            self._FAKE_ACL_ACT, [mock.sentinel.weight])
+
+    def test_get_security_acl_key(self):
+        fake_rule = self._get_fake_sg_rule(Protocol=mock.sentinel.tcp)
+        key_fields = self.netutils._get_security_rule_key_fields([fake_rule])
+        mock_acl = mock.Mock(Weight=mock.sentinel.weight,
+                             **fake_rule.to_dict())
+
+        self.assertEqual(('Action', 'Direction', 'Protocol'), key_fields)
+        self.assertEqual(
+            (self._FAKE_ACL_ACT, self._FAKE_ACL_DIR, mock.sentinel.tcp),
+            self.netutils._get_security_acl_key(fake_rule, key_fields))
+        self.assertEqual(
+            self.netutils._get_security_acl_key(fake_rule, key_fields),
+            self.netutils._get_security_acl_key(mock_acl, key_fields))
+
+    @mock.patch.object(networkutils.NetworkUtils, '_bind_security_rules')
+    @mock.patch.object(networkutils.NetworkUtils, '_remove_security_acls')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_ports_security_acls')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_switch_port_allocation')
+    def test_apply_security_rules_bulk(self, mock_get_port_alloc,
+                                       mock_get_ports_acls,
+                                       mock_remove_acls, mock_bind_rules):
+        ports = {
+            port_name: mock.Mock(InstanceID=port_name + '_id')
+            for port_name in ('port_a', 'port_b')}
+
+        def fake_get_port_alloc(port_name):
+            if port_name not in ports:
+                raise exceptions.HyperVPortNotFoundException(
+                    port_name=port_name)
+            return ports[port_name], True
+
+        def fake_bind_rules(port, add_rules, acls):
+            if port is ports['port_b']:
+                raise exceptions.HyperVException
+
+        mock_get_port_alloc.side_effect = fake_get_port_alloc
+        mock_get_ports_acls.return_value = {
+            'port_a_id': mock.sentinel.port_a_acls}
+        mock_remove_acls.return_value = mock.sentinel.remaining_acls
+        mock_bind_rules.side_effect = fake_bind_rules
+        port_rules = {
+            port_name: (mock.sentinel.add_rules, mock.sentinel.remove_rules)
+            for port_name in ('port_a', 'port_b', 'port_c')}
+
+        results = self.netutils.apply_security_rules_bulk(port_rules,
+                                                          max_workers=1)
+
+        self.assertEqual(set(port_rules), set(results))
+        self.assertIsNone(results['port_a'])
+        self.assertIsInstance(results['port_b'], exceptions.HyperVException)
+        self.assertIsInstance(results['port_c'],
+                              exceptions.HyperVPortNotFoundException)
+
+        self.assertEqual(set(ports.values()),
+                         set(mock_get_ports_acls.call_args[0][0]))
+        mock_remove_acls.assert_has_calls(
+            [mock.call(ports['port_a'], mock.sentinel.remove_rules,
+                       mock.sentinel.port_a_acls),
+             mock.call(ports['port_b'], mock.sentinel.remove_rules, [])],
+            any_order=True)
+        mock_bind_rules.assert_has_calls(
+            [mock.call(port, mock.sentinel.add_rules,
+                       mock.sentinel.remaining_acls)
+             for port in ports.values()],
+            any_order=True)
+
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_switch_port_instance_id')
+    def test_get_ports_security_acls(self, mock_get_port_instance_id):
+        self.netutils._ACL_QUERY_BATCH_SIZE = 2
+        mock_ports = [mock.Mock(InstanceID='port_id_%d' % idx)
+                      for idx in range(3)]
+        mock_acl = mock.Mock(InstanceID=mock.sentinel.acl_id)
+        mock_other_acl = mock.Mock(InstanceID=mock.sentinel.other_acl_id)
+        conn = self.netutils._conn
+        conn.query.side_effect = [[mock_acl, mock_other_acl], []]
+        mock_get_port_instance_id.side_effect = ['port_id_0',
+                                                 mock.sentinel.other_port_id]
+
+        acls = self.netutils._get_ports_security_acls(mock_ports)
+
+        expected_acls = {'port_id_0': [mock_acl],
+                         'port_id_1': [],
+                         'port_id_2': []}
+        self.assertEqual(expected_acls, acls)
+        conn.query.assert_has_calls([
+            mock.call("SELECT * FROM %s WHERE InstanceID LIKE 'port_id_0%%' "
+                      "OR InstanceID LIKE 'port_id_1%%'" %
+                      self.netutils._PORT_EXT_ACL_SET_DATA),
+            mock.call("SELECT * FROM %s WHERE InstanceID LIKE 'port_id_2%%'" %
+                      self.netutils._PORT_EXT_ACL_SET_DATA)])
+
+    def test_get_ports_security_acls_no_ports(self):
+        acls = self.netutils._get_ports_security_acls([])
+
+        self.assertEqual({}, acls)
+        self.assertFalse(self.netutils._conn.query.called)
 
     @mock.patch.object(_wqlutils, 'get_element_associated_class')
     def test_remove_all_security_rules(self, mock_get_elem_assoc_cls):
@@ -972,9 +1291,6 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_acl = mock.MagicMock()
         mock_get_elem_assoc_cls.return_value = [mock_acl]
 
-        self.netutils._filter_security_acls = mock.MagicMock(
-            return_value=[mock_acl])
-
         return (mock_port, mock_acl)
 
     def test_filter_acls(self):
@@ -1009,9 +1325,12 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self.netutils._bandwidth_sds = {
             mock_port_alloc.InstanceID: mock.sentinel.InstanceID}
-        mock_remove_feature = self.netutils._jobutils.remove_virt_feature
+        mock_remove_feature = (
+            self.netutils._jobutils.remove_multiple_virt_features)
         mock_add_feature = self.netutils._jobutils.add_virt_feature
-        mock_add_feature.side_effect = exceptions.HyperVException
+        mock_modify_feature = (
+            self.netutils._jobutils.modify_multiple_virt_features)
+        mock_modify_feature.side_effect = exceptions.HyperVException
 
         qos_rule = dict(min_kbps=20000, max_kbps=30000,
                         max_burst_kbps=40000, max_burst_size_kb=50000)
@@ -1023,12 +1342,12 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_get_bandwidth_sd.assert_called_once_with(mock_port_alloc)
         mock_get_default_sd.assert_called_once_with(
             self.netutils._PORT_BANDWIDTH_SET_DATA)
-        mock_remove_feature.assert_called_once_with(
-            mock_get_bandwidth_sd.return_value)
-        mock_add_feature.assert_called_once_with(
-            mock_get_default_sd.return_value, mock_port_alloc)
+        mock_modify_feature.assert_called_once_with(
+            [mock_get_bandwidth_sd.return_value])
+        self.assertFalse(mock_remove_feature.called)
+        self.assertFalse(mock_add_feature.called)
 
-        bw = mock_get_default_sd.return_value
+        bw = mock_get_bandwidth_sd.return_value
         self.assertEqual(qos_rule['min_kbps'] * units.Ki,
                          bw.Reservation)
         self.assertEqual(qos_rule['max_kbps'] * units.Ki,
@@ -1040,6 +1359,117 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         self.assertNotIn(mock_port_alloc.InstanceID,
                          self.netutils._bandwidth_sds)
 
+    @ddt.data(True, False)
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_bandwidth_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_default_setting_data')
+    def test_set_port_qos_rule_modify_unsupported(self, known_unsupported,
+                                                  mock_get_default_sd,
+                                                  mock_get_bandwidth_sd):
+        mock_port_alloc = self._mock_get_switch_port_alloc()
+        mock_bandwidth = mock_get_bandwidth_sd.return_value
+        self.netutils._bandwidth_sds = {
+            mock_port_alloc.InstanceID: mock_bandwidth}
+        mock_modify_feature = (
+            self.netutils._jobutils.modify_multiple_virt_features)
+        mock_modify_feature.side_effect = exceptions.WMIJobFailed(
+            error_code=self.netutils._QOS_MODIFY_NOT_SUPPORTED_ERR_CODES[0],
+            job_state=None, error_summ_desc=None, error_desc=None)
+        qos_rule = dict(min_kbps=20000)
+
+        with mock.patch.dict(self.netutils._qos_modify_unsupported,
+                             {self.netutils._host: known_unsupported},
+                             clear=True):
+            self.netutils.set_port_qos_rule(mock.sentinel.port_id, qos_rule)
+
+            self.assertTrue(
+                self.netutils._qos_modify_unsupported[self.netutils._host])
+
+        if known_unsupported:
+            self.assertFalse(mock_modify_feature.called)
+        else:
+            mock_modify_feature.assert_called_once_with([mock_bandwidth])
+        mock_remove_features = (
+            self.netutils._jobutils.remove_multiple_virt_features)
+        mock_remove_features.assert_called_once_with([mock_bandwidth])
+        mock_add_feature = self.netutils._jobutils.add_virt_feature
+        mock_add_feature.assert_called_once_with(
+            mock_get_default_sd.return_value, mock_port_alloc)
+        self.assertEqual(qos_rule['min_kbps'] * units.Ki,
+                         mock_get_default_sd.return_value.Reservation)
+        self.assertEqual({}, self.netutils._bandwidth_sds)
+
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_bandwidth_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils, '_prepare_bandwidth_sd')
+    def test_set_port_qos_rule_unchanged(self, mock_prepare_bandwidth_sd,
+                                         mock_get_bandwidth_sd):
+        self._mock_get_switch_port_alloc()
+        mock_new_bandwidth = mock_prepare_bandwidth_sd.return_value
+        mock_get_bandwidth_sd.return_value = mock.Mock(
+            Reservation=mock_new_bandwidth.Reservation,
+            Limit=mock_new_bandwidth.Limit,
+            BurstLimit=mock_new_bandwidth.BurstLimit,
+            BurstSize=mock_new_bandwidth.BurstSize)
+
+        self.netutils.set_port_qos_rule(mock.sentinel.port_id,
+                                        mock.sentinel.qos_rule)
+
+        self.assertFalse(
+            self.netutils._jobutils.modify_multiple_virt_features.called)
+        self.assertFalse(self.netutils._jobutils.add_virt_feature.called)
+
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_bandwidth_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_switch_port_allocation')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_default_setting_data', mock.MagicMock())
+    def test_set_port_qos_rules(self, mock_get_port_alloc,
+                                mock_get_bandwidth_sd):
+        mock_ports = {
+            port_id: mock.Mock(InstanceID=port_id + '_instance_id')
+            for port_id in ('modified', 'added', 'failed')}
+        mock_bandwidth_sds = {
+            'modified': mock.Mock(),
+            'added': None,
+            'failed': None}
+        mock_get_port_alloc.side_effect = lambda port_id: (
+            mock_ports[port_id], True)
+        mock_get_bandwidth_sd.side_effect = lambda port_alloc: (
+            mock_bandwidth_sds[port_alloc.InstanceID[:-12]])
+
+        def fake_add_feature(new_bandwidth, port_alloc):
+            if port_alloc is mock_ports['failed']:
+                raise exceptions.HyperVException('0x80070057')
+
+        mock_add_feature = self.netutils._jobutils.add_virt_feature
+        mock_add_feature.side_effect = fake_add_feature
+        qos_rule = dict(min_kbps=20000)
+        port_qos_rules = {port_id: qos_rule for port_id in mock_ports}
+        port_qos_rules['invalid'] = dict(min_kbps=1)
+        port_qos_rules['empty'] = {}
+
+        results = self.netutils.set_port_qos_rules(port_qos_rules)
+
+        self.assertEqual(set(port_qos_rules), set(results))
+        for port_id in ('modified', 'added', 'empty'):
+            self.assertIsNone(results[port_id])
+        for port_id in ('invalid', 'failed'):
+            self.assertIsInstance(results[port_id],
+                                  exceptions.InvalidParameterValue)
+
+        mock_modify_feature = (
+            self.netutils._jobutils.modify_multiple_virt_features)
+        mock_modify_feature.assert_called_once_with(
+            [mock_bandwidth_sds['modified']])
+        mock_add_feature.assert_has_calls(
+            [mock.call(mock.ANY, mock_ports['added']),
+             mock.call(mock.ANY, mock_ports['failed'])],
+            any_order=True)
+        self.assertEqual(2, mock_add_feature.call_count)
+
     @ddt.data({'min_kbps': 100},
               {'min_kbps': 10 * units.Ki, 'max_kbps': 100},
               {'max_kbps': 10 * units.Ki, 'max_burst_kbps': 100})
@@ -1056,6 +1486,7 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
     def test_set_port_qos_rule_invalid_qos_rule_exc(self, mock_get_default_sd,
                                                     mock_get_bandwidth_sd):
         self._mock_get_switch_port_alloc()
+        mock_get_bandwidth_sd.return_value = None
 
         mock_add_feature = self.netutils._jobutils.add_virt_feature
         mock_add_feature.side_effect = exceptions.InvalidParameterValue(
@@ -1087,6 +1518,181 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_remove_feature.assert_called_once_with(
             mock_bandwidth_settings)
 
+    def test_apply_port_config_unknown_key(self):
+        self.assertRaises(exceptions.InvalidParameterValue,
+                          self.netutils.apply_port_config,
+                          mock.sentinel.port_name,
+                          dict(fake_feature=mock.sentinel.value))
+
+    @mock.patch.object(networkutils.NetworkUtils, 'connect_vnic_to_vswitch')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_security_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_vlan_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_new_vlan_sd')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_new_security_sd')
+    def test_apply_port_config(self, mock_get_new_security_sd,
+                               mock_get_new_vlan_sd, mock_get_vlan_sd,
+                               mock_get_security_sd, mock_connect_vnic):
+        mock_port_alloc = self._mock_get_switch_port_alloc()
+        self.netutils._vlan_sds[mock_port_alloc.InstanceID] = (
+            mock.sentinel.vlan_sd)
+        mock_get_vlan_sd.return_value = mock.sentinel.vlan_sd
+        mock_get_new_vlan_sd.return_value = mock.sentinel.new_vlan_sd
+        # The security settings are already configured.
+        mock_get_new_security_sd.return_value = None
+
+        desired = dict(vswitch_name=mock.sentinel.vswitch_name,
+                       vlan=dict(vlan_id=mock.sentinel.vlan_id),
+                       security=dict(VirtualSubnetId=mock.sentinel.vsid))
+        updated = self.netutils.apply_port_config(mock.sentinel.port_name,
+                                                  desired)
+
+        self.assertEqual(['vlan'], updated)
+        mock_connect_vnic.assert_called_once_with(mock.sentinel.vswitch_name,
+                                                  mock.sentinel.port_name)
+        mock_get_new_vlan_sd.assert_called_once_with(
+            mock.sentinel.vlan_sd, desired['vlan'])
+        mock_get_new_security_sd.assert_called_once_with(
+            mock_get_security_sd.return_value, desired['security'])
+        mock_remove_features = (
+            self.netutils._jobutils.remove_multiple_virt_features)
+        mock_remove_features.assert_called_once_with([mock.sentinel.vlan_sd])
+        mock_add_features = self.netutils._jobutils.add_multiple_virt_features
+        mock_add_features.assert_called_once_with(
+            [mock.sentinel.new_vlan_sd], mock_port_alloc)
+        self.assertNotIn(mock_port_alloc.InstanceID, self.netutils._vlan_sds)
+        # The VLAN settings are checked once again after being added.
+        mock_get_vlan_sd.assert_has_calls([mock.call(mock_port_alloc)] * 2)
+
+    @ddt.data('vlan', 'security')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_security_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_vlan_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_new_vlan_sd')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_new_security_sd')
+    def test_apply_port_config_missing_feature(self, feature,
+                                               mock_get_new_security_sd,
+                                               mock_get_new_vlan_sd,
+                                               mock_get_vlan_sd,
+                                               mock_get_security_sd):
+        mock_port_alloc = self._mock_get_switch_port_alloc()
+        get_sd = dict(vlan=mock_get_vlan_sd,
+                      security=mock_get_security_sd)[feature]
+        # The feature is missing after being added.
+        get_sd.side_effect = [None, None]
+
+        desired = {feature: dict(fake_arg=mock.sentinel.value)}
+        self.assertRaises(exceptions.HyperVException,
+                          self.netutils.apply_port_config,
+                          mock.sentinel.port_name, desired)
+
+        mock_add_features = self.netutils._jobutils.add_multiple_virt_features
+        self.assertEqual(1, mock_add_features.call_count)
+        get_sd.assert_has_calls([mock.call(mock_port_alloc)] * 2)
+
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_bandwidth_setting_data_from_port_alloc')
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_get_profile_setting_data_from_port_alloc')
+    def test_apply_port_config_remove(self, mock_get_profile_sd,
+                                      mock_get_bandwidth_sd):
+        mock_port_alloc = self._mock_get_switch_port_alloc()
+        mock_get_profile_sd.return_value = None
+
+        updated = self.netutils.apply_port_config(
+            mock.sentinel.port_name, dict(profile=None, qos_rule=None))
+
+        self.assertEqual(['qos_rule'], updated)
+        mock_get_profile_sd.assert_called_once_with(mock_port_alloc)
+        mock_remove_features = (
+            self.netutils._jobutils.remove_multiple_virt_features)
+        mock_remove_features.assert_called_once_with(
+            [mock_get_bandwidth_sd.return_value])
+        self.assertFalse(
+            self.netutils._jobutils.add_multiple_virt_features.called)
+
+    @ddt.data(True, False)
+    @mock.patch.object(networkutils.NetworkUtils, '_prepare_profile_sd')
+    def test_get_new_profile_sd(self, unchanged, mock_prepare_profile_sd):
+        mock_new_profile = mock_prepare_profile_sd.return_value
+        mock_new_profile.ProfileId = mock.sentinel.profile_id
+        mock_profile = mock.Mock(
+            ProfileId=(mock.sentinel.profile_id if unchanged
+                       else mock.sentinel.other_profile_id))
+        profile_args = dict(profile_id=mock.sentinel.profile_id,
+                            profile_name=None)
+
+        new_profile = self.netutils._get_new_profile_sd(mock_profile,
+                                                        profile_args)
+
+        mock_prepare_profile_sd.assert_called_once_with(**profile_args)
+        expected_profile = None if unchanged else mock_new_profile
+        self.assertEqual(expected_profile, new_profile)
+
+    @mock.patch.object(networkutils.NetworkUtils, '_prepare_vlan_sd')
+    def test_get_new_vlan_sd(self, mock_prepare_vlan_sd):
+        new_vlan_sd = self.netutils._get_new_vlan_sd(
+            mock.sentinel.vlan_sd,
+            dict(vlan_id=mock.sentinel.vlan_id,
+                 operation_mode=constants.VLAN_MODE_TRUNK,
+                 trunk_vlans=mock.sentinel.trunk_vlans))
+
+        self.assertEqual(mock_prepare_vlan_sd.return_value, new_vlan_sd)
+        mock_prepare_vlan_sd.assert_called_once_with(
+            mock.sentinel.vlan_sd, mock.sentinel.vlan_id,
+            constants.VLAN_MODE_TRUNK, mock.sentinel.trunk_vlans)
+
+    def test_get_new_vlan_sd_invalid_mode(self):
+        self.assertRaises(AttributeError,
+                          self.netutils._get_new_vlan_sd,
+                          mock.sentinel.vlan_sd,
+                          dict(vlan_id=mock.sentinel.vlan_id,
+                               operation_mode=mock.sentinel.invalid_mode))
+
+    def test_get_new_security_sd_unchanged(self):
+        mock_sec_sd = mock.Mock(VirtualSubnetId=mock.sentinel.vsid)
+
+        new_sec_sd = self.netutils._get_new_security_sd(
+            mock_sec_sd, dict(VirtualSubnetId=mock.sentinel.vsid))
+
+        self.assertIsNone(new_sec_sd)
+
+    @ddt.data(True, False)
+    @mock.patch.object(networkutils.NetworkUtils,
+                       '_create_default_setting_data')
+    def test_get_new_security_sd(self, existing_sd, mock_create_default_sd):
+        mock_sec_sd = mock.Mock(VirtualSubnetId=mock.sentinel.old_vsid)
+
+        new_sec_sd = self.netutils._get_new_security_sd(
+            mock_sec_sd if existing_sd else None,
+            dict(VirtualSubnetId=mock.sentinel.vsid))
+
+        expected_sd = (mock_sec_sd if existing_sd
+                       else mock_create_default_sd.return_value)
+        self.assertEqual(expected_sd, new_sec_sd)
+        self.assertEqual(mock.sentinel.vsid, new_sec_sd.VirtualSubnetId)
+
+    @ddt.data(True, False)
+    @mock.patch.object(networkutils.NetworkUtils, '_prepare_bandwidth_sd')
+    def test_get_new_bandwidth_sd(self, unchanged, mock_prepare_bandwidth_sd):
+        mock_new_bandwidth = mock_prepare_bandwidth_sd.return_value
+        mock_bandwidth = mock.Mock(
+            Reservation=mock_new_bandwidth.Reservation,
+            Limit=mock_new_bandwidth.Limit,
+            BurstLimit=mock_new_bandwidth.BurstLimit,
+            BurstSize=(mock_new_bandwidth.BurstSize if unchanged
+                       else mock.sentinel.burst_size))
+
+        new_bandwidth = self.netutils._get_new_bandwidth_sd(
+            mock_bandwidth, mock.sentinel.qos_rule)
+
+        mock_prepare_bandwidth_sd.assert_called_once_with(
+            mock.sentinel.qos_rule)
+        expected_bandwidth = None if unchanged else mock_new_bandwidth
+        self.assertEqual(expected_bandwidth, new_bandwidth)
+
     @mock.patch.object(networkutils.NetworkUtils,
                        '_create_default_setting_data')
     def test_prepare_profile_sd(self, mock_create_default_sd):
@@ -1129,6 +1735,7 @@ class NetworkUtilsTestCase(test_base.OsWinBaseTestCase):
                           invalid_argument=mock.sentinel.invalid_argument)
 
 
+@ddt.ddt
 class TestNetworkUtilsR2(test_base.OsWinBaseTestCase):
 
     def setUp(self):
@@ -1194,3 +1801,59 @@ class TestNetworkUtilsR2(test_base.OsWinBaseTestCase):
                                                 [mockacl1, mockacl2])
 
         self.assertEqual([self.netutils._MAX_WEIGHT - 2], actual)
+
+    def test_get_new_weights_deny_above_reject_count(self):
+        mock_rule = mock.MagicMock(Action=self.netutils._ACL_ACTION_DENY)
+        mock_acls = [
+            mock.MagicMock(Action=self.netutils._ACL_ACTION_DENY, Weight=i)
+            for i in range(1, self.netutils._REJECT_ACLS_COUNT)]
+
+        actual = self.netutils._get_new_weights([mock_rule, mock_rule],
+                                                mock_acls)
+
+        self.assertEqual([self.netutils._REJECT_ACLS_COUNT,
+                          self.netutils._REJECT_ACLS_COUNT + 1], actual)
+
+    @ddt.data(networkutils.NetworkUtilsR2._ACL_ACTION_DENY,
+              networkutils.NetworkUtilsR2._ACL_ACTION_ALLOW)
+    def test_get_new_weights_exhausted(self, action):
+        self.netutils._enable_cache = True
+        self.netutils._sg_acl_weights = {}
+        self.netutils._MAX_WEIGHT = 4
+        mock_port = mock.MagicMock()
+        mock_rule = mock.MagicMock(Action=action)
+        mock_acls = [mock.MagicMock(Action=action, Weight=2)]
+
+        self.assertRaises(exceptions.HyperVException,
+                          self.netutils._get_new_weights,
+                          [mock_rule] * 3, mock_acls, mock_port)
+
+        # The partially allocated weights are released.
+        weight_allocator = self.netutils._sg_acl_weights[
+            mock_port.ElementName]
+        for weight in (1, 3):
+            self.assertFalse(weight_allocator.is_used(action, weight))
+
+    @ddt.data(True, False)
+    def test_get_new_weights_cached_allocator(self, enable_cache):
+        self.netutils._enable_cache = enable_cache
+        self.netutils._sg_acl_weights = {}
+        mock_port = mock.MagicMock()
+        mock_rule = mock.MagicMock(Action=self.netutils._ACL_ACTION_ALLOW)
+        mockacl = mock.MagicMock(Action=self.netutils._ACL_ACTION_ALLOW,
+                                 Weight=self.netutils._MAX_WEIGHT - 1)
+
+        first = self.netutils._get_new_weights([mock_rule], [mockacl],
+                                               mock_port)
+        # The ACL added previously is not passed, the cached allocator
+        # being expected to keep track of it.
+        second = self.netutils._get_new_weights([mock_rule], [mockacl],
+                                                mock_port)
+
+        self.assertEqual([self.netutils._MAX_WEIGHT - 2], first)
+        expected_weight = (self.netutils._MAX_WEIGHT -
+                           (3 if enable_cache else 2))
+        self.assertEqual([expected_weight], second)
+        self.assertEqual(
+            enable_cache,
+            mock_port.ElementName in self.netutils._sg_acl_weights)
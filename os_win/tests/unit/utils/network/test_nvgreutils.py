@@ -163,6 +163,33 @@ class TestNvgreUtils(test_base.OsWinBaseTestCase):
             Metric=255,
             RoutingDomainID='{%s}' % self._FAKE_RDID)
 
+    @mock.patch.object(nvgreutils.NvgreUtils, 'create_customer_route')
+    def test_sync_customer_routes(self, mock_create_route):
+        cls = self.utils._scimv2.MSFT_NetVirtualizationCustomerRouteSettingData
+        existing_route = mock.Mock(DestinationPrefix=self._FAKE_DEST_PREFIX,
+                                   NextHop=self._FAKE_GW,
+                                   RoutingDomainID='{%s}' % self._FAKE_RDID)
+        duplicate_route = mock.Mock(**{
+            attr: getattr(existing_route, attr)
+            for attr in ('DestinationPrefix', 'NextHop', 'RoutingDomainID')})
+        obsolete_route = mock.Mock(DestinationPrefix=self._FAKE_DEST_PREFIX,
+                                   NextHop=self._FAKE_GW_BAD,
+                                   RoutingDomainID='{%s}' % self._FAKE_RDID)
+        cls.return_value = [existing_route, duplicate_route, obsolete_route]
+
+        self.utils.sync_customer_routes(
+            mock.sentinel.vsid,
+            [(self._FAKE_DEST_PREFIX, self._FAKE_GW, self._FAKE_RDID.upper()),
+             (mock.sentinel.dest_prefix, self._FAKE_GW, self._FAKE_RDID)])
+
+        cls.assert_called_once_with(VirtualSubnetID=mock.sentinel.vsid)
+        self.assertFalse(existing_route.Delete_.called)
+        duplicate_route.Delete_.assert_called_once_with()
+        obsolete_route.Delete_.assert_called_once_with()
+        mock_create_route.assert_called_once_with(
+            mock.sentinel.vsid, mock.sentinel.dest_prefix, self._FAKE_GW,
+            self._FAKE_RDID)
+
     def _check_create_lookup_record(self, customer_addr, expected_type):
         lookup = mock.MagicMock()
         scimv2 = self.utils._scimv2
@@ -208,6 +235,46 @@ class TestNvgreUtils(test_base.OsWinBaseTestCase):
                                         mock.sentinel.fake_vsid)
         self.assertFalse(obj_class.new.called)
 
+    @mock.patch.object(nvgreutils.NvgreUtils, '_create_lookup_record')
+    def test_sync_lookup_records(self, mock_create_lookup_record):
+        def fake_lookup_record(customer_addr, vsid=None,
+                               provider_addr=mock.sentinel.provider_addr,
+                               mac=mock.sentinel.mac_addr):
+            return mock.Mock(CustomerAddress=customer_addr,
+                             VirtualSubnetID=vsid or self._FAKE_VSID,
+                             ProviderAddress=provider_addr,
+                             MACAddress=mac)
+
+        unchanged = fake_lookup_record(mock.sentinel.customer_addr)
+        duplicate = fake_lookup_record(mock.sentinel.customer_addr)
+        outdated = fake_lookup_record(mock.sentinel.other_customer_addr,
+                                      mac=mock.sentinel.old_mac_addr)
+        obsolete = fake_lookup_record(mock.sentinel.old_customer_addr)
+        other_vsid = fake_lookup_record(mock.sentinel.customer_addr,
+                                        vsid=mock.sentinel.other_vsid)
+        lrecs = [unchanged, duplicate, outdated, obsolete, other_vsid]
+        scimv2 = self.utils._scimv2
+        obj_class = scimv2.MSFT_NetVirtualizationLookupRecordSettingData
+        obj_class.return_value = lrecs
+
+        desired_records = [
+            (mock.sentinel.provider_addr, mock.sentinel.customer_addr,
+             mock.sentinel.mac_addr, self._FAKE_VSID),
+            (mock.sentinel.provider_addr, mock.sentinel.other_customer_addr,
+             mock.sentinel.mac_addr, self._FAKE_VSID),
+            (mock.sentinel.provider_addr, mock.sentinel.new_customer_addr,
+             mock.sentinel.mac_addr, self._FAKE_VSID)]
+        self.utils.sync_lookup_records(desired_records)
+
+        obj_class.assert_called_once_with()
+        for lrec in (duplicate, outdated, obsolete):
+            lrec.Delete_.assert_called_once_with()
+        for lrec in (unchanged, other_vsid):
+            self.assertFalse(lrec.Delete_.called)
+        mock_create_lookup_record.assert_has_calls(
+            [mock.call(*record) for record in desired_records[1:]])
+        self.assertEqual(2, mock_create_lookup_record.call_count)
+
     def test_get_network_iface_index_cached(self):
         self.utils._net_if_indexes[mock.sentinel.fake_network] = (
             mock.sentinel.iface_index)
@@ -0,0 +1,89 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win.tests.unit import test_base
+from os_win.utils.network import _wmi_object_cache
+
+
+class WMIObjectCacheTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMI object cache."""
+
+    def setUp(self):
+        super(WMIObjectCacheTestCase, self).setUp()
+        self._cache = _wmi_object_cache.WMIObjectCache(max_size=2)
+
+    def test_get(self):
+        self._cache['key'] = mock.sentinel.value
+
+        self.assertEqual(mock.sentinel.value, self._cache.get('key'))
+        self.assertEqual(mock.sentinel.value, self._cache['key'])
+        self.assertIsNone(self._cache.get('missing_key'))
+        self.assertRaises(KeyError, self._cache.__getitem__, 'missing_key')
+        self.assertIn('key', self._cache)
+
+        stats = self._cache.get_stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['size'])
+
+    def test_lru_eviction(self):
+        self._cache['key1'] = mock.sentinel.value1
+        self._cache['key2'] = mock.sentinel.value2
+        # Mark the first entry as recently used.
+        self._cache.get('key1')
+        self._cache['key3'] = mock.sentinel.value3
+
+        self.assertNotIn('key2', self._cache)
+        self.assertEqual([mock.sentinel.value1, mock.sentinel.value3],
+                         self._cache.values())
+        self.assertEqual(1, self._cache.get_stats()['evictions'])
+
+    def test_configure(self):
+        self._cache['key1'] = mock.sentinel.value1
+        self._cache['key2'] = mock.sentinel.value2
+
+        self._cache.configure(max_size=1)
+
+        self.assertEqual(1, len(self._cache))
+        self.assertIn('key2', self._cache)
+
+    @mock.patch('time.time')
+    def test_expiration(self, mock_time):
+        self._cache.configure(max_size=2, ttl=10)
+        mock_time.return_value = 100
+        self._cache['key'] = mock.sentinel.value
+
+        mock_time.return_value = 109
+        self.assertEqual(mock.sentinel.value, self._cache.get('key'))
+
+        mock_time.return_value = 110
+        self.assertIsNone(self._cache.get('key'))
+        self.assertEqual(0, len(self._cache))
+        self.assertEqual(1, self._cache.get_stats()['expirations'])
+
+    def test_pop(self):
+        self._cache['key'] = mock.sentinel.value
+
+        self.assertEqual(mock.sentinel.value, self._cache.pop('key'))
+        self.assertIsNone(self._cache.pop('key', None))
+        self.assertRaises(KeyError, self._cache.pop, 'key')
+
+    def test_clear(self):
+        self._cache['key'] = mock.sentinel.value
+        self._cache.clear()
+
+        self.assertEqual(0, len(self._cache))
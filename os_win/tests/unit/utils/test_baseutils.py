@@ -12,9 +12,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import ddt
 import mock
 import six
 
+from os_win import exceptions
 from os_win.tests.unit import test_base
 from os_win.utils import baseutils
 
@@ -22,11 +24,17 @@ from os_win.utils import baseutils
 class BaseUtilsTestCase(test_base.OsWinBaseTestCase):
     """Unit tests for the os-win BaseUtils class."""
 
+    _FAKE_MONIKER = '//fakehost/root/fake'
+
     def setUp(self):
         super(BaseUtilsTestCase, self).setUp()
         self.utils = baseutils.BaseUtils()
         self.utils._conn = mock.MagicMock()
 
+        self._pool = baseutils.BaseUtils._WMI_CONN_POOL
+        self._pool.clear()
+        self.addCleanup(self._pool.clear)
+
     @mock.patch.object(baseutils, 'wmi', create=True)
     def test_get_wmi_obj(self, mock_wmi):
         result = self.utils._get_wmi_obj(mock.sentinel.moniker)
@@ -38,31 +46,78 @@ class BaseUtilsTestCase(test_base.OsWinBaseTestCase):
     @mock.patch.object(baseutils, 'sys')
     def _check_get_wmi_conn(self, mock_sys, mock_get_wmi_obj, **kwargs):
         mock_sys.platform = 'win32'
-        result = self.utils._get_wmi_conn(mock.sentinel.moniker, **kwargs)
+        result = self.utils._get_wmi_conn(self._FAKE_MONIKER, **kwargs)
 
         self.assertEqual(mock_get_wmi_obj.return_value, result)
-        mock_get_wmi_obj.assert_called_once_with(mock.sentinel.moniker,
+        mock_get_wmi_obj.assert_called_once_with(self._FAKE_MONIKER,
                                                  **kwargs)
 
     def test_get_wmi_conn_kwargs(self):
-        self.utils._WMI_CONS.clear()
-        self._check_get_wmi_conn(privileges=mock.sentinel.privileges)
-        self.assertNotIn(mock.sentinel.moniker, baseutils.BaseUtils._WMI_CONS)
+        self._check_get_wmi_conn(privileges=["Shutdown"])
+
+        conn_key = self._pool.get_conn_key(self._FAKE_MONIKER,
+                                           privileges=["Shutdown"])
+        self.assertIn(conn_key, self._pool)
+        self.assertNotIn(self._pool.get_conn_key(self._FAKE_MONIKER),
+                         self._pool)
 
     def test_get_wmi_conn(self):
         self._check_get_wmi_conn()
-        self.assertIn(mock.sentinel.moniker, baseutils.BaseUtils._WMI_CONS)
+        self.assertIn(self._pool.get_conn_key(self._FAKE_MONIKER),
+                      self._pool)
 
     @mock.patch.object(baseutils.BaseUtils, '_get_wmi_obj')
     @mock.patch.object(baseutils, 'sys')
     def test_get_wmi_conn_cached(self, mock_sys, mock_get_wmi_obj):
         mock_sys.platform = 'win32'
-        baseutils.BaseUtils._WMI_CONS[mock.sentinel.moniker] = (
-            mock.sentinel.conn)
-        result = self.utils._get_wmi_conn(mock.sentinel.moniker)
+        first_conn = self.utils._get_wmi_conn(self._FAKE_MONIKER)
+        result = self.utils._get_wmi_conn(r'\\FakeHost\Root\Fake')
+
+        self.assertEqual(first_conn, result)
+        mock_get_wmi_obj.assert_called_once_with(self._FAKE_MONIKER)
+
+    @mock.patch.object(baseutils.BaseUtils, '_get_wmi_obj')
+    @mock.patch.object(baseutils, 'sys')
+    def test_get_pooled_wmi_conn(self, mock_sys, mock_get_wmi_obj):
+        mock_sys.platform = 'win32'
+        conn = self.utils._get_pooled_wmi_conn(self._FAKE_MONIKER)
+
+        result = conn.Msvm_Fake.new(fake_prop=mock.sentinel.value)
+
+        mock_conn = mock_get_wmi_obj.return_value
+        self.assertEqual(mock_conn.Msvm_Fake.new.return_value, result)
+        self.assertIs(mock_conn, conn.get_wrapped_conn())
+        mock_get_wmi_obj.assert_called_once_with(self._FAKE_MONIKER)
+
+    @mock.patch.object(baseutils.BaseUtils, '_get_wmi_obj')
+    @mock.patch.object(baseutils, 'sys')
+    def test_get_pooled_wmi_conn_rpc_failure(self, mock_sys,
+                                             mock_get_wmi_obj):
+        mock_sys.platform = 'win32'
+        mock_conn = mock.Mock()
+        mock_conn.query.side_effect = test_base.FakeWMIExc(
+            hresult=baseutils._utils._RPC_FAILURE_HRESULTS[0])
+        mock_get_wmi_obj.side_effect = [mock_conn, mock.sentinel.new_conn]
+        conn = self.utils._get_pooled_wmi_conn(self._FAKE_MONIKER)
+
+        self.assertRaises(test_base.FakeWMIExc,
+                          conn.query, mock.sentinel.query)
+        self.assertEqual(0, len(self._pool))
+        self.assertEqual(mock.sentinel.new_conn, conn.get_wrapped_conn())
 
-        self.assertEqual(mock.sentinel.conn, result)
-        self.assertFalse(mock_get_wmi_obj.called)
+    @mock.patch.object(baseutils.BaseUtils, '_get_wmi_obj')
+    @mock.patch.object(baseutils, 'sys')
+    def test_get_pooled_wmi_conn_unrelated_exc(self, mock_sys,
+                                               mock_get_wmi_obj):
+        mock_sys.platform = 'win32'
+        mock_conn = mock_get_wmi_obj.return_value
+        mock_conn.query.side_effect = test_base.FakeWMIExc(
+            hresult=mock.sentinel.hresult)
+        conn = self.utils._get_pooled_wmi_conn(self._FAKE_MONIKER)
+
+        self.assertRaises(test_base.FakeWMIExc,
+                          conn.query, mock.sentinel.query)
+        self.assertEqual(1, len(self._pool))
 
     @mock.patch.object(baseutils, 'sys')
     def test_get_wmi_conn_linux(self, mock_sys):
@@ -71,7 +126,99 @@ class BaseUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self.assertIsNone(result)
 
+    @mock.patch.dict(baseutils.BaseUtils._wmi_event_hubs, clear=True)
+    @mock.patch.object(baseutils._wmi_event_hub, 'WMIEventHub')
+    @mock.patch.object(baseutils.BaseUtils, '_get_wmi_conn')
+    def test_get_wmi_event_hub(self, mock_get_wmi_conn, mock_hub_cls):
+        hub = self.utils._get_wmi_event_hub(self._FAKE_MONIKER)
+        # Equivalent monikers share the same hub.
+        same_hub = self.utils._get_wmi_event_hub(
+            self._FAKE_MONIKER.replace('/', '\\'))
+
+        self.assertEqual(mock_hub_cls.return_value, hub)
+        self.assertIs(hub, same_hub)
+        mock_get_wmi_conn.assert_called_once_with(self._FAKE_MONIKER)
+        mock_hub_cls.assert_called_once_with(mock_get_wmi_conn.return_value)
+
+
+class WMIConnectionPoolTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the os-win WMI connection pool."""
+
+    def setUp(self):
+        super(WMIConnectionPoolTestCase, self).setUp()
+        self._pool = baseutils.WMIConnectionPool(max_size=2,
+                                                 probe_interval=60)
+        self._conn_factory = mock.Mock(
+            side_effect=lambda: mock.Mock(name='conn'))
+
+    def test_get_conn_key(self):
+        expected = ('.', 'root/cimv2', (('privileges', ('Shutdown', )), ))
+
+        for moniker in ['//./root/cimv2', r'\\localhost\root\CIMV2',
+                        'root/cimv2']:
+            key = self._pool.get_conn_key(moniker, privileges=['Shutdown'])
+            self.assertEqual(expected, key)
+
+    def test_get_cached(self):
+        conn = self._pool.get(mock.sentinel.key, self._conn_factory)
+        self.assertIs(conn, self._pool.get(mock.sentinel.key,
+                                           self._conn_factory))
+        self._conn_factory.assert_called_once_with()
+        self.assertFalse(conn.query.called)
+
+    @mock.patch.object(baseutils.time, 'time')
+    def test_get_stale_conn(self, mock_time):
+        mock_time.return_value = 0
+        conn = self._pool.get(mock.sentinel.key, self._conn_factory)
+        conn.query.side_effect = exceptions.x_wmi
+
+        mock_time.return_value = 61
+        new_conn = self._pool.get(mock.sentinel.key, self._conn_factory)
+
+        self.assertIsNot(conn, new_conn)
+        conn.query.assert_called_once_with(self._pool._PROBE_QUERY)
+
+    @mock.patch.object(baseutils.time, 'time')
+    def test_get_probed_conn(self, mock_time):
+        mock_time.return_value = 0
+        conn = self._pool.get(mock.sentinel.key, self._conn_factory)
 
+        mock_time.return_value = 61
+        self.assertIs(conn, self._pool.get(mock.sentinel.key,
+                                           self._conn_factory))
+        conn.query.assert_called_once_with(self._pool._PROBE_QUERY)
+
+    def test_evict_lru(self):
+        self._pool.get(mock.sentinel.key_0, self._conn_factory)
+        self._pool.get(mock.sentinel.key_1, self._conn_factory)
+        # Recently used connections must not be evicted.
+        self._pool.get(mock.sentinel.key_0, self._conn_factory)
+        self._pool.get(mock.sentinel.key_2, self._conn_factory)
+
+        self.assertIn(mock.sentinel.key_0, self._pool)
+        self.assertNotIn(mock.sentinel.key_1, self._pool)
+        self.assertIn(mock.sentinel.key_2, self._pool)
+
+    def test_get_cache(self):
+        cache = self._pool.get_cache(mock.sentinel.key, self._conn_factory)
+        cache[mock.sentinel.cache_key] = mock.sentinel.value
+
+        self.assertIs(cache, self._pool.get_cache(mock.sentinel.key,
+                                                  self._conn_factory))
+
+        # The cache is discarded along with the connection.
+        self._pool.invalidate(mock.sentinel.key)
+        self.assertEqual({}, self._pool.get_cache(mock.sentinel.key,
+                                                  self._conn_factory))
+
+    def test_invalidate_replaced_conn(self):
+        self._pool.get(mock.sentinel.key, self._conn_factory)
+        self._pool.invalidate(mock.sentinel.key, mock.sentinel.old_conn)
+
+        self.assertIn(mock.sentinel.key, self._pool)
+
+
+@ddt.ddt
 class BaseUtilsVirtTestCase(test_base.OsWinBaseTestCase):
     """Unit tests for the os-win BaseUtilsVirt class."""
 
@@ -81,12 +228,13 @@ class BaseUtilsVirtTestCase(test_base.OsWinBaseTestCase):
         self.utils._conn_attr = mock.MagicMock()
         baseutils.BaseUtilsVirt._os_version = None
 
-    @mock.patch.object(baseutils.BaseUtilsVirt, '_get_wmi_conn')
-    def test_conn(self, mock_get_wmi_conn):
+    @mock.patch.object(baseutils.BaseUtilsVirt, '_get_pooled_wmi_conn')
+    def test_conn(self, mock_get_pooled_wmi_conn):
         self.utils._conn_attr = None
 
-        self.assertEqual(mock_get_wmi_conn.return_value, self.utils._conn)
-        mock_get_wmi_conn.assert_called_once_with(
+        self.assertEqual(mock_get_pooled_wmi_conn.return_value,
+                         self.utils._conn)
+        mock_get_pooled_wmi_conn.assert_called_once_with(
             self.utils._wmi_namespace % '.')
 
     def test_vs_man_svc(self):
@@ -97,6 +245,29 @@ class BaseUtilsVirtTestCase(test_base.OsWinBaseTestCase):
         self.assertEqual(expected, self.utils._vs_man_svc)
         self.assertEqual(expected, self.utils._vs_man_svc_attr)
 
+    def test_vs_man_svc_pooled_conn(self):
+        pool = baseutils.WMIConnectionPool()
+        conn_factory = mock.Mock(side_effect=mock.MagicMock)
+        self.utils._compat_conn_attr = baseutils._PooledWMIConnProxy(
+            pool, mock.sentinel.key, conn_factory)
+
+        vs_man_svc = self.utils._vs_man_svc
+        self.assertIs(vs_man_svc, self.utils._vs_man_svc)
+        self.assertIsNone(self.utils._vs_man_svc_attr)
+
+        conn = pool.get(mock.sentinel.key, conn_factory)
+        self.assertEqual(
+            conn.Msvm_VirtualSystemManagementService.return_value[0],
+            vs_man_svc)
+        conn.Msvm_VirtualSystemManagementService.assert_called_once_with()
+
+        # The service is fetched again after reconnecting.
+        pool.invalidate(mock.sentinel.key)
+        new_conn = pool.get(mock.sentinel.key, conn_factory)
+        self.assertEqual(
+            new_conn.Msvm_VirtualSystemManagementService.return_value[0],
+            self.utils._vs_man_svc)
+
     @mock.patch.object(baseutils, 'imp')
     @mock.patch.object(baseutils, 'wmi', create=True)
     def test_vs_man_svc_2012(self, mock_wmi, mock_imp):
@@ -135,6 +306,94 @@ class BaseUtilsVirtTestCase(test_base.OsWinBaseTestCase):
         result = self.utils._get_wmi_obj(mock.sentinel.moniker, True)
         self.assertEqual(mock_get_wmi_compat.return_value, result)
 
+    @ddt.data(None, mock.sentinel.res_sub_type)
+    @mock.patch.object(baseutils.BaseUtilsVirt, '_clone_wmi_obj')
+    def test_get_default_setting_data(self, res_sub_type, mock_clone):
+        self.utils._compat_conn_attr = mock.Mock()
+        mock_query = self.utils._compat_conn_attr.query
+        mock_query.return_value = [mock.sentinel.default_obj]
+
+        for idx in range(2):
+            new_obj = self.utils._get_default_setting_data(
+                mock.sentinel.class_name, res_sub_type)
+            self.assertEqual(mock_clone.return_value, new_obj)
+
+        if res_sub_type:
+            expected_query = ("SELECT * FROM sentinel.class_name "
+                              "WHERE ResourceSubType = "
+                              "'sentinel.res_sub_type' AND "
+                              "InstanceID LIKE '%\\Default'")
+        else:
+            expected_query = ("SELECT * FROM sentinel.class_name "
+                              "WHERE InstanceID LIKE '%\\Default'")
+        mock_query.assert_called_once_with(expected_query)
+        self.assertEqual([mock.call(mock.sentinel.default_obj)] * 2,
+                         mock_clone.call_args_list)
+
+        # Templates are cached per connection.
+        self.utils._compat_conn_attr = mock.Mock()
+        self.utils._compat_conn_attr.query.return_value = [
+            mock.sentinel.other_default_obj]
+        self.utils._get_default_setting_data(mock.sentinel.class_name,
+                                             res_sub_type)
+        self.utils._compat_conn_attr.query.assert_called_once_with(
+            expected_query)
+
+    @mock.patch.object(baseutils.BaseUtilsVirt, '_clone_wmi_obj')
+    def test_get_default_setting_data_pooled_conn(self, mock_clone):
+        pool = baseutils.WMIConnectionPool()
+        conn_factory = mock.Mock(side_effect=mock.MagicMock)
+        self.utils._compat_conn_attr = baseutils._PooledWMIConnProxy(
+            pool, mock.sentinel.key, conn_factory)
+
+        for idx in range(2):
+            self.utils._get_default_setting_data(mock.sentinel.class_name)
+
+        conn = pool.get(mock.sentinel.key, conn_factory)
+        conn.query.assert_called_once_with(mock.ANY)
+        self.assertEqual({}, self.utils._default_setting_data)
+
+        # The templates are discarded along with the pooled connection.
+        pool.invalidate(mock.sentinel.key)
+        self.utils._get_default_setting_data(mock.sentinel.class_name)
+
+        new_conn = pool.get(mock.sentinel.key, conn_factory)
+        new_conn.query.assert_called_once_with(mock.ANY)
+        mock_clone.assert_has_calls(
+            [mock.call(conn.query.return_value[0])] * 2 +
+            [mock.call(new_conn.query.return_value[0])])
+
+    def test_clone_wmi_obj_pymi(self):
+        class FakePyMIInstance(object):
+            def __init__(self, conn, instance):
+                self._conn = conn
+                self.instance = instance
+
+            def get_wrapped_object(self):
+                return self.instance
+
+        mock_instance = mock.Mock()
+        wmi_obj = FakePyMIInstance(mock.sentinel.conn, mock_instance)
+
+        new_obj = self.utils._clone_wmi_obj(wmi_obj)
+
+        self.assertIsInstance(new_obj, FakePyMIInstance)
+        self.assertEqual(mock.sentinel.conn, new_obj._conn)
+        self.assertEqual(mock_instance.clone.return_value, new_obj.instance)
+
+    def test_clone_wmi_obj_old_wmi(self):
+        class FakeWMIObject(object):
+            def __init__(self, ole_object):
+                self.ole_object = ole_object
+
+        wmi_obj = FakeWMIObject(mock.Mock())
+
+        new_obj = self.utils._clone_wmi_obj(wmi_obj)
+
+        self.assertIsInstance(new_obj, FakeWMIObject)
+        self.assertEqual(wmi_obj.ole_object.Clone_.return_value,
+                         new_obj.ole_object)
+
 
 class SynchronizedMetaTestCase(test_base.OsWinBaseTestCase):
     @mock.patch.object(baseutils.threading, 'RLock')
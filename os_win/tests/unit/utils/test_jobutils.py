@@ -42,7 +42,8 @@ class JobUtilsTestCase(test_base.OsWinBaseTestCase):
     def test_check_ret_val_started(self, mock_wait_for_job):
         self.jobutils.check_ret_val(constants.WMI_JOB_STATUS_STARTED,
                                     mock.sentinel.job_path)
-        mock_wait_for_job.assert_called_once_with(mock.sentinel.job_path)
+        mock_wait_for_job.assert_called_once_with(mock.sentinel.job_path,
+                                                  timeout=None)
 
     @mock.patch.object(jobutils.JobUtils, '_wait_for_job')
     def test_check_ret_val_ok(self, mock_wait_for_job):
@@ -50,6 +51,34 @@ class JobUtilsTestCase(test_base.OsWinBaseTestCase):
                                     mock.sentinel.job_path)
         self.assertFalse(mock_wait_for_job.called)
 
+    @mock.patch.object(jobutils, 'WMIJobFuture')
+    def test_check_ret_val_async_started(self, mock_future_cls):
+        future = self.jobutils.check_ret_val_async(
+            constants.WMI_JOB_STATUS_STARTED, mock.sentinel.job_path,
+            result_func=mock.sentinel.result_func,
+            progress_callback=mock.sentinel.progress_callback)
+
+        self.assertEqual(mock_future_cls.return_value, future)
+        mock_future_cls.assert_called_once_with(
+            self.jobutils, mock.sentinel.job_path,
+            result_func=mock.sentinel.result_func,
+            progress_callback=mock.sentinel.progress_callback)
+
+    def test_check_ret_val_async_exception(self):
+        future = self.jobutils.check_ret_val_async(
+            mock.sentinel.ret_val_bad, mock.sentinel.job_path)
+
+        self.assertTrue(future.done())
+        self.assertRaises(exceptions.WMIJobFailed, future.result)
+
+    def test_check_ret_val_async_ok(self):
+        future = self.jobutils.check_ret_val_async(
+            self._FAKE_RET_VAL, None,
+            result_func=lambda job: mock.sentinel.result)
+
+        self.assertTrue(future.done())
+        self.assertEqual(mock.sentinel.result, future.result())
+
     def test_check_ret_val_exception(self):
         self.assertRaises(exceptions.WMIJobFailed,
                           self.jobutils.check_ret_val,
@@ -62,6 +91,92 @@ class JobUtilsTestCase(test_base.OsWinBaseTestCase):
         job = self.jobutils._wait_for_job(self._FAKE_JOB_PATH)
         self.assertEqual(mock_job, job)
 
+    @mock.patch.object(jobutils.JobUtils, '_job_poller')
+    def test_wait_for_job_polled(self, mock_job_poller):
+        mock_job = self._prepare_wait_for_job(constants.JOB_STATE_COMPLETED)
+        job_path = ('\\\\host\\root\\virtualization\\v2:Msvm_ConcreteJob.'
+                    'InstanceID="fake-job-id"')
+
+        job = self.jobutils._wait_for_job(job_path)
+
+        self.assertEqual(mock_job, job)
+        mock_job_poller.wait.assert_called_once_with('fake-job-id', None)
+        self.jobutils._get_wmi_obj.assert_called_once_with(
+            job_path.replace('\\', '/'))
+
+    @mock.patch.object(jobutils.JobUtils, '_job_poller')
+    def test_wait_for_job_polled_timeout(self, mock_job_poller):
+        mock_job_poller.wait.return_value = False
+        job_path = 'Msvm_ConcreteJob.InstanceID="fake-job-id"'
+
+        self.assertRaises(exceptions.WMIJobTimeout,
+                          self.jobutils._wait_for_job,
+                          job_path, timeout=mock.sentinel.timeout)
+        mock_job_poller.wait.assert_called_once_with(
+            'fake-job-id', mock.sentinel.timeout)
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(jobutils.time, 'time')
+    def test_wait_for_job_timeout(self, mock_time, mock_sleep):
+        mock_time.side_effect = [0, 0, 0, 1, 2]
+        self._prepare_wait_for_job(constants.WMI_JOB_STATE_RUNNING)
+
+        self.assertRaises(exceptions.WMIJobTimeout,
+                          self.jobutils._wait_for_job,
+                          self._FAKE_JOB_PATH, timeout=2)
+        self.assertEqual(1, mock_sleep.call_count)
+
+    @mock.patch.object(jobutils.JobUtils, '_get_wmi_obj')
+    def test_add_virt_resource_async(self, mock_get_wmi_obj):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.AddResourceSettings.return_value = (
+            mock.sentinel.job_path, [mock.sentinel.new_res],
+            self._FAKE_RET_VAL)
+        mock_res = mock.Mock()
+        mock_parent = mock.Mock()
+
+        future = self.jobutils.add_virt_resource_async(mock_res, mock_parent)
+
+        self.assertEqual([mock.sentinel.new_res], future.result())
+        mock_svc.AddResourceSettings.assert_called_once_with(
+            mock_parent.path_.return_value,
+            [mock_res.GetText_.return_value])
+
+    @mock.patch.object(jobutils.JobUtils, 'check_ret_val_async')
+    def test_remove_multiple_virt_resources_async(self,
+                                                  mock_check_ret_val_async):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.RemoveResourceSettings.return_value = (
+            mock.sentinel.job_path, mock.sentinel.ret_val)
+        mock_res = mock.Mock()
+
+        future = self.jobutils.remove_multiple_virt_resources_async(
+            [mock_res], progress_callback=mock.sentinel.callback)
+
+        self.assertEqual(mock_check_ret_val_async.return_value, future)
+        mock_svc.RemoveResourceSettings.assert_called_once_with(
+            ResourceSettings=[mock_res.path_.return_value])
+        mock_check_ret_val_async.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path,
+            progress_callback=mock.sentinel.callback)
+
+    def test_get_job_id_unknown(self):
+        self.assertIsNone(self.jobutils._get_job_id(self._FAKE_JOB_PATH))
+
+    @mock.patch.object(jobutils, '_JobPoller')
+    def test_job_poller(self, mock_job_poller_cls):
+        self.jobutils._job_pollers.clear()
+        self.addCleanup(self.jobutils._job_pollers.clear)
+
+        self.assertEqual(mock_job_poller_cls.return_value,
+                         self.jobutils._job_poller)
+        self.assertEqual(mock_job_poller_cls.return_value,
+                         jobutils.JobUtils()._job_poller)
+
+        mock_job_poller_cls.assert_called_once_with(
+            self.jobutils._conn, self.jobutils._CONCRETE_JOB_CLASS,
+            self.jobutils._completed_job_states)
+
     def test_wait_for_job_error_state(self):
         self._prepare_wait_for_job(
             constants.JOB_STATE_TERMINATED)
@@ -228,6 +343,32 @@ class JobUtilsTestCase(test_base.OsWinBaseTestCase):
                                True, mock.sentinel.vm_path,
                                [mock.sentinel.res_data])
 
+    def test_add_multiple_virt_resources(self):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.AddResourceSettings.return_value = (
+            mock.sentinel.job_path, mock.sentinel.new_resources,
+            mock.sentinel.ret_val)
+        mock_resources = [mock.Mock(), mock.Mock()]
+        mock_parent = mock.Mock()
+        self.jobutils.check_ret_val = mock.Mock()
+
+        new_resources = self.jobutils.add_multiple_virt_resources(
+            mock_resources, mock_parent)
+
+        self.assertEqual(mock.sentinel.new_resources, new_resources)
+        mock_svc.AddResourceSettings.assert_called_once_with(
+            mock_parent.path_.return_value,
+            [res.GetText_.return_value for res in mock_resources])
+        self.jobutils.check_ret_val.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path)
+
+    def test_virt_resource_batch(self):
+        batch = self.jobutils.virt_resource_batch(mock.sentinel.parent)
+
+        self.assertIsInstance(batch, jobutils.VirtResourceBatch)
+        self.assertEqual(self.jobutils, batch._job_utils)
+        self.assertEqual(mock.sentinel.parent, batch._parent)
+
     def test_remove_virt_resource(self):
         self._test_virt_method('RemoveResourceSettings', 2,
                                'remove_virt_resource', False,
@@ -238,6 +379,11 @@ class JobUtilsTestCase(test_base.OsWinBaseTestCase):
                                True, mock.sentinel.vm_path,
                                [mock.sentinel.res_data])
 
+    def test_modify_virt_feature(self):
+        self._test_virt_method('ModifyFeatureSettings', 3,
+                               'modify_virt_feature', False,
+                               FeatureSettings=[mock.sentinel.res_data])
+
     def test_remove_virt_feature(self):
         self._test_virt_method('RemoveFeatureSettings', 2,
                                'remove_virt_feature', False,
@@ -294,3 +440,375 @@ class JobUtilsTestCase(test_base.OsWinBaseTestCase):
             ResourceSettings=[mock_virt_res.path_.return_value])
         mock_check_ret.assert_called_once_with(mock.sentinel.ret_val,
                                                mock.sentinel.job)
+
+
+class VirtResourceBatchTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V resource batches."""
+
+    def setUp(self):
+        super(VirtResourceBatchTestCase, self).setUp()
+        self._jobutils = mock.Mock()
+        self._add_resources = self._jobutils.add_multiple_virt_resources
+        self._batch = jobutils.VirtResourceBatch(self._jobutils,
+                                                 mock.sentinel.parent)
+
+    def test_commit(self):
+        self._add_resources.side_effect = [
+            [mock.sentinel.drive_path_0, mock.sentinel.drive_path_1],
+            [mock.sentinel.disk_path_0, mock.sentinel.disk_path_1]]
+
+        drive_reqs = [self._batch.add(mock.sentinel.drive_0),
+                      self._batch.add(mock.sentinel.drive_1)]
+        disks = [mock.Mock(), mock.Mock()]
+        disk_reqs = [self._batch.add(disk, parent_request=drive_req)
+                     for disk, drive_req in zip(disks, drive_reqs)]
+
+        requests = self._batch.commit()
+
+        self.assertEqual(drive_reqs + disk_reqs, requests)
+        self.assertEqual(
+            [mock.sentinel.drive_path_0, mock.sentinel.drive_path_1,
+             mock.sentinel.disk_path_0, mock.sentinel.disk_path_1],
+            [request.result() for request in requests])
+        self.assertEqual([mock.sentinel.drive_path_0,
+                          mock.sentinel.drive_path_1],
+                         [disk.Parent for disk in disks])
+        self._add_resources.assert_has_calls(
+            [mock.call([mock.sentinel.drive_0, mock.sentinel.drive_1],
+                       mock.sentinel.parent),
+             mock.call(disks, mock.sentinel.parent)])
+        # The batch is emptied after being committed.
+        self.assertEqual([], self._batch.commit())
+
+    def test_commit_failed(self):
+        self._add_resources.side_effect = exceptions.HyperVException
+
+        drive_req = self._batch.add(mock.sentinel.drive)
+        disk_req = self._batch.add(mock.sentinel.disk,
+                                   parent_request=drive_req)
+        self._batch.commit()
+
+        for request in (drive_req, disk_req):
+            self.assertTrue(request.done)
+            self.assertRaises(exceptions.HyperVException, request.result)
+        self._add_resources.assert_called_once_with(
+            [mock.sentinel.drive], mock.sentinel.parent)
+
+    def test_commit_partially_failed(self):
+        exc = exceptions.HyperVException()
+        self._add_resources.side_effect = [
+            exc, [mock.sentinel.drive_path_0], exc,
+            [mock.sentinel.disk_path_0]]
+
+        drive_reqs = [self._batch.add(mock.sentinel.drive_0),
+                      self._batch.add(mock.sentinel.drive_1)]
+        disks = [mock.Mock(), mock.Mock()]
+        disk_reqs = [self._batch.add(disk, parent_request=drive_req)
+                     for disk, drive_req in zip(disks, drive_reqs)]
+        self._batch.commit()
+
+        # Only the offending request and its dependencies fail.
+        self.assertEqual(mock.sentinel.drive_path_0, drive_reqs[0].result())
+        self.assertEqual(mock.sentinel.disk_path_0, disk_reqs[0].result())
+        for request in (drive_reqs[1], disk_reqs[1]):
+            self.assertIs(exc, request.exc)
+        self._add_resources.assert_has_calls(
+            [mock.call([mock.sentinel.drive_0, mock.sentinel.drive_1],
+                       mock.sentinel.parent),
+             mock.call([mock.sentinel.drive_0], mock.sentinel.parent),
+             mock.call([mock.sentinel.drive_1], mock.sentinel.parent),
+             mock.call([disks[0]], mock.sentinel.parent)])
+
+    def test_commit_short_result(self):
+        self._add_resources.return_value = [mock.sentinel.drive_path_0]
+
+        drive_reqs = [self._batch.add(mock.sentinel.drive_0),
+                      self._batch.add(mock.sentinel.drive_1)]
+        disk_req = self._batch.add(mock.sentinel.disk,
+                                   parent_request=drive_reqs[1])
+        self._batch.commit()
+
+        # The requests that did not get a path are not resubmitted.
+        self.assertEqual(mock.sentinel.drive_path_0, drive_reqs[0].result())
+        for request in (drive_reqs[1], disk_req):
+            self.assertTrue(request.done)
+            self.assertRaises(exceptions.HyperVException, request.result)
+        self._add_resources.assert_called_once_with(
+            [mock.sentinel.drive_0, mock.sentinel.drive_1],
+            mock.sentinel.parent)
+
+    def test_commit_unknown_parent_request(self):
+        parent_request = jobutils.VirtResourceRequest(mock.sentinel.res)
+        request = self._batch.add(mock.sentinel.disk,
+                                  parent_request=parent_request)
+
+        self._batch.commit()
+
+        self.assertRaises(exceptions.HyperVException, request.result)
+        self.assertFalse(self._add_resources.called)
+
+    def test_request_result_not_committed(self):
+        request = self._batch.add(mock.sentinel.res)
+
+        self.assertFalse(request.done)
+        self.assertRaises(exceptions.HyperVException, request.result)
+
+    def test_context_manager(self):
+        self._add_resources.side_effect = exceptions.HyperVException
+
+        def _add():
+            with self._batch as batch:
+                batch.add(mock.sentinel.res)
+
+        self.assertRaises(exceptions.HyperVException, _add)
+        self._add_resources.assert_called_once_with(
+            [mock.sentinel.res], mock.sentinel.parent)
+
+    def test_context_manager_exception(self):
+        def _add():
+            with self._batch as batch:
+                batch.add(mock.sentinel.res)
+                raise exceptions.OSWinException
+
+        self.assertRaises(exceptions.OSWinException, _add)
+        self.assertFalse(self._add_resources.called)
+
+
+class JobPollerTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V job poller."""
+
+    def setUp(self):
+        super(JobPollerTestCase, self).setUp()
+        self._conn = mock.Mock()
+        self._poller = jobutils._JobPoller(
+            self._conn, mock.sentinel.job_class,
+            jobutils.JobUtils._completed_job_states)
+
+    @mock.patch.object(jobutils.threading, 'Thread')
+    def test_wait(self, mock_thread_cls):
+        mock_thread_cls.return_value.start.side_effect = (
+            lambda: self._poller._pending_jobs['job_id'].set())
+
+        self.assertTrue(self._poller.wait('job_id', timeout=1))
+        self.assertFalse(self._poller.wait('other_job_id', timeout=0))
+
+        mock_thread_cls.assert_called_once_with(
+            target=self._poller._poll_jobs)
+        self.assertTrue(self._poller._new_jobs_event.is_set())
+
+    @mock.patch.object(jobutils._JobPoller, '_get_completed_jobs')
+    def test_poll_jobs(self, mock_get_completed_jobs):
+        job_events = [mock.Mock(), mock.Mock()]
+        self._poller._pending_jobs = {
+            'job_0': job_events[0], 'job_1': job_events[1]}
+        self._poller._new_jobs_event = mock.Mock()
+        self._poller._new_jobs_event.wait.return_value = False
+        self._poller._MIN_POLL_INTERVAL = 1
+        self._poller._MAX_POLL_INTERVAL = 3
+        self._poller._POLL_INTERVAL_BACKOFF = 2
+        self._poller._running = True
+        mock_get_completed_jobs.side_effect = [
+            [], exceptions.x_wmi, ['job_0'], ['job_1']]
+
+        self._poller._poll_jobs()
+
+        self.assertFalse(self._poller._running)
+        self.assertEqual(4, mock_get_completed_jobs.call_count)
+        for job_event in job_events:
+            job_event.set.assert_called_once_with()
+
+        poll_intervals = [
+            call_args[0][0]
+            for call_args in self._poller._new_jobs_event.wait.call_args_list]
+        self.assertEqual([2, 3, 1, 1], poll_intervals)
+
+    @mock.patch.object(jobutils._JobPoller, '_get_completed_jobs')
+    def test_poll_jobs_repeated_failures(self, mock_get_completed_jobs):
+        job_event = mock.Mock()
+        self._poller._pending_jobs = {'job_0': job_event}
+        self._poller._new_jobs_event = mock.Mock()
+        self._poller._new_jobs_event.wait.return_value = False
+        self._poller._MIN_POLL_INTERVAL = 0
+        self._poller._running = True
+        mock_get_completed_jobs.side_effect = exceptions.x_wmi
+
+        self._poller._poll_jobs()
+
+        # The waiters are notified, polling the jobs themselves.
+        job_event.set.assert_called_once_with()
+        self.assertEqual(self._poller._MAX_POLL_FAILURES,
+                         mock_get_completed_jobs.call_count)
+        self.assertFalse(self._poller._running)
+
+    @mock.patch.object(jobutils._JobPoller, '_report_progress')
+    def test_get_completed_jobs(self, mock_report_progress):
+        self._poller._MAX_JOBS_PER_QUERY = 2
+        self._conn.query.side_effect = [
+            [mock.Mock(InstanceID='JOB_0',
+                       JobState=constants.JOB_STATE_COMPLETED,
+                       PercentComplete=100),
+             mock.Mock(InstanceID='job_1',
+                       JobState=constants.WMI_JOB_STATE_RUNNING,
+                       PercentComplete=50)],
+            []]
+
+        completed_jobs = self._poller._get_completed_jobs(
+            ['job_0', 'job_1', 'job_2'])
+
+        self.assertEqual(['job_0', 'job_2'], completed_jobs)
+        self._conn.query.assert_has_calls([
+            mock.call("SELECT InstanceID, JobState, ErrorCode, "
+                      "PercentComplete FROM sentinel.job_class WHERE "
+                      "InstanceID = 'job_0' OR InstanceID = 'job_1'"),
+            mock.call("SELECT InstanceID, JobState, ErrorCode, "
+                      "PercentComplete FROM sentinel.job_class WHERE "
+                      "InstanceID = 'job_2'")])
+        mock_report_progress.assert_has_calls(
+            [mock.call('job_0', 100), mock.call('job_1', 50)])
+
+    @mock.patch.object(jobutils.threading, 'Thread')
+    def test_report_progress(self, mock_thread_cls):
+        mock_callback = mock.Mock(side_effect=[None, Exception])
+        self._poller.register('job_id', progress_callback=mock_callback)
+
+        for percent_complete in (10, 10, 20):
+            self._poller._report_progress('job_id', percent_complete)
+        self._poller._report_progress('other_job_id', 10)
+
+        mock_callback.assert_has_calls([mock.call(10), mock.call(20)])
+        self.assertEqual(2, mock_callback.call_count)
+
+
+class WMIJobFutureTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V job futures."""
+
+    _FAKE_JOB_PATH = 'Msvm_ConcreteJob.InstanceID="fake_job_id"'
+
+    def setUp(self):
+        super(WMIJobFutureTestCase, self).setUp()
+        self._jobutils = mock.Mock(
+            _KILL_JOB_STATE_CHANGE_REQUEST=(
+                jobutils.JobUtils._KILL_JOB_STATE_CHANGE_REQUEST))
+        self._jobutils._get_job_id = jobutils.JobUtils._get_job_id
+        self._job_poller = self._jobutils._job_poller
+        self._completed_event = self._job_poller.register.return_value
+
+    def _get_future(self, job_path=_FAKE_JOB_PATH, **kwargs):
+        return jobutils.WMIJobFuture(self._jobutils, job_path, **kwargs)
+
+    @mock.patch.object(jobutils.time, 'time', return_value=0)
+    def test_result(self, mock_time):
+        mock_result_func = mock.Mock()
+        future = self._get_future(
+            result_func=mock_result_func,
+            progress_callback=mock.sentinel.progress_callback)
+
+        result = future.result(10)
+        # The result is cached.
+        future.result()
+
+        self.assertEqual(mock_result_func.return_value, result)
+        self.assertTrue(future.done())
+        self._job_poller.register.assert_called_once_with(
+            'fake_job_id', mock.sentinel.progress_callback)
+        self._completed_event.wait.assert_called_once_with(10)
+        self._jobutils._get_completed_job.assert_called_once_with(
+            self._FAKE_JOB_PATH, 10)
+        mock_result_func.assert_called_once_with(
+            self._jobutils._get_completed_job.return_value)
+
+    def test_result_timeout(self):
+        self._completed_event.wait.return_value = False
+        future = self._get_future()
+
+        self.assertRaises(exceptions.WMIJobTimeout, future.result, 1)
+        self.assertFalse(self._jobutils._get_completed_job.called)
+
+    def test_result_job_failed(self):
+        self._jobutils._get_completed_job.side_effect = (
+            exceptions.HyperVException)
+        future = self._get_future()
+
+        self.assertRaises(exceptions.HyperVException, future.result)
+        self.assertRaises(exceptions.HyperVException, future.result)
+        self._jobutils._get_completed_job.assert_called_once_with(
+            self._FAKE_JOB_PATH, None)
+
+    def test_result_job_timeout_not_cached(self):
+        self._jobutils._get_completed_job.side_effect = [
+            exceptions.WMIJobTimeout(job_path=self._FAKE_JOB_PATH,
+                                     timeout=0),
+            mock.sentinel.job]
+        future = self._get_future()
+
+        self.assertRaises(exceptions.WMIJobTimeout, future.result, 0)
+        self.assertEqual(mock.sentinel.job, future.result())
+
+    @mock.patch('time.sleep')
+    def test_result_untracked_job(self, mock_sleep):
+        self._jobutils._is_job_completed.side_effect = [False, True]
+        future = self._get_future(job_path='fake_job_path')
+
+        self.assertEqual(self._jobutils._get_completed_job.return_value,
+                         future.result())
+        self.assertFalse(self._job_poller.register.called)
+        mock_sleep.assert_called_once_with(0.1)
+
+    def test_done(self):
+        future = self._get_future()
+        self.assertEqual(self._completed_event.is_set.return_value,
+                         future.done())
+
+    def test_cancel(self):
+        future = self._get_future()
+        self._completed_event.is_set.return_value = False
+        mock_job = self._jobutils._get_wmi_obj.return_value
+
+        self.assertTrue(future.cancel())
+        mock_job.RequestStateChange.assert_called_once_with(
+            jobutils.JobUtils._KILL_JOB_STATE_CHANGE_REQUEST)
+
+    def test_cancel_not_cancellable(self):
+        future = self._get_future()
+        self._completed_event.is_set.return_value = False
+        mock_job = self._jobutils._get_wmi_obj.return_value
+        mock_job.Cancellable = False
+
+        self.assertFalse(future.cancel())
+        self.assertFalse(mock_job.RequestStateChange.called)
+
+    def test_cancel_job_gone(self):
+        future = self._get_future()
+        self._completed_event.is_set.return_value = False
+        mock_job = self._jobutils._get_wmi_obj.return_value
+        mock_job.RequestStateChange.side_effect = test_base.FakeWMIExc(
+            hresult=jobutils._utils._WBEM_E_NOT_FOUND)
+
+        self.assertFalse(future.cancel())
+
+    def test_cancel_done(self):
+        future = self._get_future()
+        self.assertFalse(future.cancel())
+        self.assertFalse(self._jobutils._get_wmi_obj.called)
+
+    def test_wait_for_jobs(self):
+        futures = [mock.Mock(), mock.Mock()]
+        futures[0].result.side_effect = exceptions.HyperVException
+
+        results = jobutils.wait_for_jobs(futures, return_exceptions=True)
+
+        self.assertIsInstance(results[0], exceptions.HyperVException)
+        self.assertEqual(futures[1].result.return_value, results[1])
+        for future in futures:
+            future.result.assert_called_once_with(None)
+
+    @mock.patch('time.time')
+    def test_wait_for_jobs_raise(self, mock_time):
+        mock_time.side_effect = [0, 1, 2]
+        futures = [mock.Mock(), mock.Mock()]
+        futures[0].result.side_effect = exceptions.HyperVException
+
+        self.assertRaises(exceptions.HyperVException,
+                          jobutils.wait_for_jobs, futures, timeout=10)
+        futures[0].result.assert_called_once_with(9)
+        futures[1].result.assert_called_once_with(8)
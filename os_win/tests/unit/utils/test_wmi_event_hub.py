@@ -0,0 +1,224 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win import constants
+from os_win import exceptions
+from os_win.tests.unit import test_base
+from os_win.utils import _wmi_event_hub
+
+
+class WMIEventSubscriptionTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMI event hub subscriptions."""
+
+    def setUp(self):
+        super(WMIEventSubscriptionTestCase, self).setUp()
+        self._hub = mock.Mock()
+        self._subscription = _wmi_event_hub.WMIEventSubscription(
+            self._hub, mock.sentinel.query, max_queue_size=1)
+
+    @mock.patch('time.time')
+    def test_get(self, mock_time):
+        mock_time.side_effect = [1, 3]
+
+        self._subscription._put(mock.sentinel.event)
+        event = self._subscription.get(timeout=0)
+
+        self.assertEqual(mock.sentinel.event, event)
+        self.assertIsNone(self._subscription.get(timeout=0))
+
+        expected_stats = dict(received=1, delivered=1, dropped=0, queued=0,
+                              avg_latency=2, max_latency=2)
+        self.assertEqual(expected_stats, self._subscription.get_stats())
+
+    def test_put_full_queue(self):
+        self._subscription._put(mock.sentinel.event)
+        self._subscription._put(mock.sentinel.other_event)
+
+        stats = self._subscription.get_stats()
+        self.assertEqual(2, stats['received'])
+        self.assertEqual(1, stats['dropped'])
+        self.assertEqual(1, stats['queued'])
+        self.assertEqual(mock.sentinel.event,
+                         self._subscription.get(timeout=0))
+
+    def test_put_callback(self):
+        callback = mock.Mock(side_effect=[None, Exception])
+        subscription = _wmi_event_hub.WMIEventSubscription(
+            self._hub, mock.sentinel.query, callback=callback)
+
+        subscription._put(mock.sentinel.event)
+        # Callback failures are logged, without being propagated.
+        subscription._put(mock.sentinel.other_event)
+
+        callback.assert_has_calls([mock.call(mock.sentinel.event),
+                                   mock.call(mock.sentinel.other_event)])
+        stats = subscription.get_stats()
+        self.assertEqual(2, stats['received'])
+        self.assertEqual(1, stats['delivered'])
+        self.assertEqual(0, stats['queued'])
+
+    def test_cancel(self):
+        self._subscription.cancel()
+        self._hub.unsubscribe.assert_called_once_with(self._subscription)
+
+
+class WMIEventHubTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMI event hub."""
+
+    def setUp(self):
+        super(WMIEventHubTestCase, self).setUp()
+        self._conn = mock.Mock()
+        self._hub = _wmi_event_hub.WMIEventHub(self._conn)
+
+    @mock.patch.object(_wmi_event_hub, 'threading')
+    def test_subscribe(self, mock_threading):
+        subscription = self._hub.subscribe(mock.sentinel.query,
+                                           fields=[mock.sentinel.field])
+        self._hub.subscribe(mock.sentinel.other_query)
+
+        self.assertEqual(mock.sentinel.query, subscription.query)
+        self._conn.watch_for.assert_has_calls(
+            [mock.call(raw_wql=mock.sentinel.query,
+                       fields=[mock.sentinel.field]),
+             mock.call(raw_wql=mock.sentinel.other_query)])
+        self.assertEqual(2, len(self._hub.get_subscriptions()))
+
+        # A single consumer is used.
+        mock_threading.Thread.assert_called_once_with(
+            target=self._hub._listen)
+        mock_threading.Thread.return_value.start.assert_called_once_with()
+
+        subscription.cancel()
+        self.assertNotIn(subscription, self._hub.get_subscriptions())
+
+    def test_listen(self):
+        subscription = _wmi_event_hub.WMIEventSubscription(
+            self._hub, mock.sentinel.query)
+        self._hub._subscriptions.append(subscription)
+        self._hub._worker = mock.sentinel.worker
+
+        def _fake_poll(subscription):
+            self._hub.unsubscribe(subscription)
+
+        with mock.patch.object(self._hub, '_poll',
+                               side_effect=_fake_poll) as mock_poll:
+            self._hub._listen()
+
+        mock_poll.assert_called_once_with(subscription)
+        # The consumer stops once there are no subscriptions left.
+        self.assertIsNone(self._hub._worker)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_listen_backoff(self, mock_time, mock_sleep):
+        mock_time.return_value = 10
+        failed_subscription, subscription = [
+            _wmi_event_hub.WMIEventSubscription(self._hub, query)
+            for query in (mock.sentinel.failed_query, mock.sentinel.query)]
+        failed_subscription._retry_at = 11
+        self._hub._subscriptions.extend([failed_subscription, subscription])
+
+        def _fake_poll(subscription):
+            # The failing subscription is retried after the other ones
+            # are polled.
+            subscription._retry_at = 12
+            if mock_poll.call_count == 2:
+                self._hub._subscriptions = []
+
+        def _fake_sleep(timeout):
+            mock_time.return_value += timeout
+
+        mock_sleep.side_effect = _fake_sleep
+
+        with mock.patch.object(self._hub, '_poll',
+                               side_effect=_fake_poll) as mock_poll:
+            self._hub._listen()
+
+        mock_poll.assert_has_calls([mock.call(subscription),
+                                    mock.call(failed_subscription)])
+        # The worker sleeps only while all the subscriptions back off,
+        # for short periods.
+        self.assertTrue(mock_sleep.called)
+        for call in mock_sleep.call_args_list:
+            self.assertLessEqual(call[0][0],
+                                 self._hub._EVENT_TIMEOUT_MS / 1000.)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    @mock.patch.object(_wmi_event_hub._utils, 'avoid_blocking_call')
+    def test_poll(self, mock_avoid_blocking_call, mock_time, mock_sleep):
+        mock_time.return_value = 10
+        subscription = mock.Mock(_retry_at=0)
+        mock_avoid_blocking_call.side_effect = [
+            mock.sentinel.event, exceptions.x_wmi_timed_out, Exception]
+
+        for idx in range(3):
+            self._hub._poll(subscription)
+
+        mock_avoid_blocking_call.assert_has_calls(
+            [mock.call(subscription._watcher,
+                       self._hub._EVENT_TIMEOUT_MS)] * 3)
+        subscription._put.assert_called_once_with(mock.sentinel.event)
+        # The failed subscription backs off, without blocking the worker.
+        self.assertEqual(10 + constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000.,
+                         subscription._retry_at)
+        self.assertFalse(mock_sleep.called)
+
+
+class WMIEventListenerTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMI event listener base class."""
+
+    def setUp(self):
+        super(WMIEventListenerTestCase, self).setUp()
+        self._event_hub = mock.Mock()
+        self._listener = _wmi_event_hub.WMIEventListener(self._event_hub)
+
+    @mock.patch.object(_wmi_event_hub.WMIEventListener, 'refresh')
+    @mock.patch.object(_wmi_event_hub.WMIEventListener, '_process_event')
+    @mock.patch.object(_wmi_event_hub.WMIEventListener, '_get_event_queries')
+    def test_start(self, mock_get_event_queries, mock_process_event,
+                   mock_refresh):
+        mock_get_event_queries.return_value = [
+            (mock.sentinel.query, (mock.sentinel.event_type,
+                                   mock.sentinel.class_name))]
+
+        self._listener.start()
+
+        self._event_hub.subscribe.assert_called_once_with(
+            mock.sentinel.query, callback=mock.ANY)
+        mock_refresh.assert_called_once_with()
+
+        callback = self._event_hub.subscribe.call_args[1]['callback']
+        callback(mock.sentinel.event)
+        mock_process_event.assert_called_once_with(
+            mock.sentinel.event_type, mock.sentinel.class_name,
+            mock.sentinel.event)
+
+        self._listener.stop()
+        self._event_hub.subscribe.return_value.cancel.assert_called_once_with()
+        self.assertEqual([], self._listener._subscriptions)
+
+    def test_get_event_query(self):
+        query = self._listener._get_event_query(
+            self._listener._EVENT_TYPE_DELETE, 'Msvm_ComputerSystem',
+            condition="TargetInstance.Caption = 'Virtual Machine'")
+
+        expected_query = (
+            "SELECT * FROM __InstanceDeletionEvent WITHIN 2 "
+            "WHERE TargetInstance ISA 'Msvm_ComputerSystem' "
+            "AND TargetInstance.Caption = 'Virtual Machine'")
+        self.assertEqual(expected_query, query)
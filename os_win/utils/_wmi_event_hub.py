@@ -0,0 +1,262 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import functools
+import threading
+import time
+
+from oslo_log import log as logging
+from six.moves import queue
+
+from os_win import _utils
+from os_win import constants
+from os_win import exceptions
+
+LOG = logging.getLogger(__name__)
+
+
+class WMIEventSubscription(object):
+    """Buffers the events matching a WQL query.
+
+    Events are dispatched by the event hub through a bounded queue. If
+    the subscriber doesn't keep up, new events are dropped and counted,
+    so that slow subscribers do not delay the other subscriptions.
+
+    Alternatively, a callback may be passed, in which case the hub worker
+    passes the events to it instead of queueing them. Callbacks are
+    expected to return quickly.
+    """
+
+    def __init__(self, hub, query, fields=None, max_queue_size=1000,
+                 callback=None):
+        self.query = query
+        self.fields = fields
+
+        self._hub = hub
+        self._callback = callback
+        self._watcher = None
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        # The subscription is not polled until this moment, after failures.
+        self._retry_at = 0
+
+        self._lock = threading.Lock()
+        self._received = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._total_latency = 0
+        self._max_latency = 0
+
+    def _put(self, event):
+        with self._lock:
+            self._received += 1
+
+        if self._callback:
+            try:
+                self._callback(event)
+            except Exception:
+                LOG.exception("WMI event callback failed. Subscription "
+                              "query: %s", self.query)
+            else:
+                with self._lock:
+                    self._delivered += 1
+            return
+
+        try:
+            self._queue.put_nowait((time.time(), event))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            LOG.warning("The WMI event queue is full, dropping event. "
+                        "Subscription query: %s", self.query)
+
+    def get(self, timeout=None):
+        """Returns the next event, or None if the timeout expires."""
+        try:
+            queued_at, event = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        latency = time.time() - queued_at
+        with self._lock:
+            self._delivered += 1
+            self._total_latency += latency
+            self._max_latency = max(self._max_latency, latency)
+        return event
+
+    def get_stats(self):
+        with self._lock:
+            return dict(
+                received=self._received,
+                delivered=self._delivered,
+                dropped=self._dropped,
+                queued=self._queue.qsize(),
+                avg_latency=(self._total_latency / self._delivered
+                             if self._delivered else 0),
+                max_latency=self._max_latency)
+
+    def cancel(self):
+        self._hub.unsubscribe(self)
+
+
+class WMIEventHub(object):
+    """Dispatches the events of a WMI namespace to subscribers.
+
+    A single consumer thread polls the watchers of all the subscriptions,
+    so that the number of threads used for retrieving WMI events does not
+    grow along with the number of event listeners. The consumer is
+    started when the first subscription is added and stops once all the
+    subscriptions are cancelled.
+    """
+
+    _EVENT_TIMEOUT_MS = 100
+
+    def __init__(self, conn):
+        self._conn = conn
+
+        self._lock = threading.Lock()
+        self._subscriptions = []
+        self._worker = None
+
+    def subscribe(self, query, fields=None, **kwargs):
+        """Subscribes to the events matching the given WQL query.
+
+        Accepts the WMIEventSubscription queue arguments.
+        """
+        subscription = WMIEventSubscription(self, query, fields=fields,
+                                            **kwargs)
+        # The watcher is created right away so that the subscriber
+        # doesn't miss events.
+        if fields:
+            subscription._watcher = self._conn.watch_for(raw_wql=query,
+                                                         fields=fields)
+        else:
+            subscription._watcher = self._conn.watch_for(raw_wql=query)
+
+        with self._lock:
+            self._subscriptions.append(subscription)
+            if not self._worker:
+                # This is a greenthread when eventlet monkey patching is
+                # used.
+                self._worker = threading.Thread(target=self._listen)
+                self._worker.setDaemon(True)
+                self._worker.start()
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def get_subscriptions(self):
+        with self._lock:
+            return list(self._subscriptions)
+
+    def _listen(self):
+        while True:
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+                if not subscriptions:
+                    self._worker = None
+                    return
+
+            now = time.time()
+            ready = [subscription for subscription in subscriptions
+                     if subscription._retry_at <= now]
+            if not ready:
+                # All the subscriptions are backing off. We're not sleeping
+                # for too long, so that new subscriptions are polled soon.
+                retry_at = min(subscription._retry_at
+                               for subscription in subscriptions)
+                time.sleep(min(retry_at - now,
+                               self._EVENT_TIMEOUT_MS / 1000.))
+                continue
+
+            for subscription in ready:
+                self._poll(subscription)
+
+    def _poll(self, subscription):
+        try:
+            event = _utils.avoid_blocking_call(subscription._watcher,
+                                               self._EVENT_TIMEOUT_MS)
+            subscription._put(event)
+        except exceptions.x_wmi_timed_out:
+            pass
+        except Exception:
+            LOG.exception("The WMI event hub encountered an unexpected "
+                          "exception. Subscription query: %s",
+                          subscription.query)
+            # Back off without delaying the other subscriptions.
+            subscription._retry_at = (
+                time.time() + constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000.)
+
+
+class WMIEventListener(object):
+    """Base class for in memory views kept up to date using WMI events.
+
+    The events are retrieved through the namespace event hub, whose
+    worker passes them to _process_event, along with the arguments
+    returned by _get_event_queries. Events are expected to be processed
+    quickly, as the other subscriptions of the hub are delayed meanwhile.
+    """
+
+    _EVENT_TYPE_CREATE = '__InstanceCreationEvent'
+    _EVENT_TYPE_DELETE = '__InstanceDeletionEvent'
+    _EVENT_TYPE_MODIFY = '__InstanceModificationEvent'
+
+    _EVENT_CHECK_TIMEFRAME = 2  # seconds
+
+    def __init__(self, event_hub):
+        self._event_hub = event_hub
+        self._subscriptions = []
+
+    def start(self):
+        """Subscribes to the events, after which the view is loaded."""
+        self._subscriptions = [
+            self._event_hub.subscribe(
+                query,
+                callback=functools.partial(self._process_event, *event_args))
+            for query, event_args in self._get_event_queries()]
+
+        # Subscribing first, so that the changes performed while loading
+        # the view are not missed.
+        self.refresh()
+
+    def stop(self):
+        subscriptions, self._subscriptions = self._subscriptions, []
+        for subscription in subscriptions:
+            subscription.cancel()
+
+    def refresh(self):
+        """Reloads the whole view."""
+        raise NotImplementedError()
+
+    def _get_event_queries(self):
+        """Returns a list of (query, event_args) tuples."""
+        raise NotImplementedError()
+
+    def _process_event(self, *args):
+        raise NotImplementedError()
+
+    def _get_event_query(self, event_type, class_name, condition=None):
+        query = ("SELECT * FROM %(event_type)s "
+                 "WITHIN %(timeframe)s "
+                 "WHERE TargetInstance ISA '%(class)s'" %
+                 {'event_type': event_type,
+                  'timeframe': self._EVENT_CHECK_TIMEFRAME,
+                  'class': class_name})
+        if condition:
+            query += " AND %s" % condition
+        return query
@@ -18,6 +18,7 @@
 Base WMI utility class.
 """
 
+import collections
 import imp
 import sys
 import threading
@@ -29,12 +30,203 @@ if sys.platform == 'win32':
 from oslo_log import log as logging
 from oslo_utils import reflection
 
+from os_win import _utils
+from os_win import exceptions
+from os_win.utils import _wmi_event_hub
+
 LOG = logging.getLogger(__name__)
 
 
+class _PooledWMIConn(object):
+    __slots__ = ('conn', 'last_used', 'cache')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.last_used = time.time()
+        # Objects bound to this connection, discarded along with it.
+        self.cache = {}
+
+
+class _RPCFailureGuard(object):
+    """Invokes the on_rpc_failure callback if the wrapped call fails."""
+
+    def __init__(self, target, on_rpc_failure):
+        self._target = target
+        self._on_rpc_failure = on_rpc_failure
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if callable(attr):
+            return _RPCFailureGuard(attr, self._on_rpc_failure)
+        return attr
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self._target(*args, **kwargs)
+        except exceptions.x_wmi as ex:
+            if _utils._is_rpc_failure_exc(ex):
+                self._on_rpc_failure()
+            raise
+
+
+class _PooledWMIConnProxy(object):
+    """Forwards the WMI calls to a pooled connection.
+
+    The connection is retrieved from the pool whenever it's used, being
+    discarded if an RPC failure is encountered, for example when a remote
+    host is rebooted. Subsequent calls will transparently reconnect.
+    """
+
+    def __init__(self, pool, key, conn_factory):
+        self._pool = pool
+        self._key = key
+        self._conn_factory = conn_factory
+
+    def get_wrapped_conn(self):
+        return self._pool.get(self._key, self._conn_factory)
+
+    def get_conn_cache(self):
+        return self._pool.get_cache(self._key, self._conn_factory)
+
+    def _invalidate(self, conn):
+        LOG.debug("RPC failure encountered, discarding WMI connection: %s",
+                  self._key)
+        self._pool.invalidate(self._key, conn)
+
+    def __getattr__(self, name):
+        conn = self.get_wrapped_conn()
+        attr = getattr(conn, name)
+        if callable(attr):
+            return _RPCFailureGuard(
+                attr, lambda: self._invalidate(conn))
+        return attr
+
+
+class WMIConnectionPool(object):
+    """Thread safe pool of WMI connections.
+
+    Connections are keyed by host, namespace and connection arguments
+    (e.g. privileges), so that connections to remote hosts or requiring
+    special privileges are reused as well. The pool is bounded, evicting
+    the least recently used connections.
+
+    Connections that have been idle for more than probe_interval seconds
+    are probed before being handed out, being transparently reconnected
+    if the probe fails. Invalidated connections are reestablished by the
+    next caller.
+    """
+
+    _PROBE_QUERY = "SELECT Name FROM __Namespace"
+
+    def __init__(self, max_size=64, probe_interval=60):
+        self._max_size = max_size
+        self._probe_interval = probe_interval
+
+        self._lock = threading.RLock()
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def get_conn_key(moniker, **kwargs):
+        # Monikers such as '//./root/cimv2' and r'\\.\root\CIMV2' refer
+        # to the same namespace.
+        moniker = (moniker or '').replace('\\', '/').lower()
+        if not moniker.startswith('//'):
+            moniker = '//./%s' % moniker.lstrip('/')
+        host, _sep, namespace = moniker[2:].partition('/')
+        if host in ('localhost', ''):
+            host = '.'
+
+        conn_args = tuple(
+            (arg_name, tuple(arg_value)
+             if isinstance(arg_value, (list, tuple)) else arg_value)
+            for arg_name, arg_value in sorted(kwargs.items()))
+        return (host, namespace, conn_args)
+
+    def _probe(self, conn):
+        try:
+            conn.query(self._PROBE_QUERY)
+            return True
+        except exceptions.x_wmi as ex:
+            LOG.debug("WMI connection liveness probe failed: %s", ex)
+            return False
+
+    def _get_entry(self, key, conn_factory):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                # Keep the entries ordered by their last usage.
+                self._entries[key] = entry
+
+        if entry:
+            idle_time = time.time() - entry.last_used
+            if idle_time < self._probe_interval or self._probe(entry.conn):
+                entry.last_used = time.time()
+                return entry
+
+            LOG.debug("Reconnecting stale WMI connection: %s", key)
+            self.invalidate(key, entry.conn)
+
+        # Establishing the connection may take a while, especially for
+        # remote hosts, so we're not holding the lock meanwhile.
+        new_entry = _PooledWMIConn(conn_factory())
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                # A concurrent caller has just connected.
+                return entry
+
+            self._entries[key] = new_entry
+            self._evict()
+            return new_entry
+
+    def _evict(self):
+        while len(self._entries) > self._max_size:
+            key, _entry = self._entries.popitem(last=False)
+            LOG.debug("Evicting WMI connection: %s", key)
+
+    def get(self, key, conn_factory):
+        """Returns a shared connection, establishing it if needed."""
+        return self._get_entry(key, conn_factory).conn
+
+    def get_cache(self, key, conn_factory):
+        """Returns a dict used for caching objects bound to a connection.
+
+        The cache is discarded when the connection is evicted or
+        invalidated.
+        """
+        return self._get_entry(key, conn_factory).cache
+
+    def invalidate(self, key, conn=None):
+        """Drops a connection, forcing the next caller to reconnect.
+
+        :param conn: if specified, the pooled connection will be dropped
+            only if it's the same object, allowing callers to safely discard
+            connections that might have been replaced meanwhile.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (conn is None or entry.conn is conn):
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
 class BaseUtils(object):
 
-    _WMI_CONS = {}
+    _WMI_CONN_POOL = WMIConnectionPool()
+
+    # WMI event hubs, keyed by connection key. One event consumer
+    # thread is used per namespace.
+    _wmi_event_hubs = {}
+    _wmi_event_hubs_lock = threading.Lock()
 
     def _get_wmi_obj(self, moniker, **kwargs):
         return wmi.WMI(moniker=moniker, **kwargs)
@@ -42,14 +234,35 @@ class BaseUtils(object):
     def _get_wmi_conn(self, moniker, **kwargs):
         if sys.platform != 'win32':
             return None
-        if kwargs:
-            return self._get_wmi_obj(moniker, **kwargs)
-        if moniker in self._WMI_CONS:
-            return self._WMI_CONS[moniker]
 
-        wmi_conn = self._get_wmi_obj(moniker)
-        self._WMI_CONS[moniker] = wmi_conn
-        return wmi_conn
+        conn_key = self._WMI_CONN_POOL.get_conn_key(moniker, **kwargs)
+        return self._WMI_CONN_POOL.get(
+            conn_key,
+            lambda: self._get_wmi_obj(moniker, **kwargs))
+
+    def _get_pooled_wmi_conn(self, moniker, **kwargs):
+        """Returns a proxy resolving the pooled connection on each use.
+
+        Unlike connections returned by _get_wmi_conn, the proxy does not
+        hold on to connections that have been discarded by the pool.
+        """
+        if sys.platform != 'win32':
+            return None
+
+        conn_key = self._WMI_CONN_POOL.get_conn_key(moniker, **kwargs)
+        return _PooledWMIConnProxy(
+            self._WMI_CONN_POOL, conn_key,
+            lambda: self._get_wmi_obj(moniker, **kwargs))
+
+    def _get_wmi_event_hub(self, moniker):
+        """Returns the event hub shared by the listeners of a namespace."""
+        conn_key = self._WMI_CONN_POOL.get_conn_key(moniker)
+        with self._wmi_event_hubs_lock:
+            hub = self._wmi_event_hubs.get(conn_key)
+            if not hub:
+                hub = _wmi_event_hub.WMIEventHub(self._get_wmi_conn(moniker))
+                self._wmi_event_hubs[conn_key] = hub
+            return hub
 
 
 class BaseUtilsVirt(BaseUtils):
@@ -63,11 +276,15 @@ class BaseUtilsVirt(BaseUtils):
         self._host = host
         self._conn_attr = None
         self._compat_conn_attr = None
+        # The default setting data objects never change, so we're caching
+        # them per WMI connection, using them as templates for new objects.
+        # Pooled connections keep their own templates.
+        self._default_setting_data = {}
 
     @property
     def _conn(self):
         if not self._conn_attr:
-            self._conn_attr = self._get_wmi_conn(
+            self._conn_attr = self._get_pooled_wmi_conn(
                 self._wmi_namespace % self._host)
         return self._conn_attr
 
@@ -94,7 +311,18 @@ class BaseUtilsVirt(BaseUtils):
         if self._vs_man_svc_attr:
             return self._vs_man_svc_attr
 
-        vs_man_svc = self._compat_conn.Msvm_VirtualSystemManagementService()[0]
+        conn = self._compat_conn
+        if isinstance(conn, _PooledWMIConnProxy):
+            # The service is cached along with the pooled connection, so
+            # that it's fetched again after reconnecting.
+            conn_cache = conn.get_conn_cache()
+            vs_man_svc = conn_cache.get('vs_man_svc')
+            if vs_man_svc is None:
+                vs_man_svc = conn.Msvm_VirtualSystemManagementService()[0]
+                conn_cache['vs_man_svc'] = vs_man_svc
+            return vs_man_svc
+
+        vs_man_svc = conn.Msvm_VirtualSystemManagementService()[0]
         if BaseUtilsVirt._os_version >= [6, 3]:
             # NOTE(claudiub): caching this property on Windows / Hyper-V Server
             # 2012 (using the old WMI) can lead to memory leaks. PyMI doesn't
@@ -122,6 +350,45 @@ class BaseUtilsVirt(BaseUtils):
             return wmi.WMI(moniker=moniker, **kwargs)
         return self._get_wmi_compat_conn(moniker=moniker, **kwargs)
 
+    def _get_default_setting_data(self, class_name, resource_sub_type=None):
+        """Returns a new copy of the default setting data object.
+
+        The default objects are retrieved once per connection.
+        """
+        conn = self._compat_conn
+        if isinstance(conn, _PooledWMIConnProxy):
+            # The templates are bound to the actual connection, which may
+            # get replaced.
+            templates = conn.get_conn_cache().setdefault(
+                'default_setting_data', {})
+        else:
+            templates = self._default_setting_data.setdefault(conn, {})
+
+        template = templates.get((class_name, resource_sub_type))
+        if template is None:
+            if resource_sub_type:
+                query = ("SELECT * FROM %(class_name)s "
+                         "WHERE ResourceSubType = '%(res_sub_type)s' AND "
+                         "InstanceID LIKE '%%\\Default'" %
+                         {"class_name": class_name,
+                          "res_sub_type": resource_sub_type})
+            else:
+                query = ("SELECT * FROM %s WHERE InstanceID "
+                         "LIKE '%%\\Default'" % class_name)
+            template = conn.query(query)[0]
+            templates[(class_name, resource_sub_type)] = template
+
+        return self._clone_wmi_obj(template)
+
+    @staticmethod
+    def _clone_wmi_obj(wmi_obj):
+        if hasattr(type(wmi_obj), 'get_wrapped_object'):
+            # PyMI objects wrap MI instances, which can be cloned.
+            return type(wmi_obj)(wmi_obj._conn,
+                                 wmi_obj.get_wrapped_object().clone())
+        # Objects retrieved using the old WMI module.
+        return type(wmi_obj)(wmi_obj.ole_object.Clone_())
+
 
 class SynchronizedMeta(type):
     """Use an rlock to synchronize all class methods."""
@@ -0,0 +1,164 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+
+from oslo_log import log as logging
+
+from os_win.utils import _wmi_event_hub
+
+LOG = logging.getLogger(__name__)
+
+DiskResourceEntry = collections.namedtuple(
+    'DiskResourceEntry',
+    ['class_name', 'instance_id', 'host_resource', 'serial'])
+
+
+class DiskResourceIndex(_wmi_event_hub.WMIEventListener):
+    """Maps disk paths and serial numbers to disk resource InstanceIDs.
+
+    The disk resources are retrieved using one projected query per resource
+    class. The index can be refreshed on demand or kept up to date using
+    resource creation, modification and deletion events.
+
+    As entries may still be stale, callers are expected to validate the
+    resources retrieved based on the indexed InstanceIDs.
+    """
+
+    def __init__(self, conn, res_sub_types, event_hub=None):
+        """Creates the index.
+
+        :param conn: the WMI connection used for retrieving the resources.
+        :param res_sub_types: a dict mapping the indexed resource class names
+            to the indexed resource sub types.
+        :param event_hub: the event hub of the according namespace, required
+            when tracking events.
+        """
+        super(DiskResourceIndex, self).__init__(event_hub)
+
+        self._conn = conn
+        self._res_sub_types = res_sub_types
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._paths = {}
+        self._serials = {}
+
+    def start(self, track_events=True):
+        if track_events:
+            super(DiskResourceIndex, self).start()
+        else:
+            self.refresh()
+
+    def _get_event_queries(self):
+        return [(self._get_event_query(event_type, class_name),
+                 (event_type, class_name))
+                for class_name in self._res_sub_types
+                for event_type in (self._EVENT_TYPE_CREATE,
+                                   self._EVENT_TYPE_DELETE,
+                                   self._EVENT_TYPE_MODIFY)]
+
+    def _get_res_sub_types_filter(self, class_name, prefix=''):
+        return " OR ".join(
+            "%sResourceSubType = '%s'" % (prefix, res_sub_type)
+            for res_sub_type in self._res_sub_types[class_name])
+
+    def _get_event_query(self, event_type, class_name):
+        condition = "(%s)" % self._get_res_sub_types_filter(
+            class_name, prefix='TargetInstance.')
+        return super(DiskResourceIndex, self)._get_event_query(
+            event_type, class_name, condition)
+
+    def refresh(self):
+        """Reloads the whole index."""
+        entries = {}
+        for class_name in self._res_sub_types:
+            resources = self._conn.query(
+                "SELECT InstanceID, HostResource, ElementName "
+                "FROM %(class)s WHERE %(res_sub_types)s" %
+                {'class': class_name,
+                 'res_sub_types': self._get_res_sub_types_filter(
+                     class_name)})
+            for resource in resources:
+                entries[resource.InstanceID] = self._get_entry(
+                    class_name, resource)
+
+        paths = {}
+        serials = {}
+        for entry in entries.values():
+            self._add_lookup_keys(entry, paths, serials)
+
+        with self._lock:
+            self._entries = entries
+            self._paths = paths
+            self._serials = serials
+
+        LOG.debug("Loaded %d disk resource index entries.", len(entries))
+
+    @staticmethod
+    def _normalize_path(disk_path):
+        return disk_path.lower() if disk_path else None
+
+    def _get_entry(self, class_name, resource):
+        host_resource = (resource.HostResource[0]
+                         if resource.HostResource else None)
+        return DiskResourceEntry(class_name,
+                                 resource.InstanceID,
+                                 self._normalize_path(host_resource),
+                                 resource.ElementName or None)
+
+    @staticmethod
+    def _add_lookup_keys(entry, paths, serials):
+        if entry.host_resource:
+            paths[(entry.class_name, entry.host_resource)] = entry.instance_id
+        if entry.serial:
+            serials[(entry.class_name, entry.serial)] = entry.instance_id
+
+    def _remove_lookup_keys(self, entry):
+        path_key = (entry.class_name, entry.host_resource)
+        if self._paths.get(path_key) == entry.instance_id:
+            self._paths.pop(path_key)
+        serial_key = (entry.class_name, entry.serial)
+        if self._serials.get(serial_key) == entry.instance_id:
+            self._serials.pop(serial_key)
+
+    def _process_event(self, event_type, class_name, event):
+        if event_type == self._EVENT_TYPE_DELETE:
+            self.invalidate(event.InstanceID)
+        else:
+            self.update(class_name, event)
+
+    def get(self, class_name, disk_path=None, serial=None):
+        """Returns the InstanceID of the matching disk resource, if any."""
+        if serial:
+            return self._serials.get((class_name, serial))
+        return self._paths.get((class_name, self._normalize_path(disk_path)))
+
+    def update(self, class_name, resource):
+        entry = self._get_entry(class_name, resource)
+        with self._lock:
+            old_entry = self._entries.pop(resource.InstanceID, None)
+            if old_entry:
+                self._remove_lookup_keys(old_entry)
+
+            self._entries[resource.InstanceID] = entry
+            self._add_lookup_keys(entry, self._paths, self._serials)
+
+    def invalidate(self, instance_id):
+        with self._lock:
+            entry = self._entries.pop(instance_id, None)
+            if entry:
+                self._remove_lookup_keys(entry)
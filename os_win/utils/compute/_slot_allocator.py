@@ -0,0 +1,95 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+from os_win._i18n import _
+from os_win import exceptions
+
+
+class ControllerSlotAllocator(object):
+    """Allocates disk controller slots using bitmaps.
+
+    Slots are reserved while the according drives are being attached,
+    so concurrent callers get distinct slots. Reserved slots are either
+    committed once the drive is attached or released otherwise.
+    """
+
+    def __init__(self, slots_number, used_slots=(),
+                 reservation_timeout=None):
+        """Creates the allocator.
+
+        :param reservation_timeout: optional number of seconds after which
+            pending reservations are dropped when updating the used slots,
+            in case the reserved slots were never used.
+        """
+        self._lock = threading.Lock()
+        self._mask = (1 << slots_number) - 1
+        self._reservation_timeout = reservation_timeout
+
+        self._used = 0
+        self._reserved = 0
+        self._reservation_times = {}
+        self.update(used_slots)
+
+    def update(self, used_slots):
+        """Replaces the used slots, preserving the current reservations."""
+        used = 0
+        for slot in used_slots:
+            used |= 1 << slot
+
+        with self._lock:
+            self._used = used
+            self.updated_at = time.time()
+
+            if self._reservation_timeout is not None:
+                now = time.time()
+                for slot, reserved_at in list(
+                        self._reservation_times.items()):
+                    if now - reserved_at >= self._reservation_timeout:
+                        self._reserved &= ~(1 << slot)
+                        del self._reservation_times[slot]
+
+    def get_free_slot(self):
+        """Returns the first free slot, without reserving it."""
+        free = ~(self._used | self._reserved) & self._mask
+        if not free:
+            raise exceptions.HyperVException(
+                _("Exceeded the maximum number of slots"))
+        # Isolate the lowest set bit.
+        return (free & -free).bit_length() - 1
+
+    def reserve(self):
+        with self._lock:
+            slot = self.get_free_slot()
+            self._reserved |= 1 << slot
+            self._reservation_times[slot] = time.time()
+            return slot
+
+    def commit(self, slot):
+        with self._lock:
+            self._reserved &= ~(1 << slot)
+            self._reservation_times.pop(slot, None)
+            self._used |= 1 << slot
+
+    def release(self, slot):
+        with self._lock:
+            self._reserved &= ~(1 << slot)
+            self._reservation_times.pop(slot, None)
+            self._used &= ~(1 << slot)
+
+    def is_used(self, slot):
+        return bool((self._used | self._reserved) & (1 << slot))
@@ -0,0 +1,161 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+
+from oslo_log import log as logging
+
+from os_win.utils import _wmi_event_hub
+
+LOG = logging.getLogger(__name__)
+
+VMLookupEntry = collections.namedtuple(
+    'VMLookupEntry', ['vm_path', 'vssd_path', 'instance_id'])
+
+_EMPTY_ENTRY = VMLookupEntry(None, None, None)
+
+
+class VMLookupCache(_wmi_event_hub.WMIEventListener):
+    """Maps VM names to the paths of the VM WMI objects.
+
+    The index is seeded using two projected queries and is kept up to date
+    using Msvm_ComputerSystem creation, deletion and rename events. Entries
+    added based on events only include the VM InstanceID, the paths being
+    cached when the VM is first retrieved.
+
+    Note that entries may still be stale, for which reason callers are
+    expected to validate the objects retrieved based on the cached paths,
+    invalidating the according entry if needed.
+    """
+
+    _COMPUTER_SYSTEM_CLASS = 'Msvm_ComputerSystem'
+    _VIRTUAL_SYSTEM_SETTING_DATA_CLASS = 'Msvm_VirtualSystemSettingData'
+    _VIRTUAL_SYSTEM_TYPE_REALIZED = 'Microsoft:Hyper-V:System:Realized'
+
+    def __init__(self, conn, event_hub):
+        """Creates the cache.
+
+        :param conn: the WMI connection used for seeding the cache.
+        :param event_hub: the event hub of the according namespace.
+        """
+        super(VMLookupCache, self).__init__(event_hub)
+
+        self._conn = conn
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._names_by_id = {}
+
+    def _get_event_queries(self):
+        return [(self._get_event_query(event_type), (event_type, ))
+                for event_type in (self._EVENT_TYPE_CREATE,
+                                   self._EVENT_TYPE_DELETE,
+                                   self._EVENT_TYPE_MODIFY)]
+
+    def _get_event_query(self, event_type):
+        condition = None
+        if event_type == self._EVENT_TYPE_MODIFY:
+            # We only care about renamed VMs.
+            condition = ("TargetInstance.ElementName != "
+                         "PreviousInstance.ElementName")
+        return super(VMLookupCache, self)._get_event_query(
+            event_type, self._COMPUTER_SYSTEM_CLASS, condition)
+
+    def refresh(self):
+        """Reloads the whole cache."""
+        vssds = self._conn.query(
+            "SELECT InstanceID, ElementName FROM %(class)s "
+            "WHERE VirtualSystemType = '%(vs_type)s'" %
+            {'class': self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS,
+             'vs_type': self._VIRTUAL_SYSTEM_TYPE_REALIZED})
+        vms = self._conn.query(
+            "SELECT Name, ElementName FROM %s" % self._COMPUTER_SYSTEM_CLASS)
+        vm_paths = {self.get_instance_id(vm.Name): vm.path_() for vm in vms}
+
+        entries = {}
+        duplicates = set()
+        for vssd in vssds:
+            vm_name = vssd.ElementName
+            if vm_name in entries:
+                duplicates.add(vm_name)
+            entries[vm_name] = VMLookupEntry(
+                vm_paths.get(vssd.InstanceID), vssd.path_(), vssd.InstanceID)
+
+        # Lookups for duplicate VM names will be performed using WQL queries,
+        # which is where the according error is raised.
+        for vm_name in duplicates:
+            entries.pop(vm_name)
+
+        with self._lock:
+            self._entries = entries
+            self._names_by_id = {entry.instance_id: vm_name
+                                 for vm_name, entry in entries.items()}
+
+        LOG.debug("Loaded %d VM lookup cache entries.", len(entries))
+
+    @staticmethod
+    def get_instance_id(vm_id):
+        # The VM settings InstanceID contains the VM id.
+        return 'Microsoft:%s' % vm_id
+
+    @staticmethod
+    def get_vm_id(instance_id):
+        return instance_id.split(':', 1)[-1]
+
+    def _process_event(self, event_type, event):
+        instance_id = self.get_instance_id(event.Name)
+
+        with self._lock:
+            old_name = self._names_by_id.pop(instance_id, None)
+            if old_name is not None:
+                self._entries.pop(old_name, None)
+
+            if event_type == self._EVENT_TYPE_DELETE:
+                return
+
+            vm_name = event.ElementName
+            if vm_name in self._entries:
+                # Another VM having the same name exists.
+                entry = self._entries.pop(vm_name)
+                self._names_by_id.pop(entry.instance_id, None)
+                return
+
+            # The paths are cached when the VM is first retrieved.
+            self._entries[vm_name] = VMLookupEntry(None, None, instance_id)
+            self._names_by_id[instance_id] = vm_name
+
+    def get(self, vm_name):
+        return self._entries.get(vm_name)
+
+    def update(self, vm_name, vm_path=None, vssd_path=None, instance_id=None):
+        new_values = dict(vm_path=vm_path,
+                          vssd_path=vssd_path,
+                          instance_id=instance_id)
+        new_values = {key: value for key, value in new_values.items()
+                      if value is not None}
+
+        with self._lock:
+            entry = self._entries.get(vm_name, _EMPTY_ENTRY)
+            entry = entry._replace(**new_values)
+            self._entries[vm_name] = entry
+            if entry.instance_id:
+                self._names_by_id[entry.instance_id] = vm_name
+
+    def invalidate(self, vm_name):
+        with self._lock:
+            entry = self._entries.pop(vm_name, None)
+            if entry and entry.instance_id:
+                self._names_by_id.pop(entry.instance_id, None)
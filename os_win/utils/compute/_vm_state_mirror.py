@@ -0,0 +1,158 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+from oslo_log import log as logging
+
+from os_win.utils import _wmi_event_hub
+
+LOG = logging.getLogger(__name__)
+
+VMStateEntry = collections.namedtuple('VMStateEntry',
+                                      ['vm_name', 'enabled_state'])
+
+
+class VMStateMirror(_wmi_event_hub.WMIEventListener):
+    """In memory copy of the VM names and power states.
+
+    The mirror is seeded using a single projected query and is kept up to
+    date using Msvm_ComputerSystem creation, deletion and modification
+    events. As events may be dropped, the mirror is reloaded when accessed
+    after the resync interval passes.
+    """
+
+    _COMPUTER_SYSTEM_CLASS = 'Msvm_ComputerSystem'
+
+    def __init__(self, conn, event_hub, resync_interval=300):
+        """Creates the mirror.
+
+        :param conn: the WMI connection used for seeding the mirror.
+        :param event_hub: the event hub of the according namespace.
+        :param resync_interval: the interval (in seconds) at which the
+            mirror is reloaded.
+        """
+        super(VMStateMirror, self).__init__(event_hub)
+
+        self._conn = conn
+        self._resync_interval = resync_interval
+
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._entries = {}
+        self._ids_by_name = {}
+        self._last_sync = 0
+
+    def _get_event_queries(self):
+        return [(self._get_event_query(event_type), (event_type, ))
+                for event_type in (self._EVENT_TYPE_CREATE,
+                                   self._EVENT_TYPE_DELETE,
+                                   self._EVENT_TYPE_MODIFY)]
+
+    def _get_event_query(self, event_type):
+        condition = "TargetInstance.Caption = 'Virtual Machine'"
+        if event_type == self._EVENT_TYPE_MODIFY:
+            # We only care about power state changes and renamed VMs.
+            condition += (" AND (TargetInstance.EnabledState != "
+                          "PreviousInstance.EnabledState OR "
+                          "TargetInstance.ElementName != "
+                          "PreviousInstance.ElementName)")
+        return super(VMStateMirror, self)._get_event_query(
+            event_type, self._COMPUTER_SYSTEM_CLASS, condition)
+
+    def refresh(self):
+        """Reloads the whole mirror."""
+        vms = self._conn.query(
+            "SELECT Name, ElementName, EnabledState FROM %(class)s "
+            "WHERE Caption = 'Virtual Machine'" %
+            {'class': self._COMPUTER_SYSTEM_CLASS})
+
+        entries = {vm.Name: VMStateEntry(vm.ElementName, vm.EnabledState)
+                   for vm in vms}
+        ids_by_name = {}
+        for vm_id, entry in entries.items():
+            ids_by_name.setdefault(entry.vm_name, set()).add(vm_id)
+
+        with self._lock:
+            self._entries = entries
+            self._ids_by_name = ids_by_name
+            self._last_sync = time.time()
+
+        LOG.debug("Loaded %d VM state mirror entries.", len(entries))
+
+    def _refresh_if_stale(self):
+        if time.time() - self._last_sync < self._resync_interval:
+            return
+
+        # Concurrent callers use the current entries instead of waiting
+        # for the mirror to be reloaded.
+        if not self._refresh_lock.acquire(False):
+            return
+        try:
+            if time.time() - self._last_sync >= self._resync_interval:
+                self.refresh()
+        except Exception:
+            LOG.exception("Failed to reload the VM state mirror.")
+        finally:
+            self._refresh_lock.release()
+
+    def _process_event(self, event_type, event):
+        vm_id = event.Name
+
+        with self._lock:
+            old_entry = self._entries.pop(vm_id, None)
+            if old_entry:
+                vm_ids = self._ids_by_name.get(old_entry.vm_name, set())
+                vm_ids.discard(vm_id)
+                if not vm_ids:
+                    self._ids_by_name.pop(old_entry.vm_name, None)
+
+            if event_type == self._EVENT_TYPE_DELETE:
+                return
+
+            self._entries[vm_id] = VMStateEntry(event.ElementName,
+                                                event.EnabledState)
+            self._ids_by_name.setdefault(event.ElementName, set()).add(vm_id)
+
+    def get_state(self, vm_name):
+        """Returns the VM EnabledState.
+
+        None is returned if the VM is not mirrored or if multiple VMs
+        having the requested name exist.
+        """
+        self._refresh_if_stale()
+
+        with self._lock:
+            vm_ids = self._ids_by_name.get(vm_name)
+            if not vm_ids or len(vm_ids) > 1:
+                return None
+
+            entry = self._entries.get(next(iter(vm_ids)))
+            return entry.enabled_state if entry else None
+
+    def exists(self, vm_name):
+        self._refresh_if_stale()
+        return bool(self._ids_by_name.get(vm_name))
+
+    def get_vm_names(self, enabled_states=None):
+        self._refresh_if_stale()
+
+        with self._lock:
+            entries = list(self._entries.values())
+        return [entry.vm_name for entry in entries
+                if enabled_states is None or
+                entry.enabled_state in enabled_states]
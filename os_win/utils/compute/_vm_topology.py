@@ -0,0 +1,98 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+class _Immutable(object):
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            "'%s' objects are immutable." % type(self).__name__)
+
+    def _set(self, name, value):
+        object.__setattr__(self, name, value)
+
+
+class VMResource(_Immutable):
+    """A VM resource, linked to its parent and child resources."""
+
+    __slots__ = ('wmi_obj', 'class_name', 'path', 'parent', 'children')
+
+    def __init__(self, wmi_obj, class_name):
+        self._set('wmi_obj', wmi_obj)
+        self._set('class_name', class_name)
+        self._set('path', wmi_obj.path_())
+        self._set('parent', None)
+        self._set('children', ())
+
+    @property
+    def res_sub_type(self):
+        return self.wmi_obj.ResourceSubType
+
+    def __repr__(self):
+        return '<VMResource: %s>' % self.path
+
+
+class VMTopology(_Immutable):
+    """Snapshot of the resources of a VM.
+
+    The resources are retrieved once, so callers should not expect this
+    to reflect subsequent VM changes.
+    """
+
+    __slots__ = ('vm_name', 'instance_id', 'resources', '_by_path')
+
+    def __init__(self, vm_name, instance_id, wmi_objs_by_class):
+        """Builds the snapshot.
+
+        :param wmi_objs_by_class: a list of (class_name, wmi_objs) tuples.
+        """
+        resources = tuple(
+            VMResource(wmi_obj, class_name)
+            for class_name, wmi_objs in wmi_objs_by_class
+            for wmi_obj in wmi_objs)
+        by_path = {resource.path.upper(): resource for resource in resources}
+
+        children = {}
+        for resource in resources:
+            parent_path = getattr(resource.wmi_obj, 'Parent', None)
+            parent = by_path.get(parent_path.upper()) if parent_path else None
+            if parent:
+                resource._set('parent', parent)
+                children.setdefault(parent.path.upper(), []).append(resource)
+
+        for parent_path, child_resources in children.items():
+            by_path[parent_path]._set('children', tuple(child_resources))
+
+        self._set('vm_name', vm_name)
+        self._set('instance_id', instance_id)
+        self._set('resources', resources)
+        self._set('_by_path', by_path)
+
+    def get(self, path):
+        """Returns the resource having the given path, if any."""
+        return self._by_path.get(path.upper())
+
+    def get_resources(self, class_name=None, res_sub_types=None):
+        """Returns the resources matching the given criteria."""
+        return tuple(
+            resource for resource in self.resources
+            if ((class_name is None or resource.class_name == class_name) and
+                (res_sub_types is None or
+                 resource.res_sub_type in res_sub_types)))
+
+    def get_wmi_objs(self, class_name=None, res_sub_types=None):
+        return [resource.wmi_obj for resource in
+                self.get_resources(class_name, res_sub_types)]
@@ -64,6 +64,7 @@ class ClusterUtils(baseutils.BaseUtils):
     _WMI_EVENT_CHECK_INTERVAL = 2
 
     def __init__(self, host='.'):
+        self._host = host
         self._instance_name_regex = re.compile('Virtual Machine (.*)')
         self._clusapi_utils = _clusapi_utils.ClusApiUtils()
 
@@ -86,15 +87,18 @@ class ClusterUtils(baseutils.BaseUtils):
                 _("Could not initialize cluster wmi connection."))
 
     def _get_failover_watcher(self):
-        raw_query = ("SELECT * FROM __InstanceModificationEvent "
-                     "WITHIN %(wmi_check_interv)s WHERE TargetInstance ISA "
-                     "'%(cluster_res)s' AND "
-                     "TargetInstance.Type='%(cluster_res_type)s' AND "
-                     "TargetInstance.OwnerNode != PreviousInstance.OwnerNode" %
-                     {'wmi_check_interv': self._WMI_EVENT_CHECK_INTERVAL,
-                      'cluster_res': self._MSCLUSTER_RES,
-                      'cluster_res_type': self._VM_TYPE})
-        return self._conn_cluster.watch_for(raw_wql=raw_query)
+        return self._conn_cluster.watch_for(
+            raw_wql=self._get_failover_watcher_query())
+
+    def _get_failover_watcher_query(self):
+        return ("SELECT * FROM __InstanceModificationEvent "
+                "WITHIN %(wmi_check_interv)s WHERE TargetInstance ISA "
+                "'%(cluster_res)s' AND "
+                "TargetInstance.Type='%(cluster_res_type)s' AND "
+                "TargetInstance.OwnerNode != PreviousInstance.OwnerNode" %
+                {'wmi_check_interv': self._WMI_EVENT_CHECK_INTERVAL,
+                 'cluster_res': self._MSCLUSTER_RES,
+                 'cluster_res_type': self._VM_TYPE})
 
     def check_cluster_state(self):
         if len(self._get_cluster_nodes()) < 1:
@@ -473,8 +477,6 @@ class ClusterUtils(baseutils.BaseUtils):
         # stops using it. We should also remove the instance '_watcher'
         # attribute since we end up spawning unused event listeners.
 
-        vm_name = None
-        new_host = None
         try:
             # wait for new event for _WMI_EVENT_TIMEOUT_MS milliseconds.
             if patcher.is_monkey_patched('thread'):
@@ -483,26 +485,36 @@ class ClusterUtils(baseutils.BaseUtils):
             else:
                 wmi_object = self._watcher(event_timeout_ms)
 
-            old_host = wmi_object.previous.OwnerNode
-            new_host = wmi_object.OwnerNode
-            # wmi_object.Name field is of the form:
-            # 'Virtual Machine nova-instance-template'
-            # wmi_object.Name filed is a key and as such is not affected
-            # by locale, so it will always be 'Virtual Machine'
-            match = self._instance_name_regex.search(wmi_object.Name)
-            if match:
-                vm_name = match.group(1)
-
-            if vm_name:
-                try:
-                    callback(vm_name, old_host, new_host)
-                except Exception:
-                    LOG.exception(
-                        "Exception during failover callback.")
+            self._process_failover_event(wmi_object, callback)
         except exceptions.x_wmi_timed_out:
             pass
 
+    def _process_failover_event(self, wmi_object, callback):
+        vm_name = None
+        old_host = wmi_object.previous.OwnerNode
+        new_host = wmi_object.OwnerNode
+        # wmi_object.Name field is of the form:
+        # 'Virtual Machine nova-instance-template'
+        # wmi_object.Name filed is a key and as such is not affected
+        # by locale, so it will always be 'Virtual Machine'
+        match = self._instance_name_regex.search(wmi_object.Name)
+        if match:
+            vm_name = match.group(1)
+
+        if vm_name:
+            try:
+                callback(vm_name, old_host, new_host)
+            except Exception:
+                LOG.exception(
+                    "Exception during failover callback.")
+
     def get_vm_owner_change_listener(self):
+        # The events are retrieved by the namespace event hub, which is
+        # shared by all the os-win event listeners.
+        subscription = self._get_wmi_event_hub(
+            self._MS_CLUSTER_NAMESPACE % self._host).subscribe(
+                self._get_failover_watcher_query())
+
         def listener(callback):
             while True:
                 # We avoid setting an infinite timeout in order to let
@@ -510,9 +522,10 @@ class ClusterUtils(baseutils.BaseUtils):
                 # event listeners are meant to be used as long running
                 # daemons, so no stop API is provided ATM.
                 try:
-                    self.monitor_vm_failover(
-                        callback,
-                        constants.DEFAULT_WMI_EVENT_TIMEOUT_MS)
+                    wmi_object = subscription.get(
+                        timeout=constants.DEFAULT_WMI_EVENT_TIMEOUT_MS / 1000)
+                    if wmi_object is not None:
+                        self._process_failover_event(wmi_object, callback)
                 except Exception:
                     LOG.exception("The VM cluster group owner change "
                                   "event listener encountered an "
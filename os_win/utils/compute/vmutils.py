@@ -20,13 +20,13 @@ Based on the "root/virtualization/v2" namespace available starting with
 Hyper-V Server / Windows Server 2012.
 """
 
+import collections
 import functools
 import time
 import uuid
 
-from eventlet import patcher
-from eventlet import tpool
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import uuidutils
 from six.moves import range  # noqa
 
@@ -37,6 +37,11 @@ from os_win import exceptions
 from os_win.utils import _wqlutils
 from os_win.utils import baseutils
 from os_win.utils import jobutils
+from os_win.utils.compute import _disk_resource_index
+from os_win.utils.compute import _slot_allocator
+from os_win.utils.compute import _vm_lookup_cache
+from os_win.utils.compute import _vm_state_mirror
+from os_win.utils.compute import _vm_topology
 from os_win.utils import pathutils
 
 LOG = logging.getLogger(__name__)
@@ -127,7 +132,32 @@ class VMUtils(baseutils.BaseUtilsVirt):
         _IDE_CTRL_RES_SUB_TYPE: constants.CTRL_TYPE_IDE
     }
 
+    _vm_summary_fields_map = {
+        constants.VM_SUMMARY_NUM_PROCS: 'NumberOfProcessors',
+        constants.VM_SUMMARY_ENABLED_STATE: 'EnabledState',
+        constants.VM_SUMMARY_MEMORY_USAGE: 'MemoryUsage',
+        constants.VM_SUMMARY_UPTIME: 'UpTime'
+    }
+    _DEFAULT_SUMMARY_FIELDS = (constants.VM_SUMMARY_NUM_PROCS,
+                               constants.VM_SUMMARY_ENABLED_STATE,
+                               constants.VM_SUMMARY_MEMORY_USAGE,
+                               constants.VM_SUMMARY_UPTIME)
+
     _DEFAULT_EVENT_CHECK_TIMEFRAME = 60  # seconds
+    # Controller slots reserved for longer than this are considered
+    # abandoned when reloading the used slots.
+    _SLOT_RESERVATION_TIMEOUT = 300  # seconds
+    # The used controller slots are reloaded at this interval, in case
+    # other consumers (e.g. other processes) have attached drives.
+    _SLOT_ALLOCATOR_SYNC_INTERVAL = 60  # seconds
+
+    # Shared by all the VMUtils instances, the key being the host.
+    _vm_lookup_caches = {}
+    _disk_resource_indexes = {}
+    _vm_state_mirrors = {}
+    # The key is the (host, upper case controller path) tuple. The
+    # allocators are dropped when the according VMs are destroyed.
+    _slot_allocators = {}
 
     def __init__(self, host='.'):
         super(VMUtils, self).__init__(host)
@@ -164,41 +194,100 @@ class VMUtils(baseutils.BaseUtilsVirt):
         vmsettings = self._lookup_vm_check(vm_name)
 
         settings_paths = [vmsettings.path_()]
-        # See http://msdn.microsoft.com/en-us/library/cc160706%28VS.85%29.aspx
-        (ret_val, summary_info) = self._vs_man_svc.GetSummaryInformation(
-            [constants.VM_SUMMARY_NUM_PROCS,
-             constants.VM_SUMMARY_ENABLED_STATE,
-             constants.VM_SUMMARY_MEMORY_USAGE,
-             constants.VM_SUMMARY_UPTIME],
-            settings_paths)
-        if ret_val:
+        summary_info = self._get_summary_info(settings_paths,
+                                              self._DEFAULT_SUMMARY_FIELDS)
+        if summary_info is None:
             raise exceptions.HyperVException(
                 _('Cannot get VM summary data for: %s') % vm_name)
 
-        si = summary_info[0]
-        memory_usage = None
-        if si.MemoryUsage is not None:
-            memory_usage = int(si.MemoryUsage)
-        up_time = None
-        if si.UpTime is not None:
-            up_time = int(si.UpTime)
-
-        # Nova requires a valid state to be returned. Hyper-V has more
-        # states than Nova, typically intermediate ones and since there is
-        # no direct mapping for those, ENABLED is the only reasonable option
-        # considering that in all the non mappable states the instance
-        # is running.
-        enabled_state = self._enabled_states_map.get(si.EnabledState,
-                                                     constants.
-                                                     HYPERV_VM_STATE_ENABLED)
-
-        summary_info_dict = {'NumberOfProcessors': si.NumberOfProcessors,
-                             'EnabledState': enabled_state,
-                             'MemoryUsage': memory_usage,
-                             'UpTime': up_time}
+        return self._get_summary_info_dict(summary_info[0],
+                                           self._DEFAULT_SUMMARY_FIELDS)
+
+    def get_vms_summary_info(self, vm_names=None,
+                             fields=_DEFAULT_SUMMARY_FIELDS):
+        """Retrieves the summary info of multiple VMs at once.
+
+        The VM settings are retrieved using a single query, after which
+        the summary info of all the requested VMs is fetched through a
+        single GetSummaryInformation call.
+
+        :param vm_names: a list of VM names. If not specified, the summary
+            info of all the VMs is returned.
+        :param fields: a list of VM_SUMMARY_* constants.
+        :returns: a dict mapping the VM names to summary info dicts. VMs
+            that could not be found are omitted.
+        :raises exceptions.HyperVException: if the summary info could not
+            be retrieved or if multiple requested VMs have the same name.
+        """
+        for field in fields:
+            if field not in self._vm_summary_fields_map:
+                raise exceptions.InvalidParameterValue(
+                    param_name='fields', param_value=field)
+
+        requested_names = set(vm_names) if vm_names is not None else None
+        vm_paths = collections.OrderedDict()
+        for vssd in self._conn.Msvm_VirtualSystemSettingData(
+                ['ElementName'],
+                VirtualSystemType=self._VIRTUAL_SYSTEM_TYPE_REALIZED):
+            if requested_names is None or vssd.ElementName in requested_names:
+                if vssd.ElementName in vm_paths:
+                    raise exceptions.HyperVException(
+                        _('Duplicate VM name found: %s') % vssd.ElementName)
+                vm_paths[vssd.ElementName] = vssd.path_()
+
+        if not vm_paths:
+            return {}
+
+        summary_info = self._get_summary_info(list(vm_paths.values()),
+                                              fields)
+        if summary_info is None:
+            raise exceptions.HyperVException(
+                _('Cannot get the VM summary data.'))
+
+        # The summary info objects are returned in the same order as the
+        # settings paths.
+        return {vm_name: self._get_summary_info_dict(si, fields)
+                for vm_name, si in zip(vm_paths.keys(), summary_info)}
+
+    def _get_summary_info(self, settings_paths, fields):
+        # See http://msdn.microsoft.com/en-us/library/cc160706%28VS.85%29.aspx
+        (ret_val, summary_info) = self._vs_man_svc.GetSummaryInformation(
+            list(fields), settings_paths)
+        if ret_val:
+            LOG.debug("GetSummaryInformation failed. Return value: %s",
+                      ret_val)
+            return None
+        return summary_info
+
+    def _get_summary_info_dict(self, si, fields):
+        summary_info_dict = {}
+        for field in fields:
+            field_name = self._vm_summary_fields_map[field]
+            value = getattr(si, field_name)
+
+            if field == constants.VM_SUMMARY_ENABLED_STATE:
+                # Nova requires a valid state to be returned. Hyper-V has
+                # more states than Nova, typically intermediate ones and
+                # since there is no direct mapping for those, ENABLED is
+                # the only reasonable option considering that in all the
+                # non mappable states the instance is running.
+                value = self._enabled_states_map.get(
+                    value, constants.HYPERV_VM_STATE_ENABLED)
+            elif field in (constants.VM_SUMMARY_MEMORY_USAGE,
+                           constants.VM_SUMMARY_UPTIME):
+                value = int(value) if value is not None else None
+
+            summary_info_dict[field_name] = value
         return summary_info_dict
 
     def get_vm_state(self, vm_name):
+        vm_state_mirror = self._vm_state_mirrors.get(self._host)
+        if vm_state_mirror:
+            enabled_state = vm_state_mirror.get_state(vm_name)
+            if enabled_state is not None:
+                return self._enabled_states_map.get(
+                    enabled_state, constants.HYPERV_VM_STATE_ENABLED)
+
         settings = self.get_vm_summary_info(vm_name)
         return settings['EnabledState']
 
@@ -208,7 +297,153 @@ class VMUtils(baseutils.BaseUtilsVirt):
             raise exceptions.HyperVVMNotFoundException(vm_name=vm_name)
         return vm
 
+    def enable_vm_lookup_cache(self):
+        """Enables caching the VM lookups performed by os-win.
+
+        Almost all the operations require looking up the according VM WMI
+        objects. Once enabled, the VM object paths are cached and kept up to
+        date based on WMI events, avoiding WQL queries.
+
+        This will spawn a listener thread, for which reason it's opt-in.
+        The cache is shared by all the VMUtils instances using this host.
+        """
+        if self._host not in self._vm_lookup_caches:
+            vm_lookup_cache = _vm_lookup_cache.VMLookupCache(
+                self._conn,
+                self._get_wmi_event_hub(self._wmi_namespace % self._host))
+            vm_lookup_cache.start()
+            self._vm_lookup_caches[self._host] = vm_lookup_cache
+
+    def disable_vm_lookup_cache(self):
+        vm_lookup_cache = self._vm_lookup_caches.pop(self._host, None)
+        if vm_lookup_cache:
+            vm_lookup_cache.stop()
+
+    def enable_vm_state_mirror(self, resync_interval=300):
+        """Enables keeping an in memory copy of the VM power states.
+
+        Once enabled, get_vm_state, get_active_instances and vm_exists are
+        served from memory. The mirror is kept up to date based on WMI
+        events and is periodically reloaded in case of missed events.
+        get_vm_state and vm_exists fall back to querying WMI for VMs that
+        are not mirrored yet.
+
+        This will spawn a listener thread, for which reason it's opt-in.
+        The mirror is shared by all the VMUtils instances using this host.
+
+        :param resync_interval: the interval (in seconds) at which the
+            mirror is reloaded.
+        """
+        if self._host not in self._vm_state_mirrors:
+            vm_state_mirror = _vm_state_mirror.VMStateMirror(
+                self._conn,
+                self._get_wmi_event_hub(self._wmi_namespace % self._host),
+                resync_interval=resync_interval)
+            vm_state_mirror.start()
+            self._vm_state_mirrors[self._host] = vm_state_mirror
+
+    def disable_vm_state_mirror(self):
+        vm_state_mirror = self._vm_state_mirrors.pop(self._host, None)
+        if vm_state_mirror:
+            vm_state_mirror.stop()
+
+    def enable_disk_resource_index(self, track_events=True):
+        """Enables indexing the disk resources attached to VMs.
+
+        Disk attachment lookups are performed using an index mapping the
+        disk paths and serial numbers to the disk resources, instead of
+        enumerating all the disk resources on the host.
+
+        :param track_events: if set, the index is kept up to date based on
+            WMI events, which requires spawning a listener thread.
+            Otherwise, refresh_disk_resource_index may be used.
+        """
+        if self._host not in self._disk_resource_indexes:
+            res_sub_types = collections.defaultdict(list)
+            res_sub_types[self._RESOURCE_ALLOC_SETTING_DATA_CLASS].append(
+                self._PHYS_DISK_RES_SUB_TYPE)
+            res_sub_types[self._STORAGE_ALLOC_SETTING_DATA_CLASS] += [
+                self._HARD_DISK_RES_SUB_TYPE,
+                self._DVD_DISK_RES_SUB_TYPE]
+
+            disk_resource_index = _disk_resource_index.DiskResourceIndex(
+                self._compat_conn, dict(res_sub_types),
+                event_hub=self._get_wmi_event_hub(
+                    self._wmi_namespace % self._host))
+            disk_resource_index.start(track_events=track_events)
+            self._disk_resource_indexes[self._host] = disk_resource_index
+
+    def disable_disk_resource_index(self):
+        disk_resource_index = self._disk_resource_indexes.pop(self._host,
+                                                              None)
+        if disk_resource_index:
+            disk_resource_index.stop()
+
+    def refresh_disk_resource_index(self):
+        disk_resource_index = self._disk_resource_indexes.get(self._host)
+        if disk_resource_index:
+            disk_resource_index.refresh()
+
+    def _lookup_cached_vm(self, vm_lookup_cache, vm_name, as_vssd,
+                          for_update):
+        entry = vm_lookup_cache.get(vm_name)
+        if not entry:
+            return
+
+        vm_path = entry.vssd_path if as_vssd else entry.vm_path
+        if vm_path:
+            try:
+                vm = self._get_wmi_obj(vm_path, as_vssd and for_update)
+            except exceptions.x_wmi as ex:
+                if not _utils._is_not_found_exc(ex):
+                    raise
+                vm = None
+        elif entry.instance_id:
+            # Entries added based on events only include the VM id.
+            vm = self._get_vm_by_instance_id(vm_lookup_cache,
+                                             entry.instance_id,
+                                             as_vssd, for_update)
+            if vm is not None and vm.ElementName == vm_name:
+                self._update_vm_lookup_cache(vm_lookup_cache, vm_name, vm,
+                                             as_vssd)
+        else:
+            return
+
+        if vm is None or vm.ElementName != vm_name:
+            # The VM was removed or renamed meanwhile.
+            vm_lookup_cache.invalidate(vm_name)
+            return
+        return vm
+
+    def _get_vm_by_instance_id(self, vm_lookup_cache, instance_id, as_vssd,
+                               for_update):
+        if as_vssd:
+            conn = self._compat_conn if for_update else self._conn
+            vms = conn.Msvm_VirtualSystemSettingData(InstanceID=instance_id)
+        else:
+            vms = self._conn.Msvm_ComputerSystem(
+                Name=vm_lookup_cache.get_vm_id(instance_id))
+        return vms[0] if vms else None
+
+    def _update_vm_lookup_cache(self, vm_lookup_cache, vm_name, vm,
+                                as_vssd):
+        if as_vssd:
+            if vm.VirtualSystemType == self._VIRTUAL_SYSTEM_TYPE_REALIZED:
+                vm_lookup_cache.update(vm_name, vssd_path=vm.path_(),
+                                       instance_id=vm.InstanceID)
+        else:
+            vm_lookup_cache.update(
+                vm_name, vm_path=vm.path_(),
+                instance_id=vm_lookup_cache.get_instance_id(vm.Name))
+
     def _lookup_vm(self, vm_name, as_vssd=True, for_update=False):
+        vm_lookup_cache = self._vm_lookup_caches.get(self._host)
+        if vm_lookup_cache:
+            vm = self._lookup_cached_vm(vm_lookup_cache, vm_name,
+                                        as_vssd, for_update)
+            if vm:
+                return vm
+
         if as_vssd:
             conn = self._compat_conn if for_update else self._conn
             vms = conn.Msvm_VirtualSystemSettingData(ElementName=vm_name)
@@ -224,6 +459,9 @@ class VMUtils(baseutils.BaseUtilsVirt):
             raise exceptions.HyperVException(
                 _('Duplicate VM name found: %s') % vm_name)
         else:
+            if vm_lookup_cache:
+                self._update_vm_lookup_cache(vm_lookup_cache, vm_name,
+                                             vms[0], as_vssd)
             return vms[0]
 
     def vm_exists(self, vm_name):
@@ -231,6 +469,10 @@ class VMUtils(baseutils.BaseUtilsVirt):
         # NOTE(claudiub): A planned VM and a realized VM cannot exist at the
         # same time on the same host. The 2 types must be treated separately,
         # thus, this will only check if the Realized VM exits.
+        vm_state_mirror = self._vm_state_mirrors.get(self._host)
+        if vm_state_mirror and vm_state_mirror.exists(vm_name):
+            return True
+        # The mirror may not have caught up with recently created VMs.
         return self._lookup_vm(vm_name, False) is not None
 
     def get_vm_id(self, vm_name):
@@ -243,6 +485,14 @@ class VMUtils(baseutils.BaseUtilsVirt):
             self._compat_conn, self._MEMORY_SETTING_DATA_CLASS,
             element_instance_id=vmsetting.InstanceID)[0]
 
+        self._configure_memory_settings(mem_settings, memory_mb,
+                                        memory_per_numa_node,
+                                        dynamic_memory_ratio)
+        self._jobutils.modify_virt_resource(mem_settings)
+
+    def _configure_memory_settings(self, mem_settings, memory_mb,
+                                   memory_per_numa_node,
+                                   dynamic_memory_ratio):
         max_mem = int(memory_mb)
         mem_settings.Limit = max_mem
 
@@ -264,14 +514,19 @@ class VMUtils(baseutils.BaseUtilsVirt):
             # One memory block is 1 MB.
             mem_settings.MaxMemoryBlocksPerNumaNode = memory_per_numa_node
 
-        self._jobutils.modify_virt_resource(mem_settings)
-
     def _set_vm_vcpus(self, vmsetting, vcpus_num, vcpus_per_numa_node,
                       limit_cpu_features):
         procsetting = _wqlutils.get_element_associated_class(
             self._compat_conn, self._PROCESSOR_SETTING_DATA_CLASS,
             element_instance_id=vmsetting.InstanceID)[0]
 
+        self._configure_vcpus_settings(procsetting, vcpus_num,
+                                       vcpus_per_numa_node,
+                                       limit_cpu_features)
+        self._jobutils.modify_virt_resource(procsetting)
+
+    def _configure_vcpus_settings(self, procsetting, vcpus_num,
+                                  vcpus_per_numa_node, limit_cpu_features):
         vcpus = int(vcpus_num)
         procsetting.VirtualQuantity = vcpus
         procsetting.Reservation = vcpus
@@ -281,8 +536,6 @@ class VMUtils(baseutils.BaseUtilsVirt):
         if vcpus_per_numa_node:
             procsetting.MaxProcessorsPerNumaNode = vcpus_per_numa_node
 
-        self._jobutils.modify_virt_resource(procsetting)
-
     def set_nested_virtualization(self, vm_name, state):
         """Enables nested virtualization for the given VM.
 
@@ -365,6 +618,18 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
     def _create_vm_obj(self, vm_name, vnuma_enabled, vm_gen, notes,
                        instance_path):
+        vs_data = self._get_new_vssd(vm_name, vnuma_enabled, vm_gen, notes,
+                                     instance_path)
+
+        (job_path,
+         vm_path,
+         ret_val) = self._vs_man_svc.DefineSystem(
+            ResourceSettings=[], ReferenceConfiguration=None,
+            SystemSettings=vs_data.GetText_(1))
+        self._jobutils.check_ret_val(ret_val, job_path)
+
+    def _get_new_vssd(self, vm_name, vnuma_enabled, vm_gen, notes,
+                      instance_path):
         vs_data = self._compat_conn.Msvm_VirtualSystemSettingData.new()
         vs_data.ElementName = vm_name
         vs_data.Notes = notes
@@ -384,48 +649,217 @@ class VMUtils(baseutils.BaseUtilsVirt):
         vs_data.SnapshotDataRoot = instance_path
         vs_data.SuspendDataRoot = instance_path
         vs_data.SwapFileDataRoot = instance_path
+        return vs_data
+
+    def create_vm_from_spec(self, spec):
+        """Creates a VM based on the given specification.
+
+        The VM is defined using a single job, along with its memory and
+        processor settings and NICs. The SCSI controllers are added using
+        the same resource batch as the drives attached to them, unless no
+        drives were requested, in which case they're part of the VM
+        definition.
+
+        :param spec: a dict containing the following keys:
+            - name: the VM name
+            - vm_gen: the VM generation
+            - instance_path: the location of the VM files
+            - memory_mb: the VM memory
+            - vcpus_num: the number of VM vCPUs
+            - notes (optional): a list of VM notes
+            - dynamic_memory_ratio (optional, default 1)
+            - limit_cpu_features (optional, default False)
+            - memory_per_numa_node (optional)
+            - vcpus_per_numa_node (optional)
+            - scsi_controllers (optional, default 1): the number of SCSI
+              controllers that will be added.
+            - nics (optional): a list of (nic_name, mac_address) tuples
+            - disks (optional): a list of (path, drive_type, controller)
+              tuples, as accepted by attach_volumes. If the controller is
+              None or constants.CTRL_TYPE_SCSI, the drive is attached to
+              the first new SCSI controller having free slots.
+        :returns: the volume attachment results, as returned by
+            attach_volumes.
+        """
+        vm_name = spec['name']
+        dynamic_memory_ratio = spec.get('dynamic_memory_ratio', 1)
+
+        LOG.debug('Creating VM %s', vm_name)
+
+        # vNUMA and dynamic memory are mutually exclusive
+        vnuma_enabled = dynamic_memory_ratio <= 1
+        vs_data = self._get_new_vssd(vm_name, vnuma_enabled, spec['vm_gen'],
+                                     spec.get('notes'),
+                                     spec['instance_path'])
+
+        mem_settings = self._get_new_setting_data(
+            self._MEMORY_SETTING_DATA_CLASS)
+        self._configure_memory_settings(mem_settings, spec['memory_mb'],
+                                        spec.get('memory_per_numa_node'),
+                                        dynamic_memory_ratio)
+
+        procsetting = self._get_new_setting_data(
+            self._PROCESSOR_SETTING_DATA_CLASS)
+        self._configure_vcpus_settings(procsetting, spec['vcpus_num'],
+                                       spec.get('vcpus_per_numa_node'),
+                                       spec.get('limit_cpu_features', False))
+
+        scsi_controllers = []
+        while len(scsi_controllers) < spec.get('scsi_controllers', 1):
+            scsicontrl = self._get_new_resource_setting_data(
+                self._SCSI_CTRL_RES_SUB_TYPE)
+            scsicontrl.VirtualSystemIdentifiers = [
+                '{' + str(uuid.uuid4()) + '}']
+            scsi_controllers.append(scsicontrl)
+
+        disks = spec.get('disks') or []
+        resources = [mem_settings, procsetting]
+        if not disks:
+            resources += scsi_controllers
+            scsi_controllers = []
+
+        for nic_name, mac_address in spec.get('nics', []):
+            resources.append(self._get_new_nic_data(nic_name, mac_address))
 
         (job_path,
          vm_path,
          ret_val) = self._vs_man_svc.DefineSystem(
-            ResourceSettings=[], ReferenceConfiguration=None,
+            ResourceSettings=[res.GetText_(1) for res in resources],
+            ReferenceConfiguration=None,
             SystemSettings=vs_data.GetText_(1))
         self._jobutils.check_ret_val(ret_val, job_path)
 
+        if not disks:
+            return []
+        return self._add_controllers_and_volumes(vm_name, scsi_controllers,
+                                                 disks)
+
+    def _add_controllers_and_volumes(self, vm_name, scsi_controllers,
+                                     volumes):
+        vmsettings = self._lookup_vm_check(vm_name)
+        batch = self._jobutils.virt_resource_batch(vmsettings)
+        ctrl_requests = [batch.add(scsicontrl)
+                         for scsicontrl in scsi_controllers]
+        # The new controllers do not have any drives attached.
+        free_slots = ((ctrl_request, slot)
+                      for ctrl_request in ctrl_requests
+                      for slot in range(
+                          constants.SCSI_CONTROLLER_SLOTS_NUMBER))
+
+        results = [None] * len(volumes)
+        requests = {}
+        other_volumes = {}
+        for idx, (path, drive_type, ctrller_path) in enumerate(volumes):
+            if ctrller_path not in (None, constants.CTRL_TYPE_SCSI):
+                other_volumes[idx] = (path, drive_type, ctrller_path)
+                continue
+
+            ctrl_request, drive_addr = next(free_slots, (None, None))
+            if not ctrl_request:
+                results[idx] = exceptions.HyperVException(
+                    _("No free SCSI controller slot is left for %(path)s "
+                      "on vm %(vm_name)s.") %
+                    dict(path=path, vm_name=vm_name))
+                continue
+
+            try:
+                requests[idx] = self._add_volume_to_batch(
+                    batch, path, drive_type, None, drive_addr,
+                    ctrl_request=ctrl_request)
+            except Exception as ex:
+                results[idx] = ex
+
+        batch.commit()
+        for ctrl_request in ctrl_requests:
+            ctrl_request.result()
+
+        for idx, (request, drive_request) in requests.items():
+            try:
+                results[idx] = request.result()
+            except Exception as ex:
+                LOG.error("Failed to attach %(path)s to vm %(vm_name)s. "
+                          "Exception: %(ex)s",
+                          dict(path=volumes[idx][0], vm_name=vm_name, ex=ex))
+                results[idx] = ex
+                if drive_request and drive_request.path:
+                    self._remove_drive(drive_request.path)
+
+        if other_volumes:
+            other_results = self.attach_volumes(vm_name,
+                                                list(other_volumes.values()))
+            for idx, result in zip(other_volumes, other_results):
+                results[idx] = result
+        return results
+
     @_utils.retry_decorator(exceptions=exceptions.HyperVException)
     def _modify_virtual_system(self, vmsetting):
         (job_path, ret_val) = self._vs_man_svc.ModifySystemSettings(
             SystemSettings=vmsetting.GetText_(1))
         self._jobutils.check_ret_val(ret_val, job_path)
 
-    def get_vm_scsi_controller(self, vm_name):
+    def get_vm_topology(self, vm_name):
+        """Returns a snapshot of the VM resources.
+
+        All the VM resource and storage allocation setting data objects are
+        retrieved using two queries. The resulting snapshot can be passed
+        to the VM resource getters, avoiding subsequent queries.
+        """
         vmsettings = self._lookup_vm_check(vm_name)
-        return self._get_vm_scsi_controller(vmsettings)
 
-    def _get_vm_scsi_controller(self, vmsettings):
+        class_names = [self._RESOURCE_ALLOC_SETTING_DATA_CLASS]
+        if (self._STORAGE_ALLOC_SETTING_DATA_CLASS !=
+                self._RESOURCE_ALLOC_SETTING_DATA_CLASS):
+            class_names.append(self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+
+        wmi_objs_by_class = [
+            (class_name, _wqlutils.get_element_associated_class(
+                self._compat_conn, class_name,
+                element_instance_id=vmsettings.InstanceID))
+            for class_name in class_names]
+        return _vm_topology.VMTopology(vm_name, vmsettings.InstanceID,
+                                       wmi_objs_by_class)
+
+    def _get_vm_resources(self, vmsettings, class_name, topology=None,
+                          conn=None):
+        if topology:
+            return topology.get_wmi_objs(class_name)
+        return _wqlutils.get_element_associated_class(
+            conn or self._conn, class_name,
+            element_instance_id=vmsettings.InstanceID)
+
+    def get_vm_scsi_controller(self, vm_name, topology=None):
+        vmsettings = None if topology else self._lookup_vm_check(vm_name)
+        return self._get_vm_scsi_controller(vmsettings, topology=topology)
+
+    def _get_vm_scsi_controller(self, vmsettings, topology=None):
         res = self._get_vm_disk_controllers(vmsettings,
-                                            self._SCSI_CTRL_RES_SUB_TYPE)
+                                            self._SCSI_CTRL_RES_SUB_TYPE,
+                                            topology=topology)
         return res[0].path_() if res else None
 
-    def _get_vm_disk_controllers(self, vmsettings, ctrl_res_sub_type):
-        rasds = _wqlutils.get_element_associated_class(
-            self._conn, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
-            element_instance_id=vmsettings.InstanceID)
+    def _get_vm_disk_controllers(self, vmsettings, ctrl_res_sub_type,
+                                 topology=None):
+        rasds = self._get_vm_resources(
+            vmsettings, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+            topology=topology)
         res = [r for r in rasds
                if r.ResourceSubType == ctrl_res_sub_type]
         return res
 
-    def _get_vm_ide_controller(self, vmsettings, ctrller_addr):
+    def _get_vm_ide_controller(self, vmsettings, ctrller_addr,
+                               topology=None):
         ide_ctrls = self._get_vm_disk_controllers(vmsettings,
-                                                  self._IDE_CTRL_RES_SUB_TYPE)
+                                                  self._IDE_CTRL_RES_SUB_TYPE,
+                                                  topology=topology)
         ctrl = [r for r in ide_ctrls
                 if r.Address == str(ctrller_addr)]
 
         return ctrl[0].path_() if ctrl else None
 
-    def get_vm_ide_controller(self, vm_name, ctrller_addr):
-        vmsettings = self._lookup_vm_check(vm_name)
-        return self._get_vm_ide_controller(vmsettings, ctrller_addr)
+    def get_vm_ide_controller(self, vm_name, ctrller_addr, topology=None):
+        vmsettings = None if topology else self._lookup_vm_check(vm_name)
+        return self._get_vm_ide_controller(vmsettings, ctrller_addr,
+                                           topology=topology)
 
     def _get_disk_ctrl_addr(self, controller_path):
         ctrl = self._get_wmi_obj(controller_path)
@@ -462,21 +896,13 @@ class VMUtils(baseutils.BaseUtilsVirt):
                     'parent': scsi_controller_path.replace("'", "''")})
 
     def _get_new_setting_data(self, class_name):
-        obj = self._compat_conn.query("SELECT * FROM %s WHERE InstanceID "
-                                      "LIKE '%%\\Default'" % class_name)[0]
-        return obj
+        return self._get_default_setting_data(class_name)
 
     def _get_new_resource_setting_data(self, resource_sub_type,
                                        class_name=None):
         if class_name is None:
             class_name = self._RESOURCE_ALLOC_SETTING_DATA_CLASS
-        obj = self._compat_conn.query("SELECT * FROM %(class_name)s "
-                                      "WHERE ResourceSubType = "
-                                      "'%(res_sub_type)s' AND "
-                                      "InstanceID LIKE '%%\\Default'" %
-                                      {"class_name": class_name,
-                                       "res_sub_type": resource_sub_type})[0]
-        return obj
+        return self._get_default_setting_data(class_name, resource_sub_type)
 
     def attach_scsi_drive(self, vm_name, path, drive_type=constants.DISK):
         vmsettings = self._lookup_vm_check(vm_name)
@@ -492,23 +918,31 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
     def attach_drive(self, vm_name, path, ctrller_path, drive_addr,
                      drive_type=constants.DISK):
-        """Create a drive and attach it to the vm."""
+        """Create a drive and attach it to the vm.
 
-        vm = self._lookup_vm_check(vm_name, as_vssd=False)
+        The controller slot is marked as used if the drive is attached,
+        being released otherwise.
+        """
+        try:
+            vm = self._lookup_vm_check(vm_name, as_vssd=False)
 
-        if drive_type == constants.DISK:
-            res_sub_type = self._DISK_DRIVE_RES_SUB_TYPE
-        elif drive_type == constants.DVD:
-            res_sub_type = self._DVD_DRIVE_RES_SUB_TYPE
+            if drive_type == constants.DISK:
+                res_sub_type = self._DISK_DRIVE_RES_SUB_TYPE
+            elif drive_type == constants.DVD:
+                res_sub_type = self._DVD_DRIVE_RES_SUB_TYPE
 
-        drive = self._get_new_resource_setting_data(res_sub_type)
+            drive = self._get_new_resource_setting_data(res_sub_type)
 
-        # Set the ctrller as parent.
-        drive.Parent = ctrller_path
-        drive.Address = drive_addr
-        drive.AddressOnParent = drive_addr
-        # Add the cloned disk drive object to the vm.
-        new_resources = self._jobutils.add_virt_resource(drive, vm)
+            # Set the ctrller as parent.
+            drive.Parent = ctrller_path
+            drive.Address = drive_addr
+            drive.AddressOnParent = drive_addr
+            # Add the cloned disk drive object to the vm.
+            new_resources = self._jobutils.add_virt_resource(drive, vm)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._release_controller_slot(ctrller_path, drive_addr,
+                                              sync=True)
         drive_path = new_resources[0]
 
         if drive_type == constants.DISK:
@@ -532,8 +966,11 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
             drive = self._get_wmi_obj(drive_path)
             self._jobutils.remove_virt_resource(drive)
+            self._release_controller_slot(ctrller_path, drive_addr)
             raise
 
+        self._commit_controller_slot(ctrller_path, drive_addr)
+
     def get_disk_attachment_info(self, attached_disk_path=None,
                                  is_physical=True, serial=None):
         res = self._get_mounted_disk_resource_from_path(attached_disk_path,
@@ -578,19 +1015,28 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
     def attach_volume_to_controller(self, vm_name, controller_path, address,
                                     mounted_disk_path, serial=None):
-        """Attach a volume to a controller."""
+        """Attach a volume to a controller.
 
-        vmsettings = self._lookup_vm_check(vm_name)
+        The controller slot is marked as used if the volume is attached,
+        being released otherwise.
+        """
+        try:
+            vmsettings = self._lookup_vm_check(vm_name)
 
-        diskdrive = self._get_new_resource_setting_data(
-            self._PHYS_DISK_RES_SUB_TYPE)
+            diskdrive = self._get_new_resource_setting_data(
+                self._PHYS_DISK_RES_SUB_TYPE)
 
-        diskdrive.AddressOnParent = address
-        diskdrive.Parent = controller_path
-        diskdrive.HostResource = [mounted_disk_path]
+            diskdrive.AddressOnParent = address
+            diskdrive.Parent = controller_path
+            diskdrive.HostResource = [mounted_disk_path]
 
-        diskdrive_path = self._jobutils.add_virt_resource(diskdrive,
-                                                          vmsettings)[0]
+            diskdrive_path = self._jobutils.add_virt_resource(
+                diskdrive, vmsettings)[0]
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._release_controller_slot(controller_path, address,
+                                              sync=True)
+        self._commit_controller_slot(controller_path, address)
 
         if serial:
             # Apparently this can't be set when the resource is added.
@@ -598,10 +1044,194 @@ class VMUtils(baseutils.BaseUtilsVirt):
             diskdrive.ElementName = serial
             self._jobutils.modify_virt_resource(diskdrive)
 
-    def get_vm_physical_disk_mapping(self, vm_name, is_planned_vm=False):
+    def attach_volumes(self, vm_name, volumes):
+        """Attach multiple disk images or passthrough disks to a VM.
+
+        The VM and its disk controllers are retrieved once. The controller
+        slots are reserved using the shared slot allocators, so that
+        concurrent attach operations get distinct slots. The drives are
+        added using as few jobs as possible.
+
+        :param vm_name: the name of the VM.
+        :param volumes: a list of (path, drive_type, controller)
+            tuples. The drive type can be constants.DISK, constants.DVD or
+            constants.VOLUME, in which case the path is expected to be the
+            mounted disk path. The controller can be either a controller
+            path or a controller type (constants.CTRL_TYPE_IDE or
+            constants.CTRL_TYPE_SCSI), in which case the first controller
+            of that type having free slots is used. If the controller
+            is None, the first SCSI controller of the VM is used.
+        :returns: a list containing the path of the resulting resource
+            for each requested volume, or the encountered exception if the
+            volume could not be attached. Only the drives of the volumes
+            that failed to be attached are reverted.
+        """
+        vmsettings = self._lookup_vm_check(vm_name)
+        rasds = _wqlutils.get_element_associated_class(
+            self._conn, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+            element_instance_id=vmsettings.InstanceID)
+
+        ctrl_slots = self._get_controller_slots(rasds)
+        ctrl_paths = collections.defaultdict(list)
+        for rasd in sorted(rasds, key=lambda r: r.Address or ''):
+            ctrl_type = self._disk_ctrl_type_mapping.get(rasd.ResourceSubType)
+            if ctrl_type:
+                ctrl_paths[ctrl_type].append(rasd.path_())
+
+        results = [None] * len(volumes)
+        batch = self._jobutils.virt_resource_batch(vmsettings)
+        requests = {}
+        drive_requests = {}
+        reserved_slots = {}
+        synced_ctrl_paths = set()
+        for idx, (path, drive_type, ctrller_path) in enumerate(volumes):
+            try:
+                ctrller_path, allocator, drive_addr = (
+                    self._reserve_volume_slot(
+                        vm_name, ctrller_path or constants.CTRL_TYPE_SCSI,
+                        ctrl_paths, ctrl_slots, synced_ctrl_paths))
+                reserved_slots[idx] = (allocator, drive_addr)
+
+                requests[idx], drive_requests[idx] = self._add_volume_to_batch(
+                    batch, path, drive_type, ctrller_path, drive_addr)
+            except Exception as ex:
+                results[idx] = ex
+                if idx in reserved_slots:
+                    allocator, drive_addr = reserved_slots.pop(idx)
+                    allocator.release(drive_addr)
+
+        batch.commit()
+
+        for idx, request in requests.items():
+            allocator, drive_addr = reserved_slots[idx]
+            try:
+                results[idx] = request.result()
+            except Exception as ex:
+                LOG.error("Failed to attach %(path)s to vm %(vm_name)s. "
+                          "Exception: %(ex)s",
+                          dict(path=volumes[idx][0], vm_name=vm_name, ex=ex))
+                results[idx] = ex
+
+                drive_request = drive_requests[idx]
+                if (drive_request and drive_request.path and
+                        not self._remove_drive(drive_request.path)):
+                    # The drive is still attached, keeping the slot.
+                    allocator.commit(drive_addr)
+                else:
+                    allocator.release(drive_addr)
+            else:
+                allocator.commit(drive_addr)
+
+        return results
+
+    def _reserve_volume_slot(self, vm_name, ctrller_path, ctrl_paths,
+                             ctrl_slots, synced_ctrl_paths):
+        if ctrller_path in ctrl_paths:
+            # A controller type was requested.
+            candidate_paths = ctrl_paths[ctrller_path]
+        else:
+            candidate_paths = [ctrller_path]
+
+        exc = None
+        for ctrl_path in candidate_paths:
+            ctrl_key = ctrl_path.upper()
+            if ctrl_key not in ctrl_slots:
+                raise exceptions.HyperVException(
+                    _("Could not find disk controller %(ctrller_path)s "
+                      "of vm %(vm_name)s.") %
+                    dict(ctrller_path=ctrl_path, vm_name=vm_name))
+
+            # The allocators are refreshed using the used slots retrieved
+            # by this call, once per controller.
+            sync = ctrl_key not in synced_ctrl_paths
+            synced_ctrl_paths.add(ctrl_key)
+
+            slots_number, used_slots = ctrl_slots[ctrl_key]
+            try:
+                allocator, slot = self._reserve_controller_slot(
+                    ctrl_path, sync_on_miss=False, sync=sync,
+                    slots_number=slots_number, used_slots=used_slots)
+                return ctrl_path, allocator, slot
+            except exceptions.HyperVException as ex:
+                exc = ex
+        raise exc
+
+    def _get_controller_slots(self, rasds):
+        """Returns the slots number and the used slots of each controller.
+
+        The controllers are keyed by their upper case path.
+        """
+        slots_number = {
+            self._SCSI_CTRL_RES_SUB_TYPE:
+                constants.SCSI_CONTROLLER_SLOTS_NUMBER,
+            self._IDE_CTRL_RES_SUB_TYPE:
+                constants.IDE_CONTROLLER_SLOTS_NUMBER}
+        drive_res_sub_types = [self._PHYS_DISK_RES_SUB_TYPE,
+                               self._DISK_DRIVE_RES_SUB_TYPE,
+                               self._DVD_DRIVE_RES_SUB_TYPE]
+
+        used_slots = collections.defaultdict(set)
+        for rasd in rasds:
+            if rasd.ResourceSubType in drive_res_sub_types and rasd.Parent:
+                used_slots[rasd.Parent.upper()].add(
+                    int(rasd.AddressOnParent))
+
+        ctrl_slots = {}
+        for rasd in rasds:
+            if rasd.ResourceSubType in slots_number:
+                ctrl_path = rasd.path_().upper()
+                ctrl_slots[ctrl_path] = (slots_number[rasd.ResourceSubType],
+                                         used_slots[ctrl_path])
+        return ctrl_slots
+
+    def _add_volume_to_batch(self, batch, path, drive_type, ctrller_path,
+                             drive_addr, ctrl_request=None):
+        # If the controller is part of the same batch, its path will be set
+        # as parent once the controller is added.
+        if drive_type == constants.VOLUME:
+            diskdrive = self._get_new_resource_setting_data(
+                self._PHYS_DISK_RES_SUB_TYPE)
+            diskdrive.AddressOnParent = drive_addr
+            diskdrive.Parent = ctrller_path
+            diskdrive.HostResource = [path]
+            return batch.add(diskdrive, parent_request=ctrl_request), None
+
+        if drive_type == constants.DISK:
+            drive_res_sub_type = self._DISK_DRIVE_RES_SUB_TYPE
+            res_sub_type = self._HARD_DISK_RES_SUB_TYPE
+        elif drive_type == constants.DVD:
+            drive_res_sub_type = self._DVD_DRIVE_RES_SUB_TYPE
+            res_sub_type = self._DVD_DISK_RES_SUB_TYPE
+        else:
+            raise exceptions.InvalidParameterValue(
+                param_name='drive_type', param_value=drive_type)
+
+        drive = self._get_new_resource_setting_data(drive_res_sub_type)
+        drive.Parent = ctrller_path
+        drive.Address = drive_addr
+        drive.AddressOnParent = drive_addr
+        drive_request = batch.add(drive, parent_request=ctrl_request)
+
+        res = self._get_new_resource_setting_data(
+            res_sub_type, self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+        res.HostResource = [path]
+        # The drive path will be set as parent once the drive is added.
+        return batch.add(res, parent_request=drive_request), drive_request
+
+    def _remove_drive(self, drive_path):
+        try:
+            drive = self._get_wmi_obj(drive_path)
+            self._jobutils.remove_virt_resource(drive)
+            return True
+        except Exception:
+            LOG.exception("Failed to remove drive: %s", drive_path)
+            return False
+
+    def get_vm_physical_disk_mapping(self, vm_name, is_planned_vm=False,
+                                     topology=None):
         mapping = {}
         physical_disks = (
-            self.get_vm_disks(vm_name)[1])
+            self.get_vm_disks(vm_name, topology=topology)[1])
         for diskdrive in physical_disks:
             mapping[diskdrive.ElementName] = dict(
                 resource_path=diskdrive.path_(),
@@ -652,17 +1282,20 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
         raise exceptions.HyperVvNicNotFound(vnic_name=name)
 
-    def create_nic(self, vm_name, nic_name, mac_address):
-        """Create a (synthetic) nic and attach it to the vm."""
-        # Create a new nic
+    def _get_new_nic_data(self, nic_name, mac_address):
+        """Returns a new synthetic nic, having a static MAC address."""
         new_nic_data = self._get_new_setting_data(
             self._SYNTHETIC_ETHERNET_PORT_SETTING_DATA_CLASS)
 
-        # Configure the nic
         new_nic_data.ElementName = nic_name
         new_nic_data.Address = mac_address.replace(':', '')
         new_nic_data.StaticMacAddress = 'True'
         new_nic_data.VirtualSystemIdentifiers = ['{' + str(uuid.uuid4()) + '}']
+        return new_nic_data
+
+    def create_nic(self, vm_name, nic_name, mac_address):
+        """Create a (synthetic) nic and attach it to the vm."""
+        new_nic_data = self._get_new_nic_data(nic_name, mac_address)
 
         # Add the new nic to the vm
         vmsettings = self._lookup_vm_check(vm_name)
@@ -720,9 +1353,11 @@ class VMUtils(baseutils.BaseUtilsVirt):
         vmsettings = self._lookup_vm_check(vm_name)
         return vmsettings.ConfigurationDataRoot
 
-    def get_vm_storage_paths(self, vm_name, is_planned_vm=False):
-        vmsettings = self._lookup_vm_check(vm_name)
-        (disk_resources, volume_resources) = self._get_vm_disks(vmsettings)
+    def get_vm_storage_paths(self, vm_name, is_planned_vm=False,
+                             topology=None):
+        vmsettings = None if topology else self._lookup_vm_check(vm_name)
+        (disk_resources, volume_resources) = self._get_vm_disks(
+            vmsettings, topology=topology)
 
         volume_drives = []
         for volume_resource in volume_resources:
@@ -736,14 +1371,14 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
         return (disk_files, volume_drives)
 
-    def get_vm_disks(self, vm_name, is_planned_vm=False):
-        vmsettings = self._lookup_vm_check(vm_name)
-        return self._get_vm_disks(vmsettings)
+    def get_vm_disks(self, vm_name, is_planned_vm=False, topology=None):
+        vmsettings = None if topology else self._lookup_vm_check(vm_name)
+        return self._get_vm_disks(vmsettings, topology=topology)
 
-    def _get_vm_disks(self, vmsettings):
-        rasds = _wqlutils.get_element_associated_class(
-            self._compat_conn, self._STORAGE_ALLOC_SETTING_DATA_CLASS,
-            element_instance_id=vmsettings.InstanceID)
+    def _get_vm_disks(self, vmsettings, topology=None):
+        rasds = self._get_vm_resources(
+            vmsettings, self._STORAGE_ALLOC_SETTING_DATA_CLASS,
+            topology=topology, conn=self._compat_conn)
         disk_resources = [r for r in rasds if
                           r.ResourceSubType in
                           [self._HARD_DISK_RES_SUB_TYPE,
@@ -751,9 +1386,9 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
         if (self._RESOURCE_ALLOC_SETTING_DATA_CLASS !=
                 self._STORAGE_ALLOC_SETTING_DATA_CLASS):
-            rasds = _wqlutils.get_element_associated_class(
-                self._compat_conn, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
-                element_instance_id=vmsettings.InstanceID)
+            rasds = self._get_vm_resources(
+                vmsettings, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                topology=topology, conn=self._compat_conn)
 
         volume_resources = [r for r in rasds if
                             r.ResourceSubType == self._PHYS_DISK_RES_SUB_TYPE]
@@ -765,8 +1400,21 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
         # Remove the VM. It does not destroy any associated virtual disk.
         (job_path, ret_val) = self._vs_man_svc.DestroySystem(vm.path_())
+        self._drop_vm_slot_allocators(vm.Name)
         self._jobutils.check_ret_val(ret_val, job_path)
 
+    def destroy_vm_async(self, vm_name, progress_callback=None):
+        """Non-blocking version of destroy_vm.
+
+        :returns: a jobutils.WMIJobFuture object.
+        """
+        vm = self._lookup_vm_check(vm_name, as_vssd=False)
+
+        (job_path, ret_val) = self._vs_man_svc.DestroySystem(vm.path_())
+        self._drop_vm_slot_allocators(vm.Name)
+        return self._jobutils.check_ret_val_async(
+            ret_val, job_path, progress_callback=progress_callback)
+
     def take_vm_snapshot(self, vm_name, snapshot_name=None):
         vm = self._lookup_vm_check(vm_name, as_vssd=False)
         vs_snap_svc = self._compat_conn.Msvm_VirtualSystemSnapshotService()[0]
@@ -776,6 +1424,29 @@ class VMUtils(baseutils.BaseUtilsVirt):
             SnapshotType=self._SNAPSHOT_FULL)
 
         job = self._jobutils.check_ret_val(ret_val, job_path)
+        return self._get_snapshot_path_from_job(job, snapshot_name)
+
+    def take_vm_snapshot_async(self, vm_name, snapshot_name=None,
+                               progress_callback=None):
+        """Non-blocking version of take_vm_snapshot.
+
+        :returns: a jobutils.WMIJobFuture object, the result being the
+            snapshot path.
+        """
+        vm = self._lookup_vm_check(vm_name, as_vssd=False)
+        vs_snap_svc = self._compat_conn.Msvm_VirtualSystemSnapshotService()[0]
+
+        (job_path, snp_setting_data, ret_val) = vs_snap_svc.CreateSnapshot(
+            AffectedSystem=vm.path_(),
+            SnapshotType=self._SNAPSHOT_FULL)
+
+        return self._jobutils.check_ret_val_async(
+            ret_val, job_path,
+            result_func=functools.partial(self._get_snapshot_path_from_job,
+                                          snapshot_name=snapshot_name),
+            progress_callback=progress_callback)
+
+    def _get_snapshot_path_from_job(self, job, snapshot_name=None):
         snp_setting_data = job.associators(
             wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS,
             wmi_association_class=self._AFFECTED_JOB_ELEMENT_CLASS)[0]
@@ -801,12 +1472,22 @@ class VMUtils(baseutils.BaseUtilsVirt):
         (job_path, ret_val) = vs_snap_svc.DestroySnapshot(snapshot_path)
         self._jobutils.check_ret_val(ret_val, job_path)
 
-    def get_vm_dvd_disk_paths(self, vm_name):
-        vmsettings = self._lookup_vm_check(vm_name)
+    def remove_vm_snapshot_async(self, snapshot_path, progress_callback=None):
+        """Non-blocking version of remove_vm_snapshot.
 
-        sasds = _wqlutils.get_element_associated_class(
-            self._conn, self._STORAGE_ALLOC_SETTING_DATA_CLASS,
-            element_instance_id=vmsettings.InstanceID)
+        :returns: a jobutils.WMIJobFuture object.
+        """
+        vs_snap_svc = self._compat_conn.Msvm_VirtualSystemSnapshotService()[0]
+        (job_path, ret_val) = vs_snap_svc.DestroySnapshot(snapshot_path)
+        return self._jobutils.check_ret_val_async(
+            ret_val, job_path, progress_callback=progress_callback)
+
+    def get_vm_dvd_disk_paths(self, vm_name, topology=None):
+        vmsettings = None if topology else self._lookup_vm_check(vm_name)
+
+        sasds = self._get_vm_resources(
+            vmsettings, self._STORAGE_ALLOC_SETTING_DATA_CLASS,
+            topology=topology)
 
         dvd_paths = [sasd.HostResource[0] for sasd in sasds
                      if sasd.ResourceSubType == self._DVD_DISK_RES_SUB_TYPE]
@@ -834,6 +1515,11 @@ class VMUtils(baseutils.BaseUtilsVirt):
             if not is_physical:
                 self._jobutils.remove_virt_resource(parent)
 
+            drive = disk_resource if is_physical else parent
+            if drive.Parent:
+                self._release_controller_slot(drive.Parent,
+                                              drive.AddressOnParent)
+
     def _get_mounted_disk_resource_from_path(self, disk_path, is_physical,
                                              serial=None):
         if is_physical:
@@ -841,6 +1527,15 @@ class VMUtils(baseutils.BaseUtilsVirt):
         else:
             class_name = self._STORAGE_ALLOC_SETTING_DATA_CLASS
 
+        # Lookups that miss the index are still performed using a WQL
+        # query as the index may not be up to date.
+        disk_resource_index = self._disk_resource_indexes.get(self._host)
+        if disk_resource_index:
+            disk_resource = self._get_indexed_disk_resource(
+                disk_resource_index, class_name, disk_path, serial)
+            if disk_resource:
+                return disk_resource
+
         query = ("SELECT * FROM %(class_name)s WHERE ("
                  "ResourceSubType='%(res_sub_type)s' OR "
                  "ResourceSubType='%(res_sub_type_virt)s' OR "
@@ -856,12 +1551,39 @@ class VMUtils(baseutils.BaseUtilsVirt):
         disk_resources = self._compat_conn.query(query)
 
         for disk_resource in disk_resources:
-            if serial:
+            # The resources are already filtered by serial, if requested.
+            if serial or self._disk_resource_matches(disk_resource,
+                                                     disk_path):
+                if disk_resource_index:
+                    disk_resource_index.update(class_name, disk_resource)
                 return disk_resource
 
-            if disk_resource.HostResource:
-                if disk_resource.HostResource[0].lower() == disk_path.lower():
-                    return disk_resource
+    def _get_indexed_disk_resource(self, disk_resource_index, class_name,
+                                   disk_path, serial=None):
+        instance_id = disk_resource_index.get(
+            class_name, disk_path=disk_path, serial=serial)
+        if not instance_id:
+            return
+
+        disk_resources = getattr(self._compat_conn, class_name)(
+            InstanceID=instance_id)
+        if not disk_resources:
+            disk_resource_index.invalidate(instance_id)
+            return
+        disk_resource = disk_resources[0]
+
+        if self._disk_resource_matches(disk_resource, disk_path, serial):
+            return disk_resource
+
+        # The resource was modified meanwhile.
+        disk_resource_index.update(class_name, disk_resource)
+
+    @staticmethod
+    def _disk_resource_matches(disk_resource, disk_path, serial=None):
+        if serial:
+            return disk_resource.ElementName == serial
+        return bool(disk_resource.HostResource and
+                    disk_resource.HostResource[0].lower() == disk_path.lower())
 
     def get_mounted_disk_by_drive_number(self, device_number):
         mounted_disks = self._conn.query("SELECT * FROM Msvm_DiskDrive "
@@ -887,14 +1609,87 @@ class VMUtils(baseutils.BaseUtilsVirt):
         return disk_data
 
     def get_free_controller_slot(self, scsi_controller_path):
-        attached_disks = self.get_attached_disks(scsi_controller_path)
-        used_slots = [int(disk.AddressOnParent) for disk in attached_disks]
+        """Reserves and returns a free SCSI controller slot.
 
-        for slot in range(constants.SCSI_CONTROLLER_SLOTS_NUMBER):
-            if slot not in used_slots:
-                return slot
-        raise exceptions.HyperVException(
-            _("Exceeded the maximum number of slots"))
+        The slot remains reserved until a drive is attached to it using
+        attach_drive or attach_volume_to_controller, being released if
+        the attach operation fails. The used slots are reloaded if the
+        controller seems to be full or if they have not been reloaded
+        in the last _SLOT_ALLOCATOR_SYNC_INTERVAL seconds.
+        """
+        allocator, slot = self._reserve_controller_slot(scsi_controller_path)
+        return slot
+
+    def _get_slot_allocator(
+            self, controller_path, sync=False,
+            slots_number=constants.SCSI_CONTROLLER_SLOTS_NUMBER,
+            used_slots=None):
+        """Returns the slot allocator shared by the controller consumers.
+
+        :param sync: whether to reload the used slots. Allocators that have
+            not been reloaded recently are reloaded anyway.
+        :param used_slots: optional list of used slots, to be used instead
+            of querying the attached disks.
+        """
+        key = (self._host, controller_path.upper())
+        allocator = self._slot_allocators.get(key)
+        if allocator and not sync:
+            sync = (time.time() - allocator.updated_at >=
+                    self._SLOT_ALLOCATOR_SYNC_INTERVAL)
+            if not sync:
+                return allocator
+
+        if used_slots is None:
+            attached_disks = self.get_attached_disks(controller_path)
+            used_slots = [int(disk.AddressOnParent)
+                          for disk in attached_disks]
+        if allocator:
+            allocator.update(used_slots)
+            return allocator
+
+        allocator = _slot_allocator.ControllerSlotAllocator(
+            slots_number, used_slots,
+            reservation_timeout=self._SLOT_RESERVATION_TIMEOUT)
+        return self._slot_allocators.setdefault(key, allocator)
+
+    def _reserve_controller_slot(self, controller_path, sync_on_miss=True,
+                                 **kwargs):
+        allocator = self._get_slot_allocator(controller_path, **kwargs)
+        try:
+            return allocator, allocator.reserve()
+        except exceptions.HyperVException:
+            if not sync_on_miss:
+                raise
+            # Slots may have been freed by other consumers.
+            allocator = self._get_slot_allocator(controller_path, sync=True)
+            return allocator, allocator.reserve()
+
+    def _commit_controller_slot(self, controller_path, slot):
+        key = (self._host, controller_path.upper())
+        allocator = self._slot_allocators.get(key)
+        if allocator:
+            allocator.commit(int(slot))
+
+    def _release_controller_slot(self, controller_path, slot, sync=False):
+        """Releases a controller slot.
+
+        :param sync: whether to reload the used slots, for example when the
+            slot may have been taken by other consumers.
+        """
+        key = (self._host, controller_path.upper())
+        allocator = self._slot_allocators.get(key)
+        if allocator:
+            allocator.release(int(slot))
+            if sync:
+                self._get_slot_allocator(controller_path, sync=True)
+
+    def _drop_vm_slot_allocators(self, vm_id):
+        # The controller instance ids are prefixed by the VM id.
+        instance_id_prefix = 'MICROSOFT:%s\\' % vm_id.upper()
+        for key in list(self._slot_allocators):
+            host, ctrl_path = key
+            if host == self._host and instance_id_prefix in ctrl_path:
+                self._slot_allocators.pop(key, None)
 
     def get_vm_serial_port_connection(self, vm_name, update_connection=None):
         # TODO(lpetrut): Remove this method after the patch implementing
@@ -915,10 +1710,17 @@ class VMUtils(baseutils.BaseUtilsVirt):
         if len(serial_port.Connection) > 0:
             return serial_port.Connection[0]
 
-    def _get_vm_serial_ports(self, vmsettings):
-        rasds = _wqlutils.get_element_associated_class(
-            self._compat_conn, self._SERIAL_PORT_SETTING_DATA_CLASS,
-            element_instance_id=vmsettings.InstanceID)
+    def _get_vm_serial_ports(self, vmsettings, topology=None):
+        if topology:
+            # The serial port setting data class may be a subclass of the
+            # resource allocation setting data class, the serial ports being
+            # retrieved along with the other VM resources.
+            return topology.get_wmi_objs(
+                res_sub_types=[self._SERIAL_PORT_RES_SUB_TYPE])
+
+        rasds = self._get_vm_resources(
+            vmsettings, self._SERIAL_PORT_SETTING_DATA_CLASS,
+            conn=self._compat_conn)
         serial_ports = (
             [r for r in rasds if
              r.ResourceSubType == self._SERIAL_PORT_RES_SUB_TYPE]
@@ -933,9 +1735,10 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
         self._jobutils.modify_virt_resource(serial_port)
 
-    def get_vm_serial_port_connections(self, vm_name):
-        vmsettings = self._lookup_vm_check(vm_name)
-        serial_ports = self._get_vm_serial_ports(vmsettings)
+    def get_vm_serial_port_connections(self, vm_name, topology=None):
+        vmsettings = None if topology else self._lookup_vm_check(vm_name)
+        serial_ports = self._get_vm_serial_ports(vmsettings,
+                                                 topology=topology)
         conns = [serial_port.Connection[0]
                  for serial_port in serial_ports
                  if serial_port.Connection and serial_port.Connection[0]]
@@ -943,14 +1746,45 @@ class VMUtils(baseutils.BaseUtilsVirt):
 
     def get_active_instances(self):
         """Return the names of all the active instances known to Hyper-V."""
+        vm_state_mirror = self._vm_state_mirrors.get(self._host)
+        if vm_state_mirror:
+            return vm_state_mirror.get_vm_names(
+                enabled_states=[self._vm_power_states_map[
+                    constants.HYPERV_VM_STATE_ENABLED]])
+
+        return [vm_name for (vm_name, vm_state) in
+                self.list_instances_with_state(
+                    states=[constants.HYPERV_VM_STATE_ENABLED])]
 
-        vm_names = self.list_instances()
-        vms = [self._lookup_vm(vm_name, as_vssd=False) for vm_name in vm_names]
-        active_vm_names = [v.ElementName for v in vms
-                           if v.EnabledState ==
-                           constants.HYPERV_VM_STATE_ENABLED]
+    def list_instances_with_state(self, states=None):
+        """Returns the names and power states of the instances.
 
-        return active_vm_names
+        A single projected query is used, the states being filtered
+        server side.
+
+        :param states: a list of HYPERV_VM_STATE_* constants. If specified,
+            only the instances having one of those power states are returned.
+        :returns: a list of (vm_name, vm_power_state) tuples.
+        """
+        query = ("SELECT ElementName, EnabledState FROM %(class)s "
+                 "WHERE Caption = 'Virtual Machine'" %
+                 {'class': self._COMPUTER_SYSTEM_CLASS})
+        if states is not None:
+            enabled_states = []
+            for state in states:
+                if state not in self._vm_power_states_map:
+                    raise exceptions.InvalidParameterValue(
+                        param_name='states', param_value=state)
+                enabled_states.append(self._vm_power_states_map[state])
+
+            if not enabled_states:
+                return []
+            query += " AND (%s)" % " OR ".join(
+                "EnabledState = %s" % enabled_state
+                for enabled_state in enabled_states)
+
+        return [(vm.ElementName, self.get_vm_power_state(vm.EnabledState))
+                for vm in self._conn.query(query)]
 
     def get_vm_power_state_change_listener(
             self, timeframe=_DEFAULT_EVENT_CHECK_TIMEFRAME,
@@ -961,26 +1795,22 @@ class VMUtils(baseutils.BaseUtilsVirt):
                                           field=field,
                                           timeframe=timeframe,
                                           filtered_states=filtered_states)
-        listener = self._conn.Msvm_ComputerSystem.watch_for(raw_wql=query,
+        if not get_handler:
+            return self._conn.Msvm_ComputerSystem.watch_for(raw_wql=query,
                                                             fields=[field])
 
-        def _handle_events(callback):
-            if patcher.is_monkey_patched('thread'):
-                # Retrieve one by one all the events that occurred in
-                # the checked interval.
-                #
-                # We use eventlet.tpool for retrieving the events in
-                # order to avoid issues caused by greenthread/thread
-                # communication. Note that PyMI must use the unpatched
-                # threading module.
-                listen = functools.partial(tpool.execute, listener,
-                                           event_timeout)
-            else:
-                listen = functools.partial(listener, event_timeout)
+        # The events are retrieved by the namespace event hub, which is
+        # shared by all the os-win event listeners.
+        subscription = self._get_wmi_event_hub(
+            self._wmi_namespace % self._host).subscribe(query,
+                                                        fields=[field])
 
+        def _handle_events(callback):
             while True:
                 try:
-                    event = listen()
+                    event = subscription.get(timeout=event_timeout / 1000)
+                    if event is None:
+                        continue
 
                     vm_name = event.ElementName
                     vm_state = event.EnabledState
@@ -996,15 +1826,13 @@ class VMUtils(baseutils.BaseUtilsVirt):
                         LOG.exception(err_msg,
                                       dict(vm_name=vm_name,
                                            vm_power_state=vm_power_state))
-                except exceptions.x_wmi_timed_out:
-                    pass
                 except Exception:
                     LOG.exception(
                         "The VM power state change event listener "
                         "encountered an unexpected exception.")
                     time.sleep(event_timeout / 1000)
 
-        return _handle_events if get_handler else listener
+        return _handle_events
 
     def _get_event_wql_query(self, cls, field,
                              timeframe, filtered_states=None):
@@ -18,10 +18,14 @@
 Base Utility class for operations on Hyper-V.
 """
 
+import re
+import threading
 import time
 
 from oslo_log import log as logging
+from six.moves import range  # noqa
 
+from os_win._i18n import _
 from os_win import _utils
 from os_win import constants
 from os_win import exceptions
@@ -30,6 +34,432 @@ from os_win.utils import baseutils
 LOG = logging.getLogger(__name__)
 
 
+class _JobPoller(object):
+    """Polls the state of all the pending jobs using a single query.
+
+    Waiters register the jobs they are interested in and get notified when
+    those are completed. The jobs are polled by a worker thread that runs
+    as long as there are pending jobs, using an adaptive polling interval.
+
+    If the jobs cannot be polled repeatedly, the waiters are notified
+    anyway, falling back to polling their jobs individually.
+    """
+
+    _MIN_POLL_INTERVAL = 0.1  # seconds
+    _MAX_POLL_INTERVAL = 2
+    _POLL_INTERVAL_BACKOFF = 1.5
+    # Avoid exceeding the WQL query length limit.
+    _MAX_JOBS_PER_QUERY = 64
+    _MAX_POLL_FAILURES = 3
+
+    _running = False
+
+    def __init__(self, conn, job_class, completed_job_states):
+        self._conn = conn
+        self._job_class = job_class
+        self._completed_job_states = completed_job_states
+
+        self._lock = threading.Lock()
+        self._pending_jobs = {}
+        self._progress_callbacks = {}
+        self._last_progress = {}
+        self._new_jobs_event = threading.Event()
+
+    def wait(self, job_id, timeout=None):
+        """Waits for the specified job to be completed.
+
+        Returns True if the job is completed (or could not be found) or False
+        if the timeout has been reached.
+        """
+        job_completed_event = self.register(job_id)
+        return job_completed_event.wait(timeout)
+
+    def register(self, job_id, progress_callback=None):
+        """Starts tracking the specified job.
+
+        :param progress_callback: optional function that will be called
+            using the job's PercentComplete value when it changes.
+        :returns: an event that will be set once the job is completed.
+        """
+        with self._lock:
+            job_completed_event = self._pending_jobs.get(job_id)
+            if not job_completed_event:
+                job_completed_event = threading.Event()
+                self._pending_jobs[job_id] = job_completed_event
+            if progress_callback:
+                self._progress_callbacks.setdefault(job_id, []).append(
+                    progress_callback)
+
+            self._new_jobs_event.set()
+            if not self._running:
+                worker = threading.Thread(target=self._poll_jobs)
+                worker.setDaemon(True)
+
+                self._running = True
+                worker.start()
+        return job_completed_event
+
+    def _poll_jobs(self):
+        poll_interval = self._MIN_POLL_INTERVAL
+        poll_failures = 0
+        while True:
+            with self._lock:
+                self._new_jobs_event.clear()
+                job_ids = list(self._pending_jobs)
+                if not job_ids:
+                    self._running = False
+                    return
+
+            try:
+                completed_job_ids = self._get_completed_jobs(job_ids)
+                poll_failures = 0
+            except Exception:
+                LOG.exception("Failed to retrieve the pending jobs state.")
+                completed_job_ids = []
+
+                poll_failures += 1
+                if poll_failures >= self._MAX_POLL_FAILURES:
+                    # The waiters will poll their jobs separately, getting
+                    # the error if the jobs still cannot be retrieved.
+                    LOG.error("Could not retrieve the pending jobs state "
+                              "after %d attempts. Notifying the waiters.",
+                              poll_failures)
+                    completed_job_ids = job_ids
+                    poll_failures = 0
+
+            with self._lock:
+                for job_id in completed_job_ids:
+                    self._pending_jobs.pop(job_id).set()
+                    self._progress_callbacks.pop(job_id, None)
+                    self._last_progress.pop(job_id, None)
+
+            if completed_job_ids:
+                poll_interval = self._MIN_POLL_INTERVAL
+            else:
+                poll_interval = min(
+                    poll_interval * self._POLL_INTERVAL_BACKOFF,
+                    self._MAX_POLL_INTERVAL)
+
+            # Newly registered jobs will be polled right away.
+            if self._new_jobs_event.wait(poll_interval):
+                poll_interval = self._MIN_POLL_INTERVAL
+
+    def _get_completed_jobs(self, job_ids):
+        completed_job_ids = []
+
+        for idx in range(0, len(job_ids), self._MAX_JOBS_PER_QUERY):
+            # InstanceID string comparisons are case insensitive.
+            job_ids_map = {
+                job_id.upper(): job_id
+                for job_id in job_ids[idx:idx + self._MAX_JOBS_PER_QUERY]}
+            query = ("SELECT InstanceID, JobState, ErrorCode, PercentComplete "
+                     "FROM %(job_class)s WHERE %(conditions)s" %
+                     {'job_class': self._job_class,
+                      'conditions': " OR ".join(
+                          "InstanceID = '%s'" % job_id
+                          for job_id in job_ids_map.values())})
+            jobs = _utils.avoid_blocking_call(self._conn.query, query)
+
+            for job in jobs:
+                job_id = job_ids_map.pop(job.InstanceID.upper(), None)
+                if not job_id:
+                    continue
+
+                self._report_progress(job_id, job.PercentComplete)
+                if job.JobState in self._completed_job_states:
+                    completed_job_ids.append(job_id)
+
+            # We're not going to poll jobs that cannot be found anymore,
+            # letting the waiters handle this.
+            completed_job_ids += list(job_ids_map.values())
+        return completed_job_ids
+
+    def _report_progress(self, job_id, percent_complete):
+        callbacks = self._progress_callbacks.get(job_id)
+        if (not callbacks or
+                self._last_progress.get(job_id) == percent_complete):
+            return
+
+        self._last_progress[job_id] = percent_complete
+        for callback in list(callbacks):
+            try:
+                callback(percent_complete)
+            except Exception:
+                LOG.exception("Job progress callback failed.")
+
+
+class WMIJobFuture(object):
+    """Handle of a Hyper-V job that may not be completed yet.
+
+    Allows starting multiple independent operations and waiting for all
+    of them at once.
+    """
+
+    def __init__(self, job_utils, job_path=None, exc=None, result_func=None,
+                 progress_callback=None):
+        self._job_utils = job_utils
+        self._job_path = job_path
+        self._result_func = result_func
+
+        self._job_id = job_path and job_utils._get_job_id(job_path)
+        self._completed_event = None
+        if self._job_id:
+            self._completed_event = job_utils._job_poller.register(
+                self._job_id, progress_callback)
+
+        self._result_available = job_path is None
+        self._result = None
+        self._exc = exc
+
+        if self._result_available and not exc:
+            self._set_result(None)
+
+    def _set_result(self, job):
+        try:
+            self._result = self._result_func(job) if self._result_func else job
+        except Exception as ex:
+            self._exc = ex
+        self._result_available = True
+
+    def _get_job(self):
+        return self._job_utils._get_wmi_obj(self._job_path.replace('\\', '/'))
+
+    def done(self):
+        if self._result_available:
+            return True
+        if self._completed_event:
+            return self._completed_event.is_set()
+        return self._job_utils._is_job_completed(self._get_job())
+
+    def _wait(self, timeout):
+        if self._completed_event:
+            return self._completed_event.wait(timeout)
+
+        # The job id could not be determined, so this job is not tracked
+        # by the job poller.
+        time_start = time.time()
+        while not self.done():
+            if timeout is not None and time.time() - time_start >= timeout:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def result(self, timeout=None):
+        """Waits for the job to complete, returning its result.
+
+        :raises exceptions.WMIJobTimeout: if the job did not complete in
+            the given amount of time.
+        :raises exceptions.WMIJobFailed: if the job failed.
+        """
+        if not self._result_available:
+            time_start = time.time()
+            if not self._wait(timeout):
+                raise exceptions.WMIJobTimeout(job_path=self._job_path,
+                                               timeout=timeout)
+            time_left = (max(timeout - (time.time() - time_start), 0)
+                         if timeout is not None else None)
+            try:
+                job = self._job_utils._get_completed_job(self._job_path,
+                                                         time_left)
+            except exceptions.WMIJobTimeout:
+                raise
+            except Exception as ex:
+                self._exc = ex
+                self._result_available = True
+            else:
+                self._set_result(job)
+
+        if self._exc:
+            raise self._exc
+        return self._result
+
+    def cancel(self):
+        """Requests the job to be stopped.
+
+        :returns: True if the job could be cancelled, False if the job is
+            already completed or it is not cancellable.
+        """
+        if self.done():
+            return False
+
+        try:
+            job = self._get_job()
+            if not job.Cancellable:
+                LOG.debug("Got request to cancel non-cancelable job.")
+                return False
+
+            job.RequestStateChange(
+                self._job_utils._KILL_JOB_STATE_CHANGE_REQUEST)
+        except exceptions.x_wmi as ex:
+            # The job may had been completed right before we've
+            # attempted to kill it.
+            if not _utils._is_not_found_exc(ex):
+                raise
+            return False
+        return True
+
+
+def wait_for_jobs(futures, timeout=None, return_exceptions=False):
+    """Waits for multiple jobs to complete.
+
+    :param futures: a list of WMIJobFuture objects.
+    :param timeout: the maximum amount of time to wait for all the jobs.
+    :param return_exceptions: if set, the exceptions are returned in place
+        of the according job results instead of being raised.
+    :returns: a list containing the job results.
+    :raises: the first encountered job exception, after all the jobs have
+        completed, unless return_exceptions is set.
+    """
+    time_start = time.time()
+    results = []
+    for future in futures:
+        time_left = (max(timeout - (time.time() - time_start), 0)
+                     if timeout is not None else None)
+        try:
+            results.append(future.result(time_left))
+        except Exception as ex:
+            results.append(ex)
+
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
+
+
+class VirtResourceRequest(object):
+    """A resource addition that is part of a VirtResourceBatch."""
+
+    def __init__(self, virt_resource, parent_request=None):
+        self.virt_resource = virt_resource
+        self.parent_request = parent_request
+
+        self.path = None
+        self.exc = None
+
+    @property
+    def done(self):
+        return bool(self.path or self.exc)
+
+    def result(self):
+        """Returns the path of the added resource.
+
+        :raises: the exception encountered while adding the resource.
+        """
+        if self.exc:
+            raise self.exc
+        if not self.path:
+            raise exceptions.HyperVException(
+                _("The resource batch was not committed."))
+        return self.path
+
+
+class VirtResourceBatch(object):
+    """Collects resource additions for a given parent (e.g. a VM).
+
+    The resources are submitted using as few AddResourceSettings calls as
+    possible. Resources that depend on other resources of the same batch
+    (e.g. a virtual disk that is attached to a drive that is part of the
+    batch) are submitted once the resource they depend on is added, their
+    'Parent' field being set accordingly.
+
+    If a batched call fails, its resources are resubmitted one by one,
+    so that only the offending requests fail. Failures are recorded per
+    request, without reverting the resources that were successfully added.
+    """
+
+    def __init__(self, job_utils, parent):
+        self._job_utils = job_utils
+        self._parent = parent
+        self._requests = []
+
+    def add(self, virt_resource, parent_request=None):
+        """Queues a resource addition.
+
+        :param virt_resource: the resource to be added.
+        :param parent_request: an optional VirtResourceRequest from the same
+            batch, whose resulting path will be used as 'Parent' of this
+            resource.
+        :returns: a VirtResourceRequest object, which will provide the
+            resulting resource path after the batch is committed.
+        """
+        request = VirtResourceRequest(virt_resource, parent_request)
+        self._requests.append(request)
+        return request
+
+    def commit(self):
+        """Submits the pending resource additions.
+
+        :returns: the list of the processed requests.
+        """
+        requests, self._requests = self._requests, []
+        pending = [request for request in requests if not request.done]
+
+        while pending:
+            ready = []
+            for request in pending:
+                parent_request = request.parent_request
+                if not parent_request:
+                    ready.append(request)
+                elif parent_request.exc:
+                    request.exc = parent_request.exc
+                elif parent_request.path:
+                    request.virt_resource.Parent = parent_request.path
+                    ready.append(request)
+
+            if ready:
+                self._add_resources(ready)
+            else:
+                for request in pending:
+                    if not request.done:
+                        request.exc = exceptions.HyperVException(
+                            _("The parent resource request is not part of "
+                              "this batch."))
+
+            pending = [request for request in pending if not request.done]
+
+        return requests
+
+    def _add_resources(self, requests):
+        try:
+            new_resources = self._job_utils.add_multiple_virt_resources(
+                [request.virt_resource for request in requests],
+                self._parent)
+        except Exception as ex:
+            LOG.debug("Failed to add %(count)d resources. Exception: %(ex)s",
+                      dict(count=len(requests), ex=ex))
+            if len(requests) == 1:
+                requests[0].exc = ex
+                return
+
+            for request in requests:
+                self._add_resources([request])
+            return
+
+        # The resulting resources are returned in the order in which
+        # the resource definitions were passed.
+        for request, resource_path in zip(requests, new_resources):
+            request.path = resource_path
+
+        # Resubmitting the requests that did not get a path could
+        # duplicate the resources, so we're failing them instead.
+        for request in requests[len(new_resources):]:
+            request.exc = exceptions.HyperVException(
+                _("The resource path was not returned by the "
+                  "AddResourceSettings job."))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            # Do not submit partially defined batches.
+            return
+
+        for request in self.commit():
+            request.result()
+
+
 class JobUtils(baseutils.BaseUtilsVirt):
 
     _CONCRETE_JOB_CLASS = "Msvm_ConcreteJob"
@@ -45,7 +475,11 @@ class JobUtils(baseutils.BaseUtilsVirt):
     _successful_job_states = [constants.JOB_STATE_COMPLETED,
                               constants.JOB_STATE_COMPLETED_WITH_WARNINGS]
 
-    def check_ret_val(self, ret_val, job_path, success_values=[0]):
+    # Shared by all the JobUtils instances, the key being the host.
+    _job_pollers = {}
+
+    def check_ret_val(self, ret_val, job_path, success_values=[0],
+                      timeout=None):
         """Checks that the job represented by the given arguments succeeded.
 
         Some Hyper-V operations are not atomic, and will return a reference
@@ -60,6 +494,9 @@ class JobUtils(baseutils.BaseUtilsVirt):
         :param success_values: list of return values that can be considered
             successful. WMI_JOB_STATUS_STARTED and WMI_JOB_STATE_RUNNING
             values are ignored.
+        :param timeout: the maximum amount of time to wait for the job.
+        :raises exceptions.WMIJobTimeout: if the job did not complete in
+            the given amount of time.
         :raises exceptions.WMIJobFailed: if the given ret_val is
             WMI_JOB_STATUS_STARTED or WMI_JOB_STATE_RUNNING and the state of
             job represented by the given job_path is not
@@ -68,20 +505,75 @@ class JobUtils(baseutils.BaseUtilsVirt):
         """
         if ret_val in [constants.WMI_JOB_STATUS_STARTED,
                        constants.WMI_JOB_STATE_RUNNING]:
-            return self._wait_for_job(job_path)
+            return self._wait_for_job(job_path, timeout=timeout)
         elif ret_val not in success_values:
             raise exceptions.WMIJobFailed(error_code=ret_val,
                                           job_state=None,
                                           error_summ_desc=None,
                                           error_desc=None)
 
-    def _wait_for_job(self, job_path):
+    def check_ret_val_async(self, ret_val, job_path, success_values=[0],
+                            result_func=None, progress_callback=None):
+        """Non-blocking version of check_ret_val.
+
+        :param result_func: optional function receiving the job object
+            (or None, if the operation did not use a job), used to build
+            the future's result.
+        :param progress_callback: optional function receiving the job's
+            PercentComplete value each time it changes.
+        :returns: a WMIJobFuture object.
+        """
+        if ret_val in [constants.WMI_JOB_STATUS_STARTED,
+                       constants.WMI_JOB_STATE_RUNNING]:
+            return WMIJobFuture(self, job_path, result_func=result_func,
+                                progress_callback=progress_callback)
+        elif ret_val not in success_values:
+            exc = exceptions.WMIJobFailed(error_code=ret_val,
+                                          job_state=None,
+                                          error_summ_desc=None,
+                                          error_desc=None)
+            return WMIJobFuture(self, exc=exc)
+        return WMIJobFuture(self, result_func=result_func)
+
+    @property
+    def _job_poller(self):
+        job_poller = self._job_pollers.get(self._host)
+        if not job_poller:
+            job_poller = _JobPoller(self._conn, self._CONCRETE_JOB_CLASS,
+                                    self._completed_job_states)
+            job_poller = self._job_pollers.setdefault(self._host, job_poller)
+        return job_poller
+
+    @staticmethod
+    def _get_job_id(job_path):
+        match = re.search(r'InstanceID="([^"]+)"', job_path)
+        if match:
+            return match.group(1)
+
+    def _wait_for_job(self, job_path, timeout=None):
         """Poll WMI job state and wait for completion."""
 
+        # The pending jobs are polled at once by a shared poller. If the job
+        # id can't be determined, we'll just poll this job separately.
+        time_start = time.time()
+        job_id = self._get_job_id(job_path)
+        if job_id and not self._job_poller.wait(job_id, timeout):
+            raise exceptions.WMIJobTimeout(job_path=job_path,
+                                           timeout=timeout)
+
+        time_left = (max(timeout - (time.time() - time_start), 0)
+                     if timeout is not None else None)
+        return self._get_completed_job(job_path, time_left)
+
+    def _get_completed_job(self, job_path, timeout=None):
+        time_start = time.time()
         job_wmi_path = job_path.replace('\\', '/')
         job = self._get_wmi_obj(job_wmi_path)
 
         while not self._is_job_completed(job):
+            if timeout is not None and time.time() - time_start >= timeout:
+                raise exceptions.WMIJobTimeout(job_path=job_path,
+                                               timeout=timeout)
             time.sleep(0.1)
             job = self._get_wmi_obj(job_wmi_path)
 
@@ -184,6 +676,39 @@ class JobUtils(baseutils.BaseUtilsVirt):
         self.check_ret_val(ret_val, job_path)
         return new_resources
 
+    @_utils.not_found_decorator()
+    @_utils.retry_decorator(exceptions=exceptions.HyperVException)
+    def add_multiple_virt_resources(self, virt_resources, parent):
+        (job_path, new_resources,
+         ret_val) = self._vs_man_svc.AddResourceSettings(
+            parent.path_(), [r.GetText_(1) for r in virt_resources])
+        self.check_ret_val(ret_val, job_path)
+        return new_resources
+
+    def virt_resource_batch(self, parent):
+        """Returns a batch used for adding multiple resources at once.
+
+        Example:
+            with jobutils.virt_resource_batch(vm) as batch:
+                drive_req = batch.add(drive)
+                batch.add(vhd, parent_request=drive_req)
+
+        The batch is submitted when exiting the context, the first
+        encountered exception being raised.
+        """
+        return VirtResourceBatch(self, parent)
+
+    @_utils.not_found_decorator()
+    def add_virt_resource_async(self, virt_resource, parent,
+                                progress_callback=None):
+        (job_path, new_resources,
+         ret_val) = self._vs_man_svc.AddResourceSettings(
+            parent.path_(), [virt_resource.GetText_(1)])
+        return self.check_ret_val_async(
+            ret_val, job_path,
+            result_func=lambda job: new_resources,
+            progress_callback=progress_callback)
+
     # modify_virt_resource can fail, especially while setting up the VM's
     # serial port connection. Retrying the operation will yield success.
     @_utils.not_found_decorator()
@@ -204,6 +729,14 @@ class JobUtils(baseutils.BaseUtilsVirt):
             ResourceSettings=[r.path_() for r in virt_resources])
         self.check_ret_val(ret_val, job)
 
+    @_utils.not_found_decorator()
+    def remove_multiple_virt_resources_async(self, virt_resources,
+                                             progress_callback=None):
+        (job, ret_val) = self._vs_man_svc.RemoveResourceSettings(
+            ResourceSettings=[r.path_() for r in virt_resources])
+        return self.check_ret_val_async(ret_val, job,
+                                        progress_callback=progress_callback)
+
     def add_virt_feature(self, virt_feature, parent):
         self.add_multiple_virt_features([virt_feature], parent)
 
@@ -215,6 +748,16 @@ class JobUtils(baseutils.BaseUtilsVirt):
             parent.path_(), [f.GetText_(1) for f in virt_features])
         self.check_ret_val(ret_val, job_path)
 
+    def modify_virt_feature(self, virt_feature):
+        self.modify_multiple_virt_features([virt_feature])
+
+    @_utils.not_found_decorator()
+    def modify_multiple_virt_features(self, virt_features):
+        (job_path, out_set_data,
+         ret_val) = self._vs_man_svc.ModifyFeatureSettings(
+            FeatureSettings=[f.GetText_(1) for f in virt_features])
+        self.check_ret_val(ret_val, job_path)
+
     def remove_virt_feature(self, virt_feature):
         self.remove_multiple_virt_features([virt_feature])
 
@@ -19,6 +19,8 @@ Based on the "root/virtualization/v2" namespace available starting with
 Hyper-V Server / Windows Server 2012.
 """
 
+import collections
+
 from oslo_log import log as logging
 
 from os_win._i18n import _
@@ -39,6 +41,8 @@ class MetricsUtils(baseutils.BaseUtilsVirt):
     _PORT_ALLOC_SET_DATA = 'Msvm_EthernetPortAllocationSettingData'
     _PORT_ALLOC_ACL_SET_DATA = 'Msvm_EthernetSwitchPortAclSettingData'
     _BASE_METRICS_VALUE = 'Msvm_BaseMetricValue'
+    _AGGREGATION_METRICS_VALUE = 'Msvm_AggregationMetricValue'
+    _COMPUTER_SYSTEM_CLASS = 'Msvm_ComputerSystem'
 
     _CPU_METRICS = 'Aggregated Average CPU Utilization'
     _MEMORY_METRICS = 'Aggregated Average Memory Utilization'
@@ -206,6 +210,173 @@ class MetricsUtils(baseutils.BaseUtilsVirt):
                 'instance_id': disk.InstanceID,
             }
 
+    def collect_all_vm_metrics(self):
+        """Collects the metrics of all the VMs, using a single pass.
+
+        Instead of resolving each VM and querying the metrics of each
+        element separately, every relevant class is enumerated once. The
+        metric values are then associated with the VMs, disks and switch
+        ports based on their InstanceID prefix.
+
+        :returns: a dict mapping the VM IDs to dicts containing the
+            following keys: vm_name, cpu_used, cpu_count, uptime,
+            memory_usage, disks and vnics. VM names are not unique, for
+            which reason they are not used as keys. The disks and vnics
+            are lists containing the same values as the ones returned by
+            get_disk_metrics, get_disk_latency_metrics, get_disk_iops_count
+            and get_vnic_metrics.
+        """
+        vms = self._conn.query(
+            "SELECT Name, ElementName, OnTimeInMilliseconds FROM %s "
+            "WHERE Caption = 'Virtual Machine'" % self._COMPUTER_SYSTEM_CLASS)
+        cpu_sds = self._conn.query(
+            "SELECT InstanceID, VirtualQuantity FROM %s" %
+            self._PROCESSOR_SETTING_DATA_CLASS)
+        disks = self._conn.query(
+            "SELECT InstanceID, HostResource FROM %s" %
+            self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+        ports = self._conn.query(
+            "SELECT InstanceID, Parent FROM %s" % self._PORT_ALLOC_SET_DATA)
+        port_acls = self._conn.query(
+            "SELECT InstanceID FROM %s" % self._PORT_ALLOC_ACL_SET_DATA)
+        vnics = self._conn.query(
+            "SELECT * FROM %s" % self._SYNTH_ETH_PORT_SET_DATA)
+
+        metrics_by_element = self._get_metrics_values_by_element(
+            ['Microsoft:%s' % vm.Name for vm in vms] +
+            [d.InstanceID for d in disks] +
+            [a.InstanceID for a in port_acls])
+
+        vm_records = {}
+        vm_ids = {}
+        for vm in vms:
+            vm_id = ('Microsoft:%s' % vm.Name).upper()
+            vm_metrics = metrics_by_element.get(vm_id, [])
+            cpu_used, memory_usage = self._sum_metrics_values_by_defs(
+                vm_metrics,
+                [self._metrics_defs.get(self._CPU_METRICS),
+                 self._metrics_defs.get(self._MEMORY_METRICS)])
+
+            vm_records[vm_id] = {
+                'vm_name': vm.ElementName,
+                'cpu_used': cpu_used,
+                'cpu_count': 0,
+                'uptime': int(vm.OnTimeInMilliseconds or 0),
+                'memory_usage': memory_usage,
+                'disks': [],
+                'vnics': []}
+            vm_ids[vm_id] = vm.Name
+
+        for cpu_sd in cpu_sds:
+            vm_record = vm_records.get(self._get_vm_id(cpu_sd.InstanceID))
+            if vm_record:
+                vm_record['cpu_count'] = int(cpu_sd.VirtualQuantity)
+
+        disk_metrics_defs = [
+            self._metrics_defs.get(metrics_name)
+            for metrics_name in (self._DISK_RD_METRICS,
+                                 self._DISK_WR_METRICS,
+                                 self._DISK_LATENCY_METRICS,
+                                 self._DISK_IOPS_METRICS)]
+        for disk in disks:
+            vm_record = vm_records.get(self._get_vm_id(disk.InstanceID))
+            if not vm_record:
+                continue
+
+            (read_mb, write_mb,
+             disk_latency, iops_count) = self._sum_metrics_values_by_defs(
+                metrics_by_element.get(disk.InstanceID.upper(), []),
+                disk_metrics_defs)
+            vm_record['disks'].append({
+                # Values are in megabytes
+                'read_mb': read_mb,
+                'write_mb': write_mb,
+                'disk_latency': disk_latency,
+                'iops_count': iops_count,
+                'instance_id': disk.InstanceID,
+                'host_resource': (disk.HostResource[0]
+                                  if disk.HostResource else None)})
+
+        # The network metrics are maintained for the switch port ACLs.
+        port_ids = set(port.InstanceID.upper() for port in ports)
+        port_acl_ids = collections.defaultdict(list)
+        for port_acl in port_acls:
+            port_acl_id = port_acl.InstanceID.upper()
+            port_id = self._get_instance_id_prefix(port_acl_id, port_ids)
+            if port_id:
+                port_acl_ids[port_id].append(port_acl_id)
+
+        vnics_by_path = {vnic.path_().upper(): vnic for vnic in vnics}
+        net_metrics_defs = [self._metrics_defs.get(self._NET_IN_METRICS),
+                            self._metrics_defs.get(self._NET_OUT_METRICS)]
+        for port in ports:
+            vm_record = vm_records.get(self._get_vm_id(port.InstanceID))
+            vnic = vnics_by_path.get((port.Parent or '').upper())
+            if not (vm_record and vnic):
+                continue
+
+            port_metrics = []
+            for port_acl_id in port_acl_ids[port.InstanceID.upper()]:
+                acl_metrics = [
+                    m for m in metrics_by_element.get(port_acl_id, [])
+                    if m.path().Class == self._BASE_METRICS_VALUE]
+                if acl_metrics:
+                    port_metrics.append(acl_metrics[0])
+
+            rx_mb, tx_mb = self._sum_metrics_values_by_defs(
+                port_metrics, net_metrics_defs)
+            vm_record['vnics'].append({
+                'rx_mb': rx_mb,
+                'tx_mb': tx_mb,
+                'element_name': vnic.ElementName,
+                'address': vnic.Address})
+
+        return {vm_ids[vm_id]: vm_record
+                for vm_id, vm_record in vm_records.items()}
+
+    def _get_metrics_values_by_element(self, element_instance_ids):
+        """Retrieves all the metric values, grouping them by element.
+
+        The metric values are associated with the element having the
+        longest InstanceID that prefixes the metric value InstanceID.
+
+        :returns: a dict mapping the upper case element InstanceIDs to
+            lists of metric values.
+        """
+        element_ids = set(instance_id.upper()
+                          for instance_id in element_instance_ids)
+        metrics_by_element = collections.defaultdict(list)
+
+        for metrics_class in (self._AGGREGATION_METRICS_VALUE,
+                              self._BASE_METRICS_VALUE):
+            for metric in self._conn.query("SELECT * FROM %s" %
+                                           metrics_class):
+                element_id = self._get_instance_id_prefix(
+                    metric.InstanceID.upper(), element_ids)
+                if element_id:
+                    metrics_by_element[element_id].append(metric)
+
+        return metrics_by_element
+
+    @staticmethod
+    def _get_instance_id_prefix(instance_id, prefixes):
+        """Returns the longest prefix of the given InstanceID, if any.
+
+        Only whole InstanceID components are considered, the components
+        being separated by backslashes.
+        """
+        id_parts = instance_id.split('\\')
+        for idx in range(len(id_parts), 0, -1):
+            prefix = '\\'.join(id_parts[:idx])
+            if prefix in prefixes:
+                return prefix
+
+    @staticmethod
+    def _get_vm_id(instance_id):
+        # The resource setting data InstanceID starts with the InstanceID
+        # of the VM setting data: Microsoft:<vm_id>\<resource_id>...
+        return instance_id.split('\\')[0].upper()
+
     @staticmethod
     def _sum_metrics_values(metrics):
         return sum([int(metric.MetricValue) for metric in metrics])
@@ -0,0 +1,89 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+
+
+class ACLWeightAllocator(object):
+    """Tracks the weights used by the ACLs of a switch port.
+
+    The used weights are kept in a bitmap per ACL action, so that free
+    weights can be found without scanning the existing ACLs. The bitmap
+    operations are linear in the bitmap size, which is bounded by the
+    maximum ACL weight (65500 bits, about 8KB).
+    """
+
+    def __init__(self, acls=()):
+        self._lock = threading.Lock()
+        # Maps the ACL actions to used weights bitmaps.
+        self._used = collections.defaultdict(int)
+
+        for acl in acls:
+            self._used[acl.Action] |= 1 << acl.Weight
+
+    @staticmethod
+    def _get_range_mask(min_weight, max_weight):
+        return ((1 << (max_weight + 1)) - 1) & ~((1 << min_weight) - 1)
+
+    def get_min_used(self, action):
+        """Returns the lowest weight used by the given action, if any."""
+        used = self._used.get(action, 0)
+        if not used:
+            return None
+        # Isolate the lowest set bit.
+        return (used & -used).bit_length() - 1
+
+    def is_used(self, action, weight):
+        return bool(self._used.get(action, 0) & (1 << weight))
+
+    def allocate_lowest(self, action, count, min_weight, max_weight):
+        """Reserves the lowest free weights within the given range.
+
+        Less than 'count' weights are returned if the range does not have
+        enough free weights.
+        """
+        weights = []
+        with self._lock:
+            free = (~self._used[action] &
+                    self._get_range_mask(min_weight, max_weight))
+            while free and len(weights) < count:
+                bit = free & -free
+                free ^= bit
+                self._used[action] |= bit
+                weights.append(bit.bit_length() - 1)
+        return weights
+
+    def allocate_highest(self, action, count, min_weight, max_weight):
+        """Reserves the highest free weights within the given range.
+
+        The weights are returned in descending order. Less than 'count'
+        weights are returned if the range does not have enough free weights.
+        """
+        weights = []
+        with self._lock:
+            free = (~self._used[action] &
+                    self._get_range_mask(min_weight, max_weight))
+            while free and len(weights) < count:
+                weight = free.bit_length() - 1
+                free &= ~(1 << weight)
+                self._used[action] |= 1 << weight
+                weights.append(weight)
+        return weights
+
+    def release(self, action, weights):
+        with self._lock:
+            for weight in weights:
+                self._used[action] &= ~(1 << weight)
@@ -0,0 +1,138 @@
+# Copyright 2017 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import threading
+import time
+
+
+class WMIObjectCache(object):
+    """Thread safe, bounded cache.
+
+    Exposes a subset of the dict API. When the maximum size is exceeded,
+    the least recently used entries are evicted. Entries older than the
+    configured TTL are discarded when accessed.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        """Creates the cache.
+
+        :param max_size: the maximum number of entries. Unbounded if None.
+        :param ttl: the entries lifetime, in seconds. If None or 0, the
+            entries do not expire.
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+
+        self._lock = threading.RLock()
+        # Maps the keys to (value, expiration time) tuples.
+        self._entries = collections.OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def configure(self, max_size=None, ttl=None):
+        with self._lock:
+            self._max_size = max_size
+            self._ttl = ttl
+            self._evict()
+
+    def _evict(self):
+        if self._max_size is None:
+            return
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def _get_entry(self, key):
+        # The lock must be held by the caller.
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at and expires_at <= time.time():
+            self._expirations += 1
+            return None
+
+        # Keep the entries ordered by their last usage.
+        self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self._misses += 1
+                return default
+
+            self._hits += 1
+            return entry[0]
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self._misses += 1
+                raise KeyError(key)
+
+            self._hits += 1
+            return entry[0]
+
+    def __setitem__(self, key, value):
+        expires_at = time.time() + self._ttl if self._ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            self._evict()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._get_entry(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def pop(self, key, *args):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            if args:
+                return args[0]
+            raise KeyError(key)
+        return entry[0]
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def values(self):
+        with self._lock:
+            return [value for value, expires_at in self._entries.values()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(size=len(self._entries),
+                        hits=self._hits,
+                        misses=self._misses,
+                        evictions=self._evictions,
+                        expirations=self._expirations)
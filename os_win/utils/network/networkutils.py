@@ -18,14 +18,15 @@ Utility class for network related operations.
 Based on the "root/virtualization/v2" namespace available starting with
 Hyper-V Server / Windows Server 2012.
 """
-import functools
-import re
+import collections
+import threading
+import time
 
-from eventlet import patcher
-from eventlet import tpool
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import units
 import six
+from six.moves import queue
 
 from os_win._i18n import _
 from os_win import conf
@@ -34,6 +35,8 @@ from os_win import exceptions
 from os_win.utils import _wqlutils
 from os_win.utils import baseutils
 from os_win.utils import jobutils
+from os_win.utils.network import _acl_weight_allocator
+from os_win.utils.network import _wmi_object_cache
 
 CONF = conf.CONF
 LOG = logging.getLogger(__name__)
@@ -99,24 +102,74 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
 
     _VNIC_LISTENER_TIMEOUT_MS = 2000
 
-    _switches = {}
-    _switch_ports = {}
-    _vlan_sds = {}
-    _profile_sds = {}
-    _vsid_sds = {}
-    _sg_acl_sds = {}
-    _bandwidth_sds = {}
+    _switches = _wmi_object_cache.WMIObjectCache()
+    _switch_ports = _wmi_object_cache.WMIObjectCache()
+    _vlan_sds = _wmi_object_cache.WMIObjectCache()
+    _profile_sds = _wmi_object_cache.WMIObjectCache()
+    _vsid_sds = _wmi_object_cache.WMIObjectCache()
+    _sg_acl_sds = _wmi_object_cache.WMIObjectCache()
+    _sg_acl_weights = _wmi_object_cache.WMIObjectCache()
+    _bandwidth_sds = _wmi_object_cache.WMIObjectCache()
+
+    # The profile and VLAN setting data objects may be partial, only
+    # the following properties being guaranteed. Those objects are only
+    # compared against the requested settings and removed when replaced,
+    # for which the path (based on the InstanceID key) is enough.
+    _PORT_PROFILE_SD_FIELDS = (
+        ('InstanceID', ) + tuple(sorted(_PORT_PROFILE_ATTR_MAP.values())))
+    _PORT_VLAN_SD_FIELDS = ('InstanceID', 'OperationMode', 'AccessVlanId',
+                            'NativeVlanId', 'TrunkVlanIdArray')
+
+    # The feature setting data caches loaded by init_caches, along with the
+    # properties that we need. The security and bandwidth setting data
+    # objects are passed back to Hyper-V when being updated, so we're
+    # retrieving the whole objects.
+    _PORT_FEATURE_CACHES = (
+        (_PORT_PROFILE_SET_DATA, '_profile_sds', _PORT_PROFILE_SD_FIELDS),
+        (_PORT_VLAN_SET_DATA, '_vlan_sds', _PORT_VLAN_SD_FIELDS),
+        (_PORT_SECURITY_SET_DATA, '_vsid_sds', ('*', )),
+        (_PORT_BANDWIDTH_SET_DATA, '_bandwidth_sds', ('*', )),
+    )
+    _CACHE_UPDATE_BATCH_SIZE = 50
+    _ACL_QUERY_BATCH_SIZE = 50
+
+    _CACHE_NAMES = ('_switches', '_switch_ports', '_vlan_sds', '_profile_sds',
+                    '_vsid_sds', '_sg_acl_sds', '_sg_acl_weights',
+                    '_bandwidth_sds')
+
+    _cache_invalidation_lock = threading.Lock()
+    _cache_invalidation_subscription = None
+
+    _BANDWIDTH_SD_PROPERTIES = ('Reservation', 'Limit', 'BurstLimit',
+                                'BurstSize')
+    # "Not Supported" error codes, returned when the port bandwidth settings
+    # cannot be modified in place, in which case they have to be replaced.
+    _QOS_MODIFY_NOT_SUPPORTED_ERR_CODES = (1, 32770)
+    # Shared by all the NetworkUtils instances, the key being the host.
+    _qos_modify_unsupported = {}
 
     def __init__(self):
         super(NetworkUtils, self).__init__()
         self._jobutils = jobutils.JobUtils()
         self._enable_cache = CONF.os_win.cache_temporary_wmi_objects
 
+        for cache_name in self._CACHE_NAMES:
+            getattr(NetworkUtils, cache_name).configure(
+                max_size=CONF.os_win.wmi_object_cache_max_size,
+                ttl=CONF.os_win.wmi_object_cache_ttl)
+
+    def get_cache_stats(self):
+        """Returns the hit, miss and eviction counters of the caches."""
+        return {cache_name.lstrip('_'): getattr(self, cache_name).get_stats()
+                for cache_name in self._CACHE_NAMES}
+
     def init_caches(self):
         if not self._enable_cache:
             LOG.info('WMI caching is disabled.')
             return
 
+        self._start_cache_invalidation_listener()
+
         for vswitch in self._conn.Msvm_VirtualEthernetSwitch():
             self._switches[vswitch.ElementName] = vswitch
 
@@ -124,52 +177,107 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
         for port in self._conn.Msvm_EthernetPortAllocationSettingData():
             self._switch_ports[port.ElementName] = port
 
-        # VLAN and VSID setting data's InstanceID will contain the switch
-        # port's InstanceID.
-        switch_port_id_regex = re.compile(
-            "Microsoft:[0-9A-F-]*\\\\[0-9A-F-]*\\\\[0-9A-F-]",
-            flags=re.IGNORECASE)
-
-        # map between switch port's InstanceID and their Port Profile settings
-        # data WMI objects.
-        for profile in self._conn.Msvm_EthernetSwitchPortProfileSettingData():
-            match = switch_port_id_regex.match(profile.InstanceID)
-            if match:
-                self._profile_sds[match.group()] = profile
-
-        # map between switch port's InstanceID and their VLAN setting data WMI
-        # objects.
-        for vlan_sd in self._conn.Msvm_EthernetSwitchPortVlanSettingData():
-            match = switch_port_id_regex.match(vlan_sd.InstanceID)
-            if match:
-                self._vlan_sds[match.group()] = vlan_sd
-
-        # map between switch port's InstanceID and their VSID setting data WMI
-        # objects.
-        for vsid_sd in self._conn.Msvm_EthernetSwitchPortSecuritySettingData():
-            match = switch_port_id_regex.match(vsid_sd.InstanceID)
-            if match:
-                self._vsid_sds[match.group()] = vsid_sd
-
-        # map between switch port's InstanceID and their bandwidth setting
-        # data WMI objects.
-        bandwidths = self._conn.Msvm_EthernetSwitchPortBandwidthSettingData()
-        for bandwidth_sd in bandwidths:
-            match = switch_port_id_regex.match(bandwidth_sd.InstanceID)
-            if match:
-                self._bandwidth_sds[match.group()] = bandwidth_sd
-
-    def update_cache(self):
+        # map between switch port's InstanceID and their feature setting
+        # data WMI objects, only retrieving the properties that we use.
+        for class_name, cache_name, fields in self._PORT_FEATURE_CACHES:
+            cache = getattr(self, cache_name)
+            query = "SELECT %s FROM %s" % (", ".join(fields), class_name)
+            for setting_data in self._conn.query(query):
+                port_id = self._get_switch_port_instance_id(
+                    setting_data.InstanceID)
+                if port_id:
+                    cache[port_id] = setting_data
+
+    @staticmethod
+    def _get_switch_port_instance_id(feature_instance_id):
+        # The feature setting data InstanceID contains the switch port's
+        # InstanceID, having the following format:
+        # Microsoft:<vm_id>\<port_id>\<port_type>\<feature_id>\<id>
+        if feature_instance_id[:10].lower() != 'microsoft:':
+            return None
+
+        parts = feature_instance_id.split('\\', 3)
+        if len(parts) < 3 or not parts[2]:
+            return None
+        return '%s\\%s\\%s' % (parts[0], parts[1], parts[2][0])
+
+    def update_cache(self, incremental=False):
+        """Reloads the cached switch port allocation objects.
+
+        :param incremental: if set, only the newly created switch ports are
+            retrieved, the ones that have been removed being discarded.
+            Otherwise, all the switch port objects are reloaded.
+        """
         if not self._enable_cache:
             return
 
+        if incremental:
+            self._update_switch_ports_cache()
+            return
+
         # map between switch port ID and switch port WMI object.
         self._switch_ports.clear()
         for port in self._conn.Msvm_EthernetPortAllocationSettingData():
             self._switch_ports[port.ElementName] = port
 
+    def _update_switch_ports_cache(self):
+        ports = self._conn.query(
+            "SELECT InstanceID, ElementName FROM %s" %
+            self._PORT_ALLOC_SET_DATA)
+        # Ports that are not named yet cannot be looked up, so we're
+        # skipping them.
+        port_ids = dict((port.ElementName, port.InstanceID)
+                        for port in ports if port.ElementName)
+
+        for port_name in list(self._switch_ports.keys()):
+            if port_name not in port_ids:
+                self._switch_ports.pop(port_name, None)
+
+        new_port_names = [port_name for port_name in port_ids
+                          if port_name not in self._switch_ports]
+        for idx in range(0, len(new_port_names),
+                         self._CACHE_UPDATE_BATCH_SIZE):
+            batch = new_port_names[idx:idx + self._CACHE_UPDATE_BATCH_SIZE]
+            query = "SELECT * FROM %s WHERE %s" % (
+                self._PORT_ALLOC_SET_DATA,
+                " OR ".join("ElementName = '%s'" % port_name.replace("'", '"')
+                            for port_name in batch))
+            for port in self._conn.query(query):
+                self._switch_ports[port.ElementName] = port
+
     def clear_port_sg_acls_cache(self, switch_port_name):
         self._sg_acl_sds.pop(switch_port_name, None)
+        self._sg_acl_weights.pop(switch_port_name, None)
+
+    def _invalidate_port_cache(self, switch_port_name, port_instance_id):
+        self._switch_ports.pop(switch_port_name, None)
+        self._sg_acl_sds.pop(switch_port_name, None)
+        self._sg_acl_weights.pop(switch_port_name, None)
+        self._profile_sds.pop(port_instance_id, None)
+        self._vlan_sds.pop(port_instance_id, None)
+        self._vsid_sds.pop(port_instance_id, None)
+        self._bandwidth_sds.pop(port_instance_id, None)
+
+    def _start_cache_invalidation_listener(self):
+        """Drops the cached objects of the removed switch ports.
+
+        A single listener is used by all the NetworkUtils instances.
+        """
+        with self._cache_invalidation_lock:
+            if NetworkUtils._cache_invalidation_subscription:
+                return
+
+            query = self._get_event_wql_query(
+                cls=self._PORT_ALLOC_SET_DATA,
+                event_type=self.EVENT_TYPE_DELETE,
+                timeframe=2)
+            subscription = self._get_wmi_event_hub(
+                self._wmi_namespace % self._host).subscribe(
+                    query, callback=self._invalidate_removed_port)
+            NetworkUtils._cache_invalidation_subscription = subscription
+
+    def _invalidate_removed_port(self, event):
+        self._invalidate_port_cache(event.ElementName, event.InstanceID)
 
     def get_vswitch_id(self, vswitch_name):
         vswitch = self._get_vswitch(vswitch_name)
@@ -197,8 +305,9 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
             return ext_port.ElementName
 
     def _get_vswitch(self, vswitch_name):
-        if vswitch_name in self._switches:
-            return self._switches[vswitch_name]
+        vswitch = self._switches.get(vswitch_name)
+        if vswitch is not None:
+            return vswitch
 
         vswitch = self._conn.Msvm_VirtualEthernetSwitch(
             ElementName=vswitch_name)
@@ -264,30 +373,47 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
             raise exceptions.HyperVvNicNotFound(vnic_name=vnic_name)
         return vnic_settings[0]
 
-    def get_vnic_event_listener(self, event_type):
+    def get_vnic_event_listener(self, event_type, batch_window=None):
+        """Returns a listener for vNIC events.
+
+        :param event_type: the type of the events, e.g. EVENT_TYPE_CREATE.
+        :param batch_window: if set, the events are collected for the given
+            number of seconds after the first one, the callback receiving
+            the deduplicated list of port names instead of a single port
+            name.
+        """
         query = self._get_event_wql_query(cls=self._VNIC_SET_DATA,
                                           event_type=event_type,
                                           timeframe=2)
-        listener = self._conn.Msvm_SyntheticEthernetPortSettingData.watch_for(
-            query)
+        # The events are retrieved by the namespace event hub, which is
+        # shared by all the os-win event listeners.
+        subscription = self._get_wmi_event_hub(
+            self._wmi_namespace % self._host).subscribe(query)
+
+        def _get_event_batch(first_event):
+            port_names = collections.OrderedDict()
+            port_names[first_event.ElementName] = None
+
+            deadline = time.time() + batch_window
+            time_left = batch_window
+            while time_left > 0:
+                event = subscription.get(timeout=time_left)
+                if event is not None:
+                    port_names[event.ElementName] = None
+                time_left = deadline - time.time()
+            return list(port_names)
 
         def _poll_events(callback):
-            if patcher.is_monkey_patched('thread'):
-                listen = functools.partial(tpool.execute, listener,
-                                           self._VNIC_LISTENER_TIMEOUT_MS)
-            else:
-                listen = functools.partial(listener,
-                                           self._VNIC_LISTENER_TIMEOUT_MS)
-
             while True:
-                # Retrieve one by one all the events that occurred in
-                # the checked interval.
-                try:
-                    event = listen()
+                event = subscription.get(
+                    timeout=self._VNIC_LISTENER_TIMEOUT_MS / 1000)
+                if event is None:
+                    continue
+
+                if batch_window:
+                    callback(_get_event_batch(event))
+                else:
                     callback(event.ElementName)
-                except exceptions.x_wmi_timed_out:
-                    # no new event published.
-                    pass
 
         return _poll_events
 
@@ -354,11 +480,7 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
                 # port may have already been destroyed by Hyper-V
                 pass
 
-        self._switch_ports.pop(switch_port_name, None)
-        self._profile_sds.pop(sw_port.InstanceID, None)
-        self._vlan_sds.pop(sw_port.InstanceID, None)
-        self._vsid_sds.pop(sw_port.InstanceID, None)
-        self._bandwidth_sds.pop(sw_port.InstanceID, None)
+        self._invalidate_port_cache(switch_port_name, sw_port.InstanceID)
 
     def set_vswitch_port_profile_id(self, switch_port_name, profile_id,
                                     profile_data, profile_name, vendor_name,
@@ -419,26 +541,13 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
         operation_mode = kwargs.get('operation_mode',
                                     constants.VLAN_MODE_ACCESS)
         trunk_vlans = kwargs.get('trunk_vlans')
-
-        if operation_mode not in [constants.VLAN_MODE_ACCESS,
-                                  constants.VLAN_MODE_TRUNK]:
-            msg = _('Unsupported VLAN operation mode: %s')
-            raise AttributeError(msg % operation_mode)
-
-        if (operation_mode == constants.VLAN_MODE_ACCESS and
-                trunk_vlans is not None):
-            raise AttributeError(_('The given operation mode is ACCESS, '
-                                   'cannot set given trunk_vlans.'))
+        self._validate_vlan_args(operation_mode, trunk_vlans)
 
         port_alloc = self._get_switch_port_allocation(switch_port_name)[0]
         vlan_settings = self._get_vlan_setting_data_from_port_alloc(port_alloc)
 
-        if operation_mode == constants.VLAN_MODE_ACCESS:
-            new_vlan_settings = self._prepare_vlan_sd_access_mode(
-                vlan_settings, vlan_id)
-        else:
-            new_vlan_settings = self._prepare_vlan_sd_trunk_mode(
-                vlan_settings, vlan_id, trunk_vlans)
+        new_vlan_settings = self._prepare_vlan_sd(
+            vlan_settings, vlan_id, operation_mode, trunk_vlans)
 
         if not new_vlan_settings:
             # if no object was returned, it means that the VLAN Setting Data
@@ -478,6 +587,25 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
 
         return profile_id_settings
 
+    @staticmethod
+    def _validate_vlan_args(operation_mode, trunk_vlans):
+        if operation_mode not in [constants.VLAN_MODE_ACCESS,
+                                  constants.VLAN_MODE_TRUNK]:
+            msg = _('Unsupported VLAN operation mode: %s')
+            raise AttributeError(msg % operation_mode)
+
+        if (operation_mode == constants.VLAN_MODE_ACCESS and
+                trunk_vlans is not None):
+            raise AttributeError(_('The given operation mode is ACCESS, '
+                                   'cannot set given trunk_vlans.'))
+
+    def _prepare_vlan_sd(self, vlan_settings, vlan_id, operation_mode,
+                         trunk_vlans):
+        if operation_mode == constants.VLAN_MODE_ACCESS:
+            return self._prepare_vlan_sd_access_mode(vlan_settings, vlan_id)
+        return self._prepare_vlan_sd_trunk_mode(vlan_settings, vlan_id,
+                                                trunk_vlans)
+
     def _prepare_vlan_sd_access_mode(self, vlan_settings, vlan_id):
         if vlan_settings:
             # the given vlan_id might be None.
@@ -560,10 +688,12 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
                 _('Port Security Settings not found: %s') % switch_port_name)
 
     def _get_profile_setting_data_from_port_alloc(self, port_alloc):
+        # Only the _PORT_PROFILE_SD_FIELDS properties may be used.
         return self._get_setting_data_from_port_alloc(
             port_alloc, self._profile_sds, self._PORT_PROFILE_SET_DATA)
 
     def _get_vlan_setting_data_from_port_alloc(self, port_alloc):
+        # Only the _PORT_VLAN_SD_FIELDS properties may be used.
         return self._get_setting_data_from_port_alloc(
             port_alloc, self._vlan_sds, self._PORT_VLAN_SET_DATA)
 
@@ -576,8 +706,9 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
             port_alloc, self._bandwidth_sds, self._PORT_BANDWIDTH_SET_DATA)
 
     def _get_setting_data_from_port_alloc(self, port_alloc, cache, data_class):
-        if port_alloc.InstanceID in cache:
-            return cache[port_alloc.InstanceID]
+        setting_data = cache.get(port_alloc.InstanceID)
+        if setting_data is not None:
+            return setting_data
 
         setting_data = self._get_first_item(
             _wqlutils.get_element_associated_class(
@@ -589,8 +720,9 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
 
     def _get_switch_port_allocation(self, switch_port_name, create=False,
                                     expected=True):
-        if switch_port_name in self._switch_ports:
-            return self._switch_ports[switch_port_name], True
+        switch_port = self._switch_ports.get(switch_port_name)
+        if switch_port is not None:
+            return switch_port, True
 
         switch_port, found = self._get_setting_data(
             self._PORT_ALLOC_SET_DATA,
@@ -620,10 +752,6 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
             data.ElementName = element_name
         return data, found
 
-    def _get_default_setting_data(self, class_name):
-        return self._compat_conn.query("SELECT * FROM %s WHERE InstanceID "
-                                       "LIKE '%%\\Default'" % class_name)[0]
-
     def _create_default_setting_data(self, class_name):
         return getattr(self._compat_conn, class_name).new()
 
@@ -688,18 +816,40 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
         acls = _wqlutils.get_element_associated_class(
             self._conn, self._PORT_EXT_ACL_SET_DATA,
             element_instance_id=port.InstanceID)
+        self._remove_security_acls(port, sg_rules, acls)
+
+    def _remove_security_acls(self, port, sg_rules, acls):
+        """Removes the ACLs matching the given rules from the switch port.
+
+        :returns: the remaining port ACLs.
+        """
+        if not sg_rules:
+            return acls
+
+        key_fields = self._get_security_rule_key_fields(sg_rules)
+        remove_keys = set(self._get_security_acl_key(sg_rule, key_fields)
+                          for sg_rule in sg_rules)
         remove_acls = []
-        for sg_rule in sg_rules:
-            filtered_acls = self._filter_security_acls(sg_rule, acls)
-            remove_acls.extend(filtered_acls)
+        new_acls = []
+        for acl in acls:
+            if self._get_security_acl_key(acl, key_fields) in remove_keys:
+                remove_acls.append(acl)
+            else:
+                new_acls.append(acl)
 
         if remove_acls:
             self._jobutils.remove_multiple_virt_features(remove_acls)
 
             # remove the old ACLs from the cache.
-            new_acls = [a for a in acls if a not in remove_acls]
             self._sg_acl_sds[port.ElementName] = new_acls
 
+            weight_allocator = self._sg_acl_weights.get(port.ElementName)
+            if weight_allocator:
+                for acl in remove_acls:
+                    weight_allocator.release(acl.Action, [acl.Weight])
+
+        return new_acls
+
     def remove_all_security_rules(self, switch_port_name):
         port = self._get_switch_port_allocation(switch_port_name)[0]
 
@@ -714,40 +864,138 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
 
             # clear the cache.
             self._sg_acl_sds[port.ElementName] = []
+            self._sg_acl_weights.pop(port.ElementName, None)
+
+    def _bind_security_rules(self, port, sg_rules, acls=None):
+        if acls is None:
+            acls = _wqlutils.get_element_associated_class(
+                self._conn, self._PORT_EXT_ACL_SET_DATA,
+                element_instance_id=port.InstanceID)
+        if not sg_rules:
+            return
 
-    def _bind_security_rules(self, port, sg_rules):
-        acls = _wqlutils.get_element_associated_class(
-            self._conn, self._PORT_EXT_ACL_SET_DATA,
-            element_instance_id=port.InstanceID)
+        key_fields = self._get_security_rule_key_fields(sg_rules)
+        existent_keys = set(self._get_security_acl_key(acl, key_fields)
+                            for acl in acls)
 
         # Add the ACL only if it don't already exist.
-        add_acls = []
         processed_sg_rules = []
-        weights = self._get_new_weights(sg_rules, acls)
-        index = 0
-
         for sg_rule in sg_rules:
-            filtered_acls = self._filter_security_acls(sg_rule, acls)
-            if filtered_acls:
+            sg_rule_key = self._get_security_acl_key(sg_rule, key_fields)
+            if sg_rule_key in existent_keys:
                 # ACL already exists.
                 continue
 
-            acl = self._create_security_acl(sg_rule, weights[index])
-            add_acls.append(acl)
-            index += 1
-
-            # append sg_rule the acls list, to make sure that the same rule
-            # is not processed twice.
+            # make sure that the same rule is not processed twice.
+            existent_keys.add(sg_rule_key)
             processed_sg_rules.append(sg_rule)
 
+        add_acls = []
+        if processed_sg_rules:
+            weights = self._get_new_weights(processed_sg_rules, acls, port)
+            for index, sg_rule in enumerate(processed_sg_rules):
+                acl = self._create_security_acl(sg_rule, weights[index])
+                add_acls.append(acl)
+
         if add_acls:
-            self._jobutils.add_multiple_virt_features(add_acls, port)
+            try:
+                self._jobutils.add_multiple_virt_features(add_acls, port)
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    # The reserved weights may not be used.
+                    self._sg_acl_weights.pop(port.ElementName, None)
 
             # caching the Security Group Rules that have been processed and
             # added to the port. The list should only be used to check the
             # existence of rules, nothing else.
             acls.extend(processed_sg_rules)
 
+    def apply_security_rules_bulk(self, port_rules, max_workers=8):
+        """Adds and removes security group rules on multiple switch ports.
+
+        The ACLs of all the involved ports are retrieved using a single
+        query, while the per port feature jobs are submitted by a bounded
+        number of workers.
+
+        :param port_rules: a dict mapping switch port names to
+            (add_rules, remove_rules) tuples. The rules are removed before
+            the new ones are added.
+        :param max_workers: the maximum number of ports updated in parallel.
+        :returns: a dict mapping the switch port names to None if the rules
+            were successfully applied or to the encountered exception.
+        """
+        results = {}
+        ports = {}
+        for port_name in port_rules:
+            try:
+                ports[port_name] = self._get_switch_port_allocation(
+                    port_name)[0]
+            except Exception as ex:
+                results[port_name] = ex
+
+        acls_by_port_id = self._get_ports_security_acls(ports.values())
+
+        pending_ports = queue.Queue()
+        for port_name in ports:
+            pending_ports.put(port_name)
+
+        def _apply_port_rules():
+            while True:
+                try:
+                    port_name = pending_ports.get_nowait()
+                except queue.Empty:
+                    return
+
+                port = ports[port_name]
+                add_rules, remove_rules = port_rules[port_name]
+                acls = acls_by_port_id.get(port.InstanceID, [])
+                try:
+                    acls = self._remove_security_acls(port, remove_rules,
+                                                      acls)
+                    self._bind_security_rules(port, add_rules, acls)
+                    results[port_name] = None
+                except Exception as ex:
+                    LOG.error("Failed to apply the security group rules "
+                              "on port %(port_name)s. Exception: %(ex)s",
+                              dict(port_name=port_name, ex=ex))
+                    results[port_name] = ex
+
+        workers = []
+        while len(workers) < min(max_workers, len(ports)):
+            worker = threading.Thread(target=_apply_port_rules)
+            worker.setDaemon(True)
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+        return results
+
+    def _get_ports_security_acls(self, ports):
+        """Returns the ACLs of the given switch ports, using batched queries.
+
+        :returns: a dict mapping the switch port InstanceIDs to lists of
+            ACL setting data objects.
+        """
+        acls_by_port_id = {port.InstanceID: [] for port in ports}
+        if not acls_by_port_id:
+            return acls_by_port_id
+
+        # The ACL InstanceIDs are prefixed by the switch port InstanceID.
+        port_ids = list(acls_by_port_id)
+        for idx in range(0, len(port_ids), self._ACL_QUERY_BATCH_SIZE):
+            batch = port_ids[idx:idx + self._ACL_QUERY_BATCH_SIZE]
+            query = "SELECT * FROM %s WHERE %s" % (
+                self._PORT_EXT_ACL_SET_DATA,
+                " OR ".join("InstanceID LIKE '%s%%'" % port_id
+                            for port_id in batch))
+            for acl in self._conn.query(query):
+                port_id = self._get_switch_port_instance_id(acl.InstanceID)
+                if port_id in acls_by_port_id:
+                    acls_by_port_id[port_id].append(acl)
+        return acls_by_port_id
+
     def _get_port_security_acls(self, port):
         """Returns a mutable list of Security Group Rule objects.
 
@@ -755,8 +1003,9 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
         otherwise it fetches and caches from the port's associated class.
         """
 
-        if port.ElementName in self._sg_acl_sds:
-            return self._sg_acl_sds[port.ElementName]
+        acls = self._sg_acl_sds.get(port.ElementName)
+        if acls is not None:
+            return acls
 
         acls = _wqlutils.get_element_associated_class(
             self._conn, self._PORT_EXT_ACL_SET_DATA,
@@ -788,14 +1037,32 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
                 v.AclType == acl_type and
                 v.RemoteAddress == remote_addr]
 
-    def _filter_security_acls(self, sg_rule, acls):
-        return [a for a in acls if sg_rule == a]
+    @staticmethod
+    def _get_security_rule_key_fields(sg_rules):
+        """Returns the fields identifying the given security group rules.
+
+        Security group rules are compared with the ACLs using the fields
+        that are passed to the ACL setting data objects.
+        """
+        return tuple(sorted(sg_rules[0].to_dict()))
+
+    @staticmethod
+    def _get_security_acl_key(acl, key_fields):
+        """Returns a hashable key for an ACL or a security group rule.
 
-    def _get_new_weights(self, sg_rules, existent_acls):
+        ACLs and security group rules matching each other have the same key,
+        which allows them to be looked up in sets instead of being compared
+        one by one.
+        """
+        return tuple(getattr(acl, field, None) for field in key_fields)
+
+    def _get_new_weights(self, sg_rules, existent_acls, port=None):
         """Computes the weights needed for given sg_rules.
 
         :param sg_rules: ACLs to be added. They must have the same Action.
         :existent_acls: ACLs already bound to a switch port.
+        :param port: the switch port to which the ACLs will be added. If
+                     given, the port's cached weight allocator is used.
         :return: list of weights which will be used to create ACLs. List will
                  have the recommended order for sg_rules' Action.
         """
@@ -804,6 +1071,10 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
     def set_port_qos_rule(self, port_id, qos_rule):
         """Sets the QoS rule for the given port.
 
+        The existing bandwidth settings are modified in place, if supported
+        by the host. The call is skipped if the port already has the
+        requested limits.
+
         :param port_id: the port's ID to which the QoS rule will be applied to.
         :param qos_rule: a dictionary containing the following keys:
             min_kbps, max_kbps, max_burst_kbps, max_burst_size_kb.
@@ -814,6 +1085,148 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
         :raises exceptions.HyperVException: if the QoS rule cannot be set.
         """
 
+        new_bandwidth = self._prepare_bandwidth_sd(qos_rule)
+        if not new_bandwidth:
+            # no limits need to be set
+            return
+
+        port_alloc = self._get_switch_port_allocation(port_id)[0]
+        bandwidth = self._get_bandwidth_setting_data_from_port_alloc(
+            port_alloc)
+        if self._bandwidth_sd_matches(bandwidth, new_bandwidth):
+            return
+
+        results = self._update_ports_bandwidth(
+            {port_id: (port_alloc, bandwidth, new_bandwidth)})
+        if results[port_id]:
+            raise self._get_qos_rule_exc(results[port_id], qos_rule,
+                                         port_alloc)
+
+    def set_port_qos_rules(self, port_qos_rules):
+        """Sets the QoS rules of multiple ports.
+
+        The bandwidth settings of all the ports are modified using a single
+        job, if supported by the host. Ports that do not have bandwidth
+        settings yet require one job each. Ports that already have the
+        requested limits are skipped.
+
+        :param port_qos_rules: a dict mapping port IDs to QoS rules, as
+            accepted by set_port_qos_rule.
+        :returns: a dict mapping the port IDs to None if the QoS rule was
+            successfully set, or to the encountered exception.
+        """
+        results = {}
+        updates = {}
+        for port_id, qos_rule in port_qos_rules.items():
+            results[port_id] = None
+            try:
+                new_bandwidth = self._prepare_bandwidth_sd(qos_rule)
+                if not new_bandwidth:
+                    continue
+
+                port_alloc = self._get_switch_port_allocation(port_id)[0]
+                bandwidth = self._get_bandwidth_setting_data_from_port_alloc(
+                    port_alloc)
+                if not self._bandwidth_sd_matches(bandwidth, new_bandwidth):
+                    updates[port_id] = (port_alloc, bandwidth, new_bandwidth)
+            except Exception as ex:
+                results[port_id] = ex
+
+        for port_id, exc in self._update_ports_bandwidth(updates).items():
+            if exc:
+                port_alloc = updates[port_id][0]
+                results[port_id] = self._get_qos_rule_exc(
+                    exc, port_qos_rules[port_id], port_alloc)
+        return results
+
+    def _get_qos_rule_exc(self, exc, qos_rule, port_alloc):
+        if '0x80070057' in six.text_type(exc):
+            return exceptions.InvalidParameterValue(
+                param_name="qos_rule", param_value=qos_rule)
+        return exceptions.HyperVException(
+            'Unable to set qos rule %(qos_rule)s for port %(port)s. '
+            'Error: %(error)s' %
+            dict(qos_rule=qos_rule, port=port_alloc, error=exc))
+
+    def _bandwidth_sd_matches(self, bandwidth, new_bandwidth):
+        return bool(bandwidth) and all(
+            getattr(bandwidth, attr) == getattr(new_bandwidth, attr)
+            for attr in self._BANDWIDTH_SD_PROPERTIES)
+
+    def _update_ports_bandwidth(self, updates):
+        """Applies the new bandwidth settings of multiple ports.
+
+        :param updates: a dict mapping the port IDs to (port_alloc,
+            bandwidth, new_bandwidth) tuples, bandwidth being None if the
+            port does not have bandwidth settings.
+        :returns: a dict mapping the port IDs to None or to the encountered
+            exception.
+        """
+        results = {}
+        modify_port_ids = [port_id for port_id, update in updates.items()
+                           if update[1]]
+        add_port_ids = [port_id for port_id, update in updates.items()
+                        if not update[1]]
+
+        if (modify_port_ids and
+                not self._qos_modify_unsupported.get(self._host)):
+            bandwidth_sds = []
+            for port_id in modify_port_ids:
+                port_alloc, bandwidth, new_bandwidth = updates[port_id]
+                for attr in self._BANDWIDTH_SD_PROPERTIES:
+                    setattr(bandwidth, attr, getattr(new_bandwidth, attr))
+                bandwidth_sds.append(bandwidth)
+
+            try:
+                self._jobutils.modify_multiple_virt_features(bandwidth_sds)
+                results.update({port_id: None for port_id in modify_port_ids})
+                modify_port_ids = []
+            except Exception as ex:
+                # The modified objects may not reflect the actual settings.
+                for port_id in modify_port_ids:
+                    self._bandwidth_sds.pop(updates[port_id][0].InstanceID,
+                                            None)
+
+                if (getattr(ex, 'error_code', None) not in
+                        self._QOS_MODIFY_NOT_SUPPORTED_ERR_CODES):
+                    results.update({port_id: ex
+                                    for port_id in modify_port_ids})
+                    modify_port_ids = []
+                else:
+                    LOG.info("The port bandwidth settings cannot be "
+                             "modified on this host, replacing them "
+                             "instead.")
+                    self._qos_modify_unsupported[self._host] = True
+
+        if modify_port_ids:
+            # Removing the features because they cannot be modified
+            # due to a wmi exception.
+            try:
+                self._jobutils.remove_multiple_virt_features(
+                    [updates[port_id][1] for port_id in modify_port_ids])
+                add_port_ids += modify_port_ids
+            except Exception as ex:
+                results.update({port_id: ex for port_id in modify_port_ids})
+
+            # remove from cache.
+            for port_id in modify_port_ids:
+                self._bandwidth_sds.pop(updates[port_id][0].InstanceID, None)
+
+        for port_id in add_port_ids:
+            port_alloc, bandwidth, new_bandwidth = updates[port_id]
+            try:
+                self._jobutils.add_virt_feature(new_bandwidth, port_alloc)
+                results[port_id] = None
+            except Exception as ex:
+                results[port_id] = ex
+
+        return results
+
+    def _prepare_bandwidth_sd(self, qos_rule):
+        """Validates the QoS rule, returning a bandwidth setting data object.
+
+        None is returned if the QoS rule does not contain any limits.
+        """
         # Hyper-V stores bandwidth limits in bytes.
         min_bps = qos_rule.get("min_kbps", 0) * units.Ki
         max_bps = qos_rule.get("max_kbps", 0) * units.Ki
@@ -821,8 +1234,7 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
         max_burst_sz = qos_rule.get("max_burst_size_kb", 0) * units.Ki
 
         if not (min_bps or max_bps or max_burst_bps or max_burst_sz):
-            # no limits need to be set
-            return
+            return None
 
         if min_bps and min_bps < 10 * units.Mi:
             raise exceptions.InvalidParameterValue(
@@ -834,34 +1246,13 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
             raise exceptions.InvalidParameterValue(
                 param_name="max_burst_kbps", param_value=max_burst_bps)
 
-        port_alloc = self._get_switch_port_allocation(port_id)[0]
-        bandwidth = self._get_bandwidth_setting_data_from_port_alloc(
-            port_alloc)
-        if bandwidth:
-            # Removing the feature because it cannot be modified
-            # due to a wmi exception.
-            self._jobutils.remove_virt_feature(bandwidth)
-
-            # remove from cache.
-            self._bandwidth_sds.pop(port_alloc.InstanceID, None)
-
         bandwidth = self._get_default_setting_data(
             self._PORT_BANDWIDTH_SET_DATA)
         bandwidth.Reservation = min_bps
         bandwidth.Limit = max_bps
         bandwidth.BurstLimit = max_burst_bps
         bandwidth.BurstSize = max_burst_sz
-
-        try:
-            self._jobutils.add_virt_feature(bandwidth, port_alloc)
-        except Exception as ex:
-            if '0x80070057' in six.text_type(ex):
-                raise exceptions.InvalidParameterValue(
-                    param_name="qos_rule", param_value=qos_rule)
-            raise exceptions.HyperVException(
-                'Unable to set qos rule %(qos_rule)s for port %(port)s. '
-                'Error: %(error)s' %
-                dict(qos_rule=qos_rule, port=port_alloc, error=ex))
+        return bandwidth
 
     def remove_port_qos_rule(self, port_id):
         """Removes the QoS rule from the given port.
@@ -876,6 +1267,139 @@ class NetworkUtils(baseutils.BaseUtilsVirt):
             # remove from cache.
             self._bandwidth_sds.pop(port_alloc.InstanceID, None)
 
+    def apply_port_config(self, switch_port_name, desired):
+        """Applies the desired configuration to the given switch port.
+
+        The current port features are compared with the desired ones, only
+        the features that differ being replaced. The obsolete features are
+        removed using a single RemoveFeatureSettings call, after which the
+        new ones are added using a single AddFeatureSettings call.
+
+        :param switch_port_name: the ElementName of the vSwitch port.
+        :param desired: a dict which may contain the following keys:
+            vswitch_name: the vSwitch to which the port is connected.
+            profile: a dict containing the set_vswitch_port_profile_id
+                arguments.
+            vlan: a dict which may contain the vlan_id, operation_mode and
+                trunk_vlans set_vswitch_port_vlan_id arguments.
+            security: a dict containing the security setting data
+                properties, e.g.: VirtualSubnetId, AllowMacSpoofing.
+            qos_rule: a dict containing the set_port_qos_rule arguments.
+            Features that are not specified are left untouched, while
+            features set to None are removed.
+        :returns: a list containing the names of the updated features.
+        :raises HyperVException: if the VLAN or security settings are not
+            found on the port after being added.
+        """
+        unknown_keys = set(desired) - set(('vswitch_name', 'profile', 'vlan',
+                                           'security', 'qos_rule'))
+        if unknown_keys:
+            raise exceptions.InvalidParameterValue(
+                param_name='desired', param_value=sorted(unknown_keys))
+
+        if desired.get('vswitch_name'):
+            self.connect_vnic_to_vswitch(desired['vswitch_name'],
+                                         switch_port_name)
+
+        features = (
+            ('profile', self._get_profile_setting_data_from_port_alloc,
+             self._get_new_profile_sd, self._profile_sds),
+            ('vlan', self._get_vlan_setting_data_from_port_alloc,
+             self._get_new_vlan_sd, self._vlan_sds),
+            ('security', self._get_security_setting_data_from_port_alloc,
+             self._get_new_security_sd, self._vsid_sds),
+            ('qos_rule', self._get_bandwidth_setting_data_from_port_alloc,
+             self._get_new_bandwidth_sd, self._bandwidth_sds))
+
+        port_alloc = self._get_switch_port_allocation(switch_port_name)[0]
+        remove_sds = []
+        add_sds = []
+        updated_features = []
+        for feature, get_current_sd, get_new_sd, cache in features:
+            if feature not in desired:
+                continue
+
+            current_sd = get_current_sd(port_alloc)
+            if desired[feature] is None:
+                new_sd = None
+                if not current_sd:
+                    continue
+            else:
+                new_sd = get_new_sd(current_sd, desired[feature])
+                if not new_sd:
+                    # The feature is already properly configured.
+                    continue
+
+            if current_sd:
+                # Port features cannot be modified due to a WMI exception,
+                # so we're replacing them.
+                remove_sds.append(current_sd)
+            if new_sd:
+                add_sds.append(new_sd)
+
+            cache.pop(port_alloc.InstanceID, None)
+            updated_features.append(feature)
+
+        if remove_sds:
+            self._jobutils.remove_multiple_virt_features(remove_sds)
+        if add_sds:
+            self._jobutils.add_multiple_virt_features(add_sds, port_alloc)
+
+        # TODO(claudiub): This will help solve the missing VLAN / VSID issue,
+        # but it comes with a performance cost. The root cause of the problem
+        # must be solved.
+        if 'vlan' in updated_features and desired['vlan'] is not None:
+            if not self._get_vlan_setting_data_from_port_alloc(port_alloc):
+                raise exceptions.HyperVException(
+                    _('Port VLAN not found: %s') % switch_port_name)
+        if 'security' in updated_features and desired['security'] is not None:
+            if not self._get_security_setting_data_from_port_alloc(
+                    port_alloc):
+                raise exceptions.HyperVException(
+                    _('Port Security Settings not found: %s') %
+                    switch_port_name)
+
+        return updated_features
+
+    def _get_new_profile_sd(self, port_profile, profile_args):
+        new_port_profile = self._prepare_profile_sd(**profile_args)
+        if port_profile and all(
+                getattr(port_profile, _PORT_PROFILE_ATTR_MAP[arg_name]) ==
+                getattr(new_port_profile, _PORT_PROFILE_ATTR_MAP[arg_name])
+                for arg_name, arg_value in profile_args.items()
+                if arg_value is not None):
+            return None
+        return new_port_profile
+
+    def _get_new_vlan_sd(self, vlan_settings, vlan_args):
+        operation_mode = vlan_args.get('operation_mode',
+                                       constants.VLAN_MODE_ACCESS)
+        trunk_vlans = vlan_args.get('trunk_vlans')
+        self._validate_vlan_args(operation_mode, trunk_vlans)
+
+        return self._prepare_vlan_sd(vlan_settings, vlan_args.get('vlan_id'),
+                                     operation_mode, trunk_vlans)
+
+    def _get_new_security_sd(self, sec_settings, sec_props):
+        if sec_settings:
+            if all(getattr(sec_settings, k) == v
+                   for k, v in sec_props.items()):
+                return None
+        else:
+            sec_settings = self._create_default_setting_data(
+                self._PORT_SECURITY_SET_DATA)
+
+        for k, v in sec_props.items():
+            setattr(sec_settings, k, v)
+        return sec_settings
+
+    def _get_new_bandwidth_sd(self, bandwidth, qos_rule):
+        new_bandwidth = self._prepare_bandwidth_sd(qos_rule)
+        if new_bandwidth and self._bandwidth_sd_matches(bandwidth,
+                                                        new_bandwidth):
+            return None
+        return new_bandwidth
+
 
 class NetworkUtilsR2(NetworkUtils):
     _PORT_EXT_ACL_SET_DATA = 'Msvm_EthernetSwitchPortExtendedAclSettingData'
@@ -891,36 +1415,50 @@ class NetworkUtilsR2(NetworkUtils):
         sg_rule.Weight = weight
         return acl
 
-    def _get_new_weights(self, sg_rules, existent_acls):
-        sg_rule = sg_rules[0]
+    def _get_acl_weight_allocator(self, existent_acls, port=None):
+        """Returns the weight allocator of the given port.
+
+        The allocators are cached along with the port ACLs, the existent
+        ACLs being used only when a new allocator is created.
+        """
+        if port is not None:
+            weight_allocator = self._sg_acl_weights.get(port.ElementName)
+            if weight_allocator:
+                return weight_allocator
+
+        weight_allocator = _acl_weight_allocator.ACLWeightAllocator(
+            existent_acls)
+        if port is not None and self._enable_cache:
+            self._sg_acl_weights[port.ElementName] = weight_allocator
+        return weight_allocator
+
+    def _get_new_weights(self, sg_rules, existent_acls, port=None):
+        action = sg_rules[0].Action
         num_rules = len(sg_rules)
-        existent_acls = [a for a in existent_acls
-                         if a.Action == sg_rule.Action]
-        if not existent_acls:
-            if sg_rule.Action == self._ACL_ACTION_DENY:
-                return list(range(1, 1 + num_rules))
+        weight_allocator = self._get_acl_weight_allocator(existent_acls, port)
+
+        if action == self._ACL_ACTION_DENY:
+            # The deny ACLs usually fit in the first _REJECT_ACLS_COUNT
+            # weights, but they are not limited to them.
+            weights = weight_allocator.allocate_lowest(
+                action, num_rules, 1, self._MAX_WEIGHT - 1)
+        else:
+            min_weight = weight_allocator.get_min_used(action)
+            if min_weight is None:
+                min_weight = self._MAX_WEIGHT
+
+            if min_weight - num_rules - 1 > self._REJECT_ACLS_COUNT:
+                # use the contiguous weights right below the existent ACLs.
+                weights = weight_allocator.allocate_highest(
+                    action, num_rules, 1, min_weight - 1)
             else:
-                return list(range(self._MAX_WEIGHT - 1,
-                                  self._MAX_WEIGHT - 1 - num_rules, - 1))
-
-        # there are existent ACLs.
-        weights = [a.Weight for a in existent_acls]
-        if sg_rule.Action == self._ACL_ACTION_DENY:
-            return [i for i in list(range(1, self._REJECT_ACLS_COUNT + 1))
-                    if i not in weights][:num_rules]
-
-        min_weight = min(weights)
-        last_weight = min_weight - num_rules - 1
-        if last_weight > self._REJECT_ACLS_COUNT:
-            return list(range(min_weight - 1, last_weight, - 1))
-
-        # not enough weights. Must search for available weights.
-        # if it is this case, num_rules is a small number.
-        current_weight = self._MAX_WEIGHT - 1
-        new_weights = []
-        for i in list(range(num_rules)):
-            while current_weight in weights:
-                current_weight -= 1
-            new_weights.append(current_weight)
-
-        return new_weights
+                # not enough weights. Must search for available weights.
+                weights = weight_allocator.allocate_highest(
+                    action, num_rules, 1, self._MAX_WEIGHT - 1)
+
+        if len(weights) < num_rules:
+            weight_allocator.release(action, weights)
+            raise exceptions.HyperVException(
+                _('Not enough ACL weights available for %(num_rules)d '
+                  'rules.') % dict(num_rules=num_rules))
+        return weights
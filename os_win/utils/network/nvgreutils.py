@@ -97,6 +97,46 @@ class NvgreUtils(baseutils.BaseUtils):
             Metric=255,
             RoutingDomainID='{%s}' % rdid_uuid)
 
+    def sync_customer_routes(self, vsid, desired_routes):
+        """Ensures that the virtual subnet has exactly the given routes.
+
+        The existing routes are retrieved once, only the missing routes
+        being created and only the obsolete ones being deleted.
+
+        :param vsid: the virtual subnet ID.
+        :param desired_routes: a list of (dest_prefix, next_hop, rdid_uuid)
+            tuples, as accepted by create_customer_route.
+        """
+        routes = self._scimv2.MSFT_NetVirtualizationCustomerRouteSettingData(
+            VirtualSubnetID=vsid)
+
+        existing_routes = {}
+        for route in routes:
+            key = self._get_customer_route_key(
+                route.DestinationPrefix, route.NextHop, route.RoutingDomainID)
+            if key in existing_routes:
+                # duplicate route.
+                route.Delete_()
+            else:
+                existing_routes[key] = route
+
+        missing_routes = []
+        for dest_prefix, next_hop, rdid_uuid in desired_routes:
+            key = self._get_customer_route_key(dest_prefix, next_hop,
+                                               '{%s}' % rdid_uuid)
+            if existing_routes.pop(key, None) is None:
+                missing_routes.append((dest_prefix, next_hop, rdid_uuid))
+
+        for route in existing_routes.values():
+            route.Delete_()
+
+        for dest_prefix, next_hop, rdid_uuid in missing_routes:
+            self.create_customer_route(vsid, dest_prefix, next_hop, rdid_uuid)
+
+    @staticmethod
+    def _get_customer_route_key(dest_prefix, next_hop, rdid):
+        return (dest_prefix, next_hop, rdid.upper())
+
     def create_lookup_record(self, provider_addr, customer_addr, mac, vsid):
         # check for existing entry.
         lrec = self._scimv2.MSFT_NetVirtualizationLookupRecordSettingData(
@@ -111,6 +151,59 @@ class NvgreUtils(baseutils.BaseUtils):
         if lrec:
             lrec[0].Delete_()
 
+        self._create_lookup_record(provider_addr, customer_addr, mac, vsid)
+
+    def sync_lookup_records(self, desired_records, vsids=None):
+        """Ensures that the given lookup records exist.
+
+        The existing lookup records are retrieved using a single query and
+        indexed by (CustomerAddress, VirtualSubnetID). Only the missing or
+        outdated records are created, while records which are not desired
+        are deleted.
+
+        :param desired_records: a list of (provider_addr, customer_addr,
+            mac, vsid) tuples, as accepted by create_lookup_record.
+        :param vsids: the virtual subnet IDs being synchronized. Records
+            belonging to other virtual subnets are left untouched. Defaults
+            to the virtual subnets of the desired records.
+        """
+        if vsids is None:
+            vsids = set(record[3] for record in desired_records)
+
+        lrecs = self._scimv2.MSFT_NetVirtualizationLookupRecordSettingData()
+        existing_records = {}
+        obsolete_records = []
+        for lrec in lrecs:
+            if lrec.VirtualSubnetID not in vsids:
+                continue
+
+            key = (lrec.CustomerAddress, lrec.VirtualSubnetID)
+            if key in existing_records:
+                obsolete_records.append(lrec)
+            else:
+                existing_records[key] = lrec
+
+        missing_records = []
+        for provider_addr, customer_addr, mac, vsid in desired_records:
+            lrec = existing_records.pop((customer_addr, vsid), None)
+            if (lrec and lrec.ProviderAddress == provider_addr and
+                    lrec.MACAddress == mac):
+                # lookup record already exists, nothing to do.
+                continue
+
+            if lrec:
+                obsolete_records.append(lrec)
+            missing_records.append((provider_addr, customer_addr, mac, vsid))
+
+        obsolete_records += existing_records.values()
+        for lrec in obsolete_records:
+            lrec.Delete_()
+
+        for provider_addr, customer_addr, mac, vsid in missing_records:
+            self._create_lookup_record(provider_addr, customer_addr, mac,
+                                       vsid)
+
+    def _create_lookup_record(self, provider_addr, customer_addr, mac, vsid):
         if constants.IPV4_DEFAULT == customer_addr:
             # customer address used for DHCP requests.
             record_type = self._LOOKUP_RECORD_TYPE_L2_ONLY